@@ -6,6 +6,7 @@ class User(AbstractBaseUser):
     username = models.CharField(max_length=150, unique=True)
     password = models.CharField(max_length=128)
     rating = models.IntegerField(default=1200)
+    profile_version = models.PositiveIntegerField(default=0)
 
     friends = models.ManyToManyField('self', blank=True)
 
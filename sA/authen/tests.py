@@ -3,6 +3,10 @@ from rest_framework.test import APITestCase
 from rest_framework import status
 from unittest.mock import patch
 from users import models
+from sA.tokens import AccessToken, token_backend
+from rest_framework_simplejwt.exceptions import TokenError
+import jwt
+import time
 
 
 class SignUpViewTest(APITestCase):
@@ -59,6 +63,14 @@ class SignInViewTest(APITestCase):
         self.assertIn('access', response.data)
         self.assertIn('refresh', response.data)
 
+    def test_sign_in_token_carries_profile(self):
+        url = reverse('signin')
+        response = self.client.post(url, {'username': 'username0', 'password': 'username0password'}, format='json')
+        token = AccessToken(response.data['access'])
+        self.assertEqual(token['username'], 'username0')
+        self.assertEqual(token['rating'], 1200)
+        self.assertEqual(token['profile_version'], self.user.profile_version)
+
     def test_sign_in_invalid_credentials(self):
         url = reverse('signin')
         response = self.client.post(url, {'username': 'usernameUnknown', 'password': 'usernameUnknownPassword'}, format='json')
@@ -97,3 +109,31 @@ class IssueAccessTokenByIdViewTests(APITestCase):
         url = reverse('token-by-id', kwargs={'user_id': self.user.id})
         response = self.client.get(url)
         self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+
+class TokenSigningKeysTest(APITestCase):
+    def setUp(self):
+        self.user = models.User.objects.create(username='username0')
+
+    def sign(self, kid, key):
+        payload = {'token_type': 'access', 'user_id': self.user.id, 'exp': int(time.time()) + 60, 'jti': 'jti'}
+        return jwt.encode(payload, key, algorithm='HS256', headers={'kid': kid} if kid else None)
+
+    def test_token_names_its_signing_key(self):
+        token = str(AccessToken.for_user(self.user))
+        self.assertEqual(jwt.get_unverified_header(token)['kid'], token_backend.current_kid)
+        self.assertEqual(AccessToken(token)['user_id'], self.user.id)
+
+    def test_listed_retired_key_still_verifies(self):
+        with patch.dict(token_backend.signing_keys, {'retired': 'retiredsecret'}):
+            token = AccessToken(self.sign('retired', 'retiredsecret'))
+        self.assertEqual(token['user_id'], self.user.id)
+
+    def test_token_without_key_id_verifies_with_legacy_key(self):
+        with patch.dict(token_backend.signing_keys, {'k0': 'legacysecret'}):
+            token = AccessToken(self.sign(None, 'legacysecret'))
+        self.assertEqual(token['user_id'], self.user.id)
+
+    def test_unknown_key_is_rejected(self):
+        with self.assertRaises(TokenError):
+            AccessToken(self.sign('unknown', 'unknownsecret'))
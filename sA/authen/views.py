@@ -1,12 +1,12 @@
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from users.models import User
-from rest_framework_simplejwt.tokens import RefreshToken
+from sA.tokens import RefreshToken
 from rest_framework import status, generics
 from .serializers import UserCreateSerializer
 from rest_framework.permissions import AllowAny
 from sA.permissions import ProvidesValidRootPassword
-from rest_framework_simplejwt.tokens import AccessToken
+from sA.tokens import AccessToken
 
 
 class SignUpView(generics.CreateAPIView):
@@ -3,6 +3,9 @@ from rest_framework.test import APITestCase
 from rest_framework import status
 from users.models import User
 from .models import FriendRequest
+from unittest.mock import patch
+from django.test import override_settings
+import json
 
 
 class UserSearchViewTest(APITestCase):
@@ -66,4 +69,34 @@ class OpenFriendRequestViewTest(APITestCase):
     def test_send_friend_request_missing_param(self):
         response = self.client.post(self.url)
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
-        self.assertEqual(FriendRequest.objects.count(), 0)
\ No newline at end of file
+        self.assertEqual(FriendRequest.objects.count(), 0)
+
+
+@override_settings(USER_EVENTS_REDIS_URL='redis://user-events')
+class ResolveFriendRequestViewTest(APITestCase):
+    def setUp(self):
+        self.sender = User.objects.create(username="sender")
+        self.receiver = User.objects.create(username="receiver")
+        self.friend_request = FriendRequest.objects.create(sender=self.sender, receiver=self.receiver)
+
+        self.client.force_authenticate(user=self.receiver)
+
+        self.url = reverse('friend-request-resolve')
+
+    @patch('users.events.send')
+    def test_accept_publishes_friends_change(self, mock_send):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(f'{self.url}?id={self.friend_request.id}&accepted=1')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn(self.receiver, self.sender.friends.all())
+
+        changed_ids = {json.loads(call.args[0])['user_id'] for call in mock_send.call_args_list}
+        self.assertEqual(changed_ids, {self.sender.id, self.receiver.id})
+
+    @patch('users.events.send')
+    def test_reject_publishes_nothing(self, mock_send):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(f'{self.url}?id={self.friend_request.id}&accepted=0')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        mock_send.assert_not_called()
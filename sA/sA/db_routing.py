@@ -1,51 +1,230 @@
+import os
+import copy
 import time
+import socket
+import random
 import logging
-from django.db import connections, OperationalError
+import threading
+from collections import Counter, defaultdict
+from contextvars import ContextVar
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import connections, OperationalError, InterfaceError
+from django.db.utils import load_backend
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from .db_topology import TopologyStore
 
 logger = logging.getLogger(__name__)
 
+
+class RoutingContext:
+    """
+    Per-request routing state, set up by sA.middleware.ReadYourWritesMiddleware.
+    """
+    def __init__(self, user_id=None, sticky=False, sticky_lsn=None):
+        self.user_id = user_id
+        self.sticky = sticky                # The user wrote recently, so replicas may lag behind them
+        self.sticky_lsn = sticky_lsn        # Primary WAL position right after that write, if known
+        self.wrote = False                  # This request has written to the primary
+        self.written_user_ids = set()       # Users whose rows were touched by those writes
+
+
+routing_context = ContextVar('routing_context', default=None)
+
+
+def lsn_to_int(lsn):
+    """
+    Converts a pg_lsn string such as '16/B374D848' to a comparable integer.
+    """
+    high, low = lsn.split('/')
+    return (int(high, 16) << 32) + int(low, 16)
+
+
+def get_router():
+    """
+    Returns the PostgreSQLRouter instance Django routes queries through, if any.
+    """
+    from django.db import router as db_router
+
+    for router in db_router.routers:
+        if isinstance(router, PostgreSQLRouter):
+            return router
+    return None
+
+
 class PostgreSQLRouter:
+    LATENCY_EWMA_ALPHA = 0.2                            # Weight of the newest sample in the latency average
+    DEFAULT_LATENCY_S = 0.001                           # Assumed latency of a replica without samples yet
+
     def __init__(self):
-        self.replica_list = ['replica1', 'replica2']
-        self.write_db = 'default'                       # Initially, the master is the default DB
-        self.read_db_index = 0                          # Initially, route reads to replica1
+        # Held while the layout changes, so two threads seeing the same failure fail over once
+        self.topology_lock = threading.RLock()
+        self.reset_topology()
+
+        # alias -> (is_healthy, checked_at), kept fresh by the background probers
+        self.health_state = {}
+        # alias -> consecutive failed health checks. Unlike health_state, failed queries
+        # don't count here, and only this can fail a master over.
+        self.failed_probes = Counter()
+        self.health_lock = threading.Lock()
+        # alias -> last WAL position replayed by that replica, as seen by the prober
+        self.replay_lsn = {}
+        self.health_ttl = getattr(settings, 'DB_HEALTH_CHECK_TTL_S', 5)
+        self.master_failed_probes = getattr(settings, 'DB_MASTER_FAILED_PROBES', 3)
+        self.probe_interval = getattr(settings, 'DB_HEALTH_PROBE_INTERVAL_S', 1)
+        self.probe_timeout = getattr(settings, 'DB_HEALTH_PROBE_TIMEOUT_S', 2)
+        # alias -> the prober's own unpooled connection
+        self.probe_connections = {}
+
+        # alias -> moving average of query latency (s) / number of queries in flight
+        self.latency = {}
+        self.outstanding = Counter()
+        self.stats_lock = threading.Lock()
+
+        # Router decisions, e.g. counters['reads']['replica1']
+        self.counters = defaultdict(Counter)
+
+        # The layout is shared with every other sA worker, so they all fail over together
+        self.topology_store = None
+        if getattr(settings, 'DB_TOPOLOGY_REDIS_URL', None):
+            self.topology_store = TopologyStore(settings.DB_TOPOLOGY_REDIS_URL)
+            self.topology_store.start_listening(self.apply_topology, self.reset_shared_topology, self.restore_shared_topology)
+
+        # Every query is timed, and failures seen on real queries mark the alias as unhealthy right away
+        connection_created.connect(self.install_query_observer, weak=False, dispatch_uid='pg_router_query_observer')
+
+        # Remember whose data each request has written, so their next reads see it
+        for signal in (post_save, post_delete, m2m_changed):
+            signal.connect(self.track_written_instance, weak=False, dispatch_uid='pg_router_track_writes')
+
+        self.start_health_prober()
+
+    def count(self, name, db_alias):
+        with self.stats_lock:
+            self.counters[name][db_alias] += 1
 
     def db_for_read(self, model, **hints):
         """
-        Routes read queries to the replicas, retrying if the connection fails.
+        Spreads read queries over the healthy replicas, ejecting the ones that fail.
+        Users that have just written are kept on data at least as new as their writes.
         """
-        for _ in range(len(self.replica_list)):
-            try:
-                read_db = self.replica_list[self.read_db_index]
-                if self.is_connection_healthy_no_reconnect(read_db):
-                    return read_db
-                else:
-                    raise OperationalError(f"Replica {read_db} is unavailable.")
-            except OperationalError as e:
-                logger.error(f"Error reading from replica {read_db}: {e}")
-                self.handle_db_failure('replica')
-            except Exception as e:
-                logger.error(f"Error reading from replica {read_db}: {e}")
+        context = routing_context.get()
+        if context is not None and (context.wrote or context.sticky):
+            return self.db_for_sticky_read(context)
+
+        for replica in list(self.replica_list):
+            if not self.is_healthy(replica):
+                logger.error(f"Error reading from replica {replica}: Replica {replica} is unavailable.")
+                self.handle_db_failure('replica', replica)
+
+        read_db = self.pick_replica(self.replica_list)
+        if read_db is not None:
+            self.count('reads', read_db)
+            return read_db
 
         logger.critical("No replicas are available for reading. Falling back to master.")
+        self.count('reads', self.write_db)
+        self.count('fallback_reads', self.write_db)
         return self.write_db
 
     def db_for_write(self, model, **hints):
         """
-        Routes write queries to the master, retrying if the connection fails.
+        Routes write queries to the master, promoting replicas if the master fails.
         """
-        while True:
-            try:
-                if self.is_connection_healthy_no_reconnect(self.write_db):
-                    print(f"Writing to {self.write_db}")
-                    return self.write_db
-                else:
-                    raise OperationalError(f"Master {self.write_db} is unavailable.")
-            except OperationalError as e:
-                logger.error(f"Error writing to master {self.write_db}: {e}")
-                self.handle_db_failure('master')
-            except Exception as e:
-                logger.error(f"Error writing to master {self.write_db}: {e}")
+        context = routing_context.get()
+        if context is not None:
+            context.wrote = True
+
+        for _ in range(len(self.replica_list) + 1):
+            write_db = self.write_db
+            if not self.is_master_down(write_db):
+                print(f"Writing to {write_db}")
+                self.count('writes', write_db)
+                return write_db
+
+            logger.error(f"Error writing to master {write_db}: its health check failed {self.failed_probes[write_db]} times in a row.")
+            self.handle_db_failure('master', write_db)
+
+        logger.critical(f"No healthy database is available for writing. Routing to {self.write_db} anyway.")
+        return self.write_db
+
+    def db_for_sticky_read(self, context):
+        """
+        Reads of a user with recent writes go to a replica that has already replayed
+        past the WAL position of those writes, or to the master if there is none.
+        """
+        if not context.wrote and context.sticky_lsn is not None:
+            caught_up = [
+                replica for replica in self.replica_list
+                if self.is_healthy(replica) and self.replay_lsn.get(replica, -1) >= context.sticky_lsn
+            ]
+            read_db = self.pick_replica(caught_up)
+            if read_db is not None:
+                self.count('sticky_reads', read_db)
+                return read_db
+
+        self.count('sticky_reads', self.write_db)
+        return self.write_db
+
+    def pick_replica(self, replicas):
+        """
+        Picks a replica at random, weighted towards the ones with the lowest measured
+        latency and the fewest queries in flight.
+        """
+        if not replicas:
+            return None
+        if len(replicas) == 1:
+            return replicas[0]
+
+        weights = [
+            1 / (self.latency.get(replica, self.DEFAULT_LATENCY_S) * (self.outstanding[replica] + 1))
+            for replica in replicas
+        ]
+        return random.choices(replicas, weights=weights)[0]
+
+    def track_written_instance(self, sender, instance, **kwargs):
+        context = routing_context.get()
+        if context is not None:
+            context.written_user_ids |= self.get_written_user_ids(instance, kwargs.get('model'), kwargs.get('pk_set'))
+
+    def get_written_user_ids(self, instance, related_model=None, related_pks=None):
+        """
+        Collects the ids of the users a written row belongs to (the user itself, any
+        user it references, or users added to / removed from one of its relations).
+        """
+        user_ids = set()
+        user_model = get_user_model()
+
+        if isinstance(instance, user_model) and instance.pk is not None:
+            user_ids.add(instance.pk)
+
+        if related_model is user_model and related_pks:
+            user_ids |= set(related_pks)
+
+        for field in instance._meta.concrete_fields:
+            if field.is_relation and field.related_model is user_model:
+                user_id = getattr(instance, field.attname)
+                if user_id is not None:
+                    user_ids.add(user_id)
+
+        return user_ids
+
+    def get_current_write_lsn(self):
+        """
+        Returns the current WAL position of the master, or None if it can't be told.
+        """
+        connection = connections[self.write_db]
+        if connection.vendor != 'postgresql':
+            return None
+
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT pg_current_wal_lsn()")
+                return lsn_to_int(cursor.fetchone()[0])
+        except Exception as e:
+            logger.error(f"Could not read the WAL position of {self.write_db}: {e}")
+            return None
 
     def allow_migrate(self, db, app_label, model_name=None, **hints):
         """
@@ -53,50 +232,418 @@ class PostgreSQLRouter:
         """
         return db == self.write_db
 
-    def handle_db_failure(self, db_type):
+    def handle_db_failure(self, db_type, db_alias=None):
         """
         Handles database failure by reconfiguring the database routing.
-        - For a master failure: promote the first replica to master, route reads to the next replica.
-        - For a replica failure: remove it from the replica list and route reads to the next available replica.
+        - For a master failure: promote the first replica to master, route reads to the remaining replicas.
+        - For a replica failure: eject it from the replica list until the prober sees it healthy again.
         """
-        if db_type == 'master':
-            self.promote_replica_to_master()
-        elif db_type == 'replica':
-            self.remove_failed_replica()
+        with self.topology_lock:
+            if db_type == 'master':
+                # Another thread may have failed this master over already
+                if db_alias in (None, self.write_db):
+                    self.promote_replica_to_master()
+            elif db_type == 'replica':
+                self.remove_failed_replica(db_alias)
 
     def promote_replica_to_master(self):
         """
-        Promote the first replica in the list to be the new master and reroute reads to the second replica.
+        Promote the first replica in the list to be the new master, the remaining ones keep serving reads.
+        The old master is kept aside, it may only serve again once rebuilt as a standby of the new one.
         """
         if self.replica_list:
             # Promote the first replica
             new_master = self.replica_list.pop(0)
+            old_master = self.write_db
             self.write_db = new_master
-            self.read_db_index = 0  # Route reads to the next available replica
+            if old_master not in self.demoted_masters:
+                self.demoted_masters.append(old_master)
+            failed_probes = self.failed_probes[old_master]
+            self.count('promotions', new_master)
             logger.info(f"Master DB failed. Promoting {self.write_db} to be the new master.")
+            logger.critical(
+                f"Master {old_master} was demoted and needs manual repair: it is only re-admitted, "
+                f"as a replica, once it has been rebuilt as a standby of {new_master}."
+            )
+            self.share_topology(f"master {old_master} failed {failed_probes} health checks in a row")
         else:
             logger.critical("No replicas are available to promote as the new master.")
 
-    def remove_failed_replica(self):
+    def remove_failed_replica(self, failed_replica):
         """
-        Remove the failed replica from the list and reroute reads to the next available replica.
+        Eject the failed replica from the list, reads go to the remaining replicas.
         """
-        if self.replica_list:
-            failed_replica = self.replica_list.pop(self.read_db_index)
-            logger.info(f"Replica {failed_replica} removed from the replica list.")
-            if self.replica_list:
-                self.read_db_index %= len(self.replica_list)  # Adjust index to avoid out-of-bounds
-            else:
+        if failed_replica in self.replica_list:
+            self.replica_list.remove(failed_replica)
+            self.ejected_replicas.append(failed_replica)
+            self.count('ejections', failed_replica)
+            logger.info(f"Replica {failed_replica} ejected from the replica list.")
+            if not self.replica_list:
                 logger.warning("No replicas available for reading.")
+            self.share_topology(f"replica {failed_replica} is unhealthy")
         else:
             logger.critical("No replicas left to handle.")
 
-    def is_connection_healthy_no_reconnect(self, db_alias):
+    def readmit_replica(self, replica):
+        """
+        Put an ejected replica that is healthy again back into the replica list.
+        """
+        with self.topology_lock:
+            if replica not in self.ejected_replicas:
+                return
+
+            self.ejected_replicas.remove(replica)
+            self.replica_list.append(replica)
+            self.latency.pop(replica, None)  # Old samples would hold the replica back
+            self.count('readmissions', replica)
+            logger.info(f"Replica {replica} is healthy again and re-admitted to the replica list.")
+            self.share_topology(f"replica {replica} is healthy again")
+
+    def readmit_demoted_master(self, db_alias, in_recovery):
+        """
+        Put a demoted master back as a replica, once it is healthy and replaying from the
+        new master. Until then it could hold writes the new master never saw.
+        """
+        with self.topology_lock:
+            if db_alias not in self.demoted_masters or not in_recovery:
+                return
+
+            self.demoted_masters.remove(db_alias)
+            self.replica_list.append(db_alias)
+            self.latency.pop(db_alias, None)
+            self.count('readmissions', db_alias)
+            logger.info(f"Demoted master {db_alias} is now a standby and re-admitted to the replica list.")
+            self.share_topology(f"demoted master {db_alias} is a standby now")
+
+    def get_topology(self):
+        return {
+            'write_db': self.write_db,
+            'replicas': list(self.replica_list),
+            'ejected_replicas': list(self.ejected_replicas),
+            'demoted_masters': list(self.demoted_masters),
+        }
+
+    def reset_topology(self):
+        """
+        Back to the configured layout.
+        """
+        self.replica_list = ['replica1', 'replica2']
+        self.write_db = 'default'                       # Initially, the master is the default DB
+        self.ejected_replicas = []                      # Failed replicas, re-admitted by the prober once healthy
+        self.demoted_masters = []                       # Failed masters, re-admitted as replicas once rebuilt as standbys
+        self.topology_version = 0
+
+    def share_topology(self, reason):
+        """
+        Publishes the local layout to the other sA workers, with why and by whom it was
+        decided and the version it was based on. If one of them has changed the layout
+        in the meantime, theirs wins and is applied here instead.
+        """
+        if self.topology_store is None:
+            return
+
+        layout = {
+            **self.get_topology(),
+            'based_on_version': self.topology_version,
+            'reason': reason,
+            'decided_by': f"{socket.gethostname()}:{os.getpid()}",
+        }
+
+        try:
+            applied, version, layout = self.topology_store.publish(self.topology_version, layout)
+        except Exception as e:
+            logger.error(f"Could not share the database topology: {e}")
+            return
+
+        if applied:
+            self.topology_version = version
+        else:
+            self.apply_topology(version, layout)
+
+    def restore_shared_topology(self):
+        """
+        Called when there is no shared layout although nobody reset it (e.g. Redis lost
+        its data). A worker that has failed over publishes its layout again, so workers
+        started afterwards don't come up writing to the demoted master.
+        """
+        with self.topology_lock:
+            if self.topology_version > 0:
+                logger.warning(f"The shared database topology is missing, publishing v{self.topology_version} again.")
+                self.share_topology("the shared topology was missing")
+
+    def reset_shared_topology(self):
+        """
+        Back to the configured layout, after an operator reset the shared one with the
+        reset_db_topology command.
+        """
+        with self.topology_lock:
+            self.reset_topology()
+            self.count('topology_resets', self.write_db)
+            logger.warning("The shared database topology was reset, back to the configured layout.")
+
+    def apply_topology(self, version, layout):
+        """
+        Adopts a layout published by another sA worker, unless it is older than ours.
+        """
+        with self.topology_lock:
+            self.apply_topology_locked(version, layout)
+
+    def apply_topology_locked(self, version, layout):
+        # Only reset_shared_topology() may go back to the configured layout
+        if layout is None or version <= self.topology_version:
+            return
+
+        aliases = [layout['write_db'], *layout['replicas'], *layout['ejected_replicas'], *layout.get('demoted_masters', [])]
+        if any(db_alias not in settings.DATABASES for db_alias in aliases):
+            logger.error(f"Ignoring database topology v{version} with unknown aliases: {layout}")
+            return
+
+        self.topology_version = version
+        self.write_db = layout['write_db']
+        self.replica_list = list(layout['replicas'])
+        self.ejected_replicas = list(layout['ejected_replicas'])
+        self.demoted_masters = list(layout.get('demoted_masters', []))
+        self.count('topology_updates', self.write_db)
+        logger.info(
+            f"Applied database topology v{version} (based on v{layout.get('based_on_version')}, "
+            f"decided by {layout.get('decided_by')} as {layout.get('reason')}): {layout}"
+        )
+
+    def get_stats(self):
+        return {
+            'topology_version': self.topology_version,
+            'write_db': self.write_db,
+            'replicas': list(self.replica_list),
+            'ejected_replicas': list(self.ejected_replicas),
+            'demoted_masters': list(self.demoted_masters),
+            'pools': self.get_pool_stats(),
+            **self.get_health_stats(),
+        }
+
+    def get_health_stats(self):
+        with self.health_lock:
+            health = {
+                'failed_probes': dict(self.failed_probes),
+                'healthy': {db_alias: state[0] for db_alias, state in self.health_state.items()},
+            }
+
+        with self.stats_lock:
+            return {
+                **health,
+                'latency_ms': {db_alias: round(latency * 1000, 3) for db_alias, latency in self.latency.items()},
+                'outstanding': dict(self.outstanding),
+                'counters': {name: dict(counter) for name, counter in self.counters.items()},
+            }
+
+    def is_healthy(self, db_alias):
+        """
+        Returns the cached health of an alias. The database is only queried here when
+        the cached state is missing or older than the TTL (e.g. the prober has stalled).
+        """
+        state = self.health_state.get(db_alias)
+        if state is None or time.monotonic() - state[1] > self.health_ttl:
+            return self.refresh_health(db_alias)
+
+        return state[0]
+
+    def is_master_down(self, master):
+        """
+        Whether the master's own health check has failed DB_MASTER_FAILED_PROBES times in a
+        row. A failed query is not enough, it may have failed for reasons of its own while
+        the master is fine, and neither is a single blip.
+        """
+        state = self.health_state.get(master)
+        if state is None or time.monotonic() - state[1] > self.health_ttl:
+            self.refresh_health(master)
+
+        return self.failed_probes[master] >= self.master_failed_probes
+
+    def refresh_health(self, db_alias, connection=None):
+        healthy = self.is_connection_healthy_no_reconnect(db_alias, connection)
+
+        with self.health_lock:
+            self.health_state[db_alias] = (healthy, time.monotonic())
+            if healthy:
+                self.failed_probes.pop(db_alias, None)
+            else:
+                self.failed_probes[db_alias] += 1
+
+        return healthy
+
+    def mark_unhealthy(self, db_alias):
+        with self.health_lock:
+            was_healthy = self.health_state.get(db_alias, (True,))[0]
+            self.health_state[db_alias] = (False, time.monotonic())
+
+        if was_healthy:
+            logger.warning(f"Lost the connection to {db_alias}. Marking it as unhealthy.")
+
+    def start_health_prober(self):
+        if self.probe_interval <= 0:
+            return  # Health is then only refreshed on the routing path, once per TTL
+
+        if self.probe_timeout + self.probe_interval >= self.health_ttl:
+            logger.warning(
+                f"DB_HEALTH_PROBE_TIMEOUT_S + DB_HEALTH_PROBE_INTERVAL_S should stay below DB_HEALTH_CHECK_TTL_S, "
+                f"or requests will run health checks themselves whenever a database is down."
+            )
+
+        # One prober per alias, so a server that doesn't answer delays nobody else's checks
+        for db_alias in settings.DATABASES:
+            prober = threading.Thread(target=self.probe_forever, args=(db_alias,), name=f'db-health-prober-{db_alias}', daemon=True)
+            prober.start()
+
+    def probe_forever(self, db_alias):
+        """
+        Refreshes the health of an alias in the background, so routing decisions never
+        have to wait for a health check.
+        """
+        while True:
+            try:
+                self.probe(db_alias)
+            except Exception as e:
+                logger.error(f"Health probe of {db_alias} failed: {e}")
+
+            time.sleep(self.probe_interval)
+
+    def probe(self, db_alias):
+        connection = self.get_probe_connection(db_alias)
+        if self.refresh_health(db_alias, connection):
+            in_recovery = self.refresh_replay_lsn(db_alias, connection)
+            if db_alias in self.ejected_replicas:
+                self.readmit_replica(db_alias)
+            elif db_alias in self.demoted_masters:
+                self.readmit_demoted_master(db_alias, in_recovery)
+        else:
+            # Drop the broken connection so the next probe opens a fresh one
+            connection.close()
+
+        # Also catches aliases marked unhealthy by failed queries in between
+        if not self.health_state[db_alias][0]:
+            self.drain_pool(db_alias)
+
+    def get_probe_connection(self, db_alias):
+        """
+        The prober keeps its own unpooled connection per alias, so health checks neither
+        take pool slots nor wait on a pool that keeps trying to reach a dead server.
+        """
+        connection = self.probe_connections.get(db_alias)
+        if connection is None:
+            settings_dict = copy.deepcopy(connections.settings[db_alias])
+            settings_dict['OPTIONS'].pop('pool', None)
+            settings_dict['OPTIONS']['connect_timeout'] = self.probe_timeout
+
+            backend = load_backend(settings_dict['ENGINE'])
+            connection = backend.DatabaseWrapper(settings_dict, db_alias)
+            connection.is_health_probe = True
+            self.probe_connections[db_alias] = connection
+
+        return connection
+
+    def get_pool(self, db_alias):
+        """
+        Returns the connection pool of an alias if one has been opened, without creating it.
+        """
+        return getattr(connections[db_alias], '_connection_pools', {}).get(db_alias)
+
+    def drain_pool(self, db_alias):
+        """
+        Closes the pool of a failed alias, together with every connection it holds. The
+        next query routed to the alias opens a fresh pool.
+        """
+        if self.get_pool(db_alias) is None:
+            return
+
+        connections[db_alias].close_pool()
+        self.count('pool_drains', db_alias)
+        logger.warning(f"Drained the connection pool of {db_alias}.")
+
+    def get_pool_stats(self):
+        """
+        Pool usage per alias, including how long requests waited for a connection.
+        """
+        pool_stats = {}
+        for db_alias in settings.DATABASES:
+            pool = self.get_pool(db_alias)
+            if pool is not None:
+                pool_stats[db_alias] = pool.get_stats()
+
+        return pool_stats
+
+    def refresh_replay_lsn(self, db_alias, connection):
+        """
+        Records how far a standby has replayed. Returns whether the server is in recovery.
+        """
+        if connection.vendor != 'postgresql':
+            return False
+
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_last_wal_replay_lsn()")
+            lsn = cursor.fetchone()[0]
+
+        # NULL on a server that is not in recovery, i.e. on the master
+        if lsn is None:
+            return False
+
+        self.replay_lsn[db_alias] = lsn_to_int(lsn)
+        return True
+
+    def install_query_observer(self, sender, connection, **kwargs):
+        # Probes would make the latency of the prober, not of real traffic, weigh the replicas
+        if getattr(connection, 'is_health_probe', False):
+            return
+
+        if self.observe_query not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self.observe_query)
+
+    def observe_query(self, execute, sql, params, many, context):
+        db_alias = context['connection'].alias
+
+        with self.stats_lock:
+            self.outstanding[db_alias] += 1
+        started_at = time.monotonic()
+
+        try:
+            return execute(sql, params, many, context)
+        except InterfaceError:
+            self.mark_unhealthy(db_alias)
+            raise
+        except OperationalError:
+            # Deadlocks, timeouts, recovery conflicts... leave the connection usable
+            if self.is_connection_lost(context['connection']):
+                self.mark_unhealthy(db_alias)
+            raise
+        finally:
+            elapsed = time.monotonic() - started_at
+            with self.stats_lock:
+                self.outstanding[db_alias] -= 1
+                previous = self.latency.get(db_alias)
+                if previous is None:
+                    self.latency[db_alias] = elapsed
+                else:
+                    self.latency[db_alias] = previous + self.LATENCY_EWMA_ALPHA * (elapsed - previous)
+
+    def is_connection_lost(self, connection):
+        """
+        Whether a query failed because the connection to the server is gone.
+        """
+        raw_connection = connection.connection
+        if raw_connection is None or getattr(raw_connection, 'closed', False) or getattr(raw_connection, 'broken', False):
+            return True
+
+        # Every query fails inside an aborted transaction, so only the flags above can tell
+        if connection.in_atomic_block:
+            return False
+
+        return not connection.is_usable()
+
+    def is_connection_healthy_no_reconnect(self, db_alias, connection=None):
         """
         Check if the database connection is healthy without reconnecting.
         """
         try:
-            connection = connections[db_alias]
+            if connection is None:
+                connection = connections[db_alias]
             cursor = connection.cursor()
             cursor.execute("SELECT 1")
             cursor.close()
@@ -0,0 +1,107 @@
+import json
+import time
+import logging
+import threading
+import redis
+
+logger = logging.getLogger(__name__)
+
+
+# Replaces the layout only if nobody has changed it since `expected_version`,
+# and announces the new version to every subscribed sA worker. If the layout is
+# gone (e.g. Redis lost its data), whoever publishes first restores theirs, numbered
+# after the version they had so no worker takes it for an old one.
+PUBLISH_SCRIPT = """
+local current = tonumber(redis.call('HGET', KEYS[1], 'version') or '0')
+local expected = tonumber(ARGV[1])
+if current ~= 0 and current ~= expected then
+    return {0, current, redis.call('HGET', KEYS[1], 'layout')}
+end
+
+local version = math.max(current, expected) + 1
+redis.call('HSET', KEYS[1], 'version', version, 'layout', ARGV[2])
+redis.call('PUBLISH', ARGV[3], '{"version": ' .. version .. ', "layout": ' .. ARGV[2] .. '}')
+return {1, version, ARGV[2]}
+"""
+
+
+class TopologyStore:
+    """
+    Keeps the master/replica layout chosen by PostgreSQLRouter in Redis, so that every
+    worker of every sA instance routes to the same master and replicas. The layout never
+    expires, a promoted master must not silently turn back into the configured one: it is
+    only dropped by an explicit reset, see the reset_db_topology command.
+    """
+    KEY = 'sA:db_topology'
+    CHANNEL = 'sA:db_topology_changes'
+
+    def __init__(self, url):
+        self.url = url
+        self.redis = redis.Redis.from_url(url, socket_timeout=0.5, socket_connect_timeout=0.5)
+        self.publish_script = self.redis.register_script(PUBLISH_SCRIPT)
+
+    def load(self):
+        """
+        Returns the shared (version, layout), version 0 meaning nothing has been shared yet.
+        """
+        version, layout = self.redis.hmget(self.KEY, 'version', 'layout')
+        if version is None:
+            return 0, None
+
+        return int(version), json.loads(layout)
+
+    def publish(self, expected_version, layout):
+        """
+        Shares a new layout based on `expected_version`. Returns (applied, version, layout),
+        where a rejected update comes back with the layout that won instead.
+        """
+        applied, version, shared_layout = self.publish_script(
+            keys=[self.KEY],
+            args=[expected_version, json.dumps(layout), self.CHANNEL]
+        )
+
+        return bool(applied), int(version), json.loads(shared_layout)
+
+    def reset(self):
+        """
+        Forgets the shared layout and tells every sA worker to go back to the configured one.
+        """
+        pipe = self.redis.pipeline()
+        pipe.delete(self.KEY)
+        pipe.publish(self.CHANNEL, json.dumps({'version': 0, 'layout': None, 'reset': True}))
+        pipe.execute()
+
+    def start_listening(self, on_change, on_reset, on_missing):
+        listener = threading.Thread(
+            target=self.listen_forever, args=(on_change, on_reset, on_missing), name='db-topology-listener', daemon=True
+        )
+        listener.start()
+
+    def listen_forever(self, on_change, on_reset, on_missing):
+        """
+        Calls on_change(version, layout) for the current layout and for every change
+        published afterwards, re-reading the layout after each reconnect. on_reset() is
+        called for an explicit reset, on_missing() when there is no shared layout.
+        """
+        while True:
+            try:
+                client = redis.Redis.from_url(self.url, socket_connect_timeout=0.5, health_check_interval=30)
+                pubsub = client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.CHANNEL)
+
+                # Subscribing first means no change can slip in between the two
+                version, layout = self.load()
+                if layout is not None:
+                    on_change(version, layout)
+                else:
+                    on_missing()
+
+                for message in pubsub.listen():
+                    change = json.loads(message['data'])
+                    if change.get('reset'):
+                        on_reset()
+                    else:
+                        on_change(change['version'], change['layout'])
+            except Exception as e:
+                logger.error(f"Lost the database topology feed: {e}")
+                time.sleep(1)
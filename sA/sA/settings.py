@@ -62,6 +62,7 @@ MIDDLEWARE = [
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'sA.middleware.LogstashMiddleware',
+    'sA.middleware.ReadYourWritesMiddleware',
 ]
 
 ROOT_URLCONF = 'sA.urls'
@@ -90,6 +91,18 @@ WSGI_APPLICATION = 'sA.wsgi.application'
 
 import dj_database_url
 
+# Every worker keeps a pool of connections per alias. Checked out connections are
+# health-checked first and idle ones above min_size are closed after max_idle seconds.
+DB_OPTIONS = {
+    'connect_timeout': int(os.getenv('DB_CONNECT_TIMEOUT_S', 2)),
+    'pool': {
+        'min_size': int(os.getenv('DB_POOL_MIN_SIZE', 1)),
+        'max_size': int(os.getenv('DB_POOL_MAX_SIZE', 4)),
+        'timeout': float(os.getenv('DB_POOL_TIMEOUT_S', 2)),       # Longest wait for a free connection
+        'max_idle': float(os.getenv('DB_POOL_MAX_IDLE_S', 300)),
+    },
+}
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.postgresql',
@@ -98,6 +111,8 @@ DATABASES = {
         'PASSWORD': 'apass',
         'HOST': 'pg-1',
         'PORT': '5432',
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': DB_OPTIONS,
     },
     'replica1': {
         'ENGINE': 'django.db.backends.postgresql',
@@ -106,6 +121,8 @@ DATABASES = {
         'PASSWORD': 'apass',
         'HOST': 'pg-2',
         'PORT': '5432',
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': DB_OPTIONS,
     },
     'replica2': {
         'ENGINE': 'django.db.backends.postgresql',
@@ -114,11 +131,55 @@ DATABASES = {
         'PASSWORD': 'apass',
         'HOST': 'pg-3',
         'PORT': '5432',
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': DB_OPTIONS,
     },
 }
 
 DATABASE_ROUTERS = ['sA.db_routing.PostgreSQLRouter']
 
+# The router caches the health of every alias and refreshes it in the background
+DB_HEALTH_CHECK_TTL_S = float(os.getenv('DB_HEALTH_CHECK_TTL_S', 5))
+DB_HEALTH_PROBE_INTERVAL_S = float(os.getenv('DB_HEALTH_PROBE_INTERVAL_S', 1))
+# Connect timeout of the probes, with the interval it must stay below the TTL (libpq waits 2s at least)
+DB_HEALTH_PROBE_TIMEOUT_S = int(os.getenv('DB_HEALTH_PROBE_TIMEOUT_S', 2))
+
+# The master is only failed over once this many health checks in a row have failed
+DB_MASTER_FAILED_PROBES = int(os.getenv('DB_MASTER_FAILED_PROBES', 3))
+
+# After a write, the reads of the affected users avoid lagging replicas for this long
+DB_READ_YOUR_WRITES_WINDOW_S = float(os.getenv('DB_READ_YOUR_WRITES_WINDOW_S', 5))
+
+
+# Cache
+# https://docs.djangoproject.com/en/5.1/topics/cache/
+
+REDIS_URL = os.getenv('REDIS_URL', 'redis://sm-redis:6379')
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': REDIS_URL,
+        'KEY_PREFIX': 'sA',
+    },
+}
+
+# Profiles served by validate-token are cached per user, deleted users are remembered
+# for as long as their refresh tokens live
+USER_SNAPSHOT_TTL_S = int(os.getenv('USER_SNAPSHOT_TTL_S', 3600))
+USER_TOMBSTONE_TTL_S = int(os.getenv('USER_TOMBSTONE_TTL_S', 24 * 3600))
+
+# Most ids/tokens a single bulk lookup may ask for
+BULK_LOOKUP_MAX_ITEMS = int(os.getenv('BULK_LOOKUP_MAX_ITEMS', 100))
+
+# Changes to users are published here, so services caching user data can evict it
+USER_EVENTS_REDIS_URL = os.getenv('USER_EVENTS_REDIS_URL', REDIS_URL)
+USER_EVENTS_CHANNEL = os.getenv('USER_EVENTS_CHANNEL', 'sA:user_events')
+
+# The master/replica layout chosen by the router is shared by all sA workers through Redis,
+# until it is reset with manage.py reset_db_topology
+DB_TOPOLOGY_REDIS_URL = os.getenv('DB_TOPOLOGY_REDIS_URL', REDIS_URL)
+
 import sys
 
 if 'test' in sys.argv:
@@ -126,6 +187,20 @@ if 'test' in sys.argv:
         default=os.getenv('TEST_DATABASE_URL', 'sqlite://:memory:')
     )
 
+    # Probing from another thread would hit the test transaction's locks
+    DB_HEALTH_PROBE_INTERVAL_S = 0
+
+    # The replicas are unreachable in tests, a pool would keep trying to connect to them
+    for replica in ('replica1', 'replica2'):
+        DATABASES[replica]['OPTIONS'] = {'connect_timeout': DB_OPTIONS['connect_timeout']}
+
+    CACHES['default'] = {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+
+    DB_TOPOLOGY_REDIS_URL = None
+    USER_EVENTS_REDIS_URL = None
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
@@ -182,11 +257,20 @@ REST_FRAMEWORK = {
 
 from datetime import timedelta
 
+# Keys as comma separated "<kid>:<secret>" pairs. The first one signs new tokens, the
+# others only verify, so a replaced key should stay listed until its tokens expire.
+# sB verifies tokens locally with the same list, so it must not be the SECRET_KEY:
+# the default only keeps setups that predate the list working.
+JWT_SIGNING_KEYS = dict(
+    entry.split(':', 1) for entry in os.getenv('JWT_SIGNING_KEYS', f'k0:{SECRET_KEY}').split(',')
+)
+
 SIMPLE_JWT = {
     'ACCESS_TOKEN_LIFETIME': timedelta(minutes=60),
     'REFRESH_TOKEN_LIFETIME': timedelta(days=1),
     'ROTATE_REFRESH_TOKENS': False,
     'BLACKLIST_AFTER_ROTATION': True,
     'ALGORITHM': 'HS256',
-    'SIGNING_KEY': SECRET_KEY,
+    'SIGNING_KEY': next(iter(JWT_SIGNING_KEYS.values())),
+    'AUTH_TOKEN_CLASSES': ('sA.tokens.AccessToken',),
 }
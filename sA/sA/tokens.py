@@ -0,0 +1,92 @@
+import jwt
+from django.conf import settings
+from rest_framework_simplejwt.backends import TokenBackend
+from rest_framework_simplejwt.exceptions import TokenBackendError
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import AccessToken as BaseAccessToken, RefreshToken as BaseRefreshToken
+
+
+# Key id of the key tokens were signed with before they named one, i.e. the SECRET_KEY
+LEGACY_KID = 'k0'
+
+
+class KeyRotatingTokenBackend(TokenBackend):
+    """
+    Signs tokens with the first key of JWT_SIGNING_KEYS and names it in the `kid` header.
+    Tokens are verified with whichever listed key they name, so a retired key keeps
+    working for as long as it stays listed.
+    """
+
+    def __init__(self, signing_keys):
+        self.signing_keys = signing_keys
+        self.current_kid = next(iter(signing_keys))
+
+        super().__init__(
+            api_settings.ALGORITHM,
+            signing_keys[self.current_kid],
+            audience=api_settings.AUDIENCE,
+            issuer=api_settings.ISSUER,
+            leeway=api_settings.LEEWAY,
+        )
+
+    def encode(self, payload):
+        jwt_payload = payload.copy()
+        if self.audience is not None:
+            jwt_payload['aud'] = self.audience
+        if self.issuer is not None:
+            jwt_payload['iss'] = self.issuer
+
+        return jwt.encode(
+            jwt_payload,
+            self.signing_key,
+            algorithm=self.algorithm,
+            headers={'kid': self.current_kid},
+            json_encoder=self.json_encoder,
+        )
+
+    def get_verifying_key(self, token):
+        try:
+            kid = jwt.get_unverified_header(token).get('kid')
+        except jwt.InvalidTokenError as e:
+            raise TokenBackendError("Token is invalid or expired") from e
+
+        # Tokens issued before key ids were introduced are signed with the legacy key
+        if kid is None:
+            return self.signing_keys.get(LEGACY_KID, self.signing_key)
+
+        if kid not in self.signing_keys:
+            raise TokenBackendError("Token is signed with an unknown key")
+
+        return self.signing_keys[kid]
+
+
+token_backend = KeyRotatingTokenBackend(settings.JWT_SIGNING_KEYS)
+
+
+class ProfileClaimsMixin:
+    """
+    Copies the profile fields into the token, so consumers like sB rarely need to look the
+    user up. `profile_version` tells how current those copies are.
+    """
+
+    @classmethod
+    def for_user(cls, user):
+        token = super().for_user(user)
+
+        for field in user.PROFILE_FIELDS:
+            token[field] = getattr(user, field)
+        token['profile_version'] = user.profile_version
+
+        return token
+
+
+class AccessToken(ProfileClaimsMixin, BaseAccessToken):
+    def get_token_backend(self):
+        return token_backend
+
+
+class RefreshToken(ProfileClaimsMixin, BaseRefreshToken):
+    access_token_class = AccessToken
+
+    def get_token_backend(self):
+        return token_backend
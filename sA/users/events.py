@@ -0,0 +1,43 @@
+import json
+import logging
+import redis
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import router, transaction
+
+logger = logging.getLogger(__name__)
+
+client = None
+
+
+def get_client():
+    global client
+    if client is None:
+        client = redis.Redis.from_url(settings.USER_EVENTS_REDIS_URL, socket_timeout=0.5, socket_connect_timeout=0.5)
+    return client
+
+def events_enabled():
+    return bool(settings.USER_EVENTS_REDIS_URL)
+
+def publish_user_event(user_id, fields, version, using=None):
+    """
+    Announces that `fields` of the user changed ('deleted' when the user is gone), once
+    the transaction on `using` commits (by default the alias users are written to).
+    Subscribers evict what they cached about the user.
+    """
+    if not events_enabled():
+        return
+
+    # After a failover the master is no longer 'default', the event must wait for its transaction
+    if using is None:
+        using = router.db_for_write(get_user_model())
+
+    event = json.dumps({'user_id': user_id, 'fields': list(fields), 'version': version})
+    transaction.on_commit(lambda: send(event), using=using)
+
+def send(event):
+    # Losing an event only means the data lives until its TTL, the write itself succeeded
+    try:
+        get_client().publish(settings.USER_EVENTS_CHANNEL, event)
+    except redis.RedisError as e:
+        logger.error(f"Could not publish user event {event}: {e}")
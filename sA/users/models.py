@@ -1,4 +1,4 @@
-from django.db import models
+from django.db import models, router, transaction
 from django.contrib.auth.models import AbstractBaseUser
 
 
@@ -6,10 +6,57 @@ class User(AbstractBaseUser):
     username = models.CharField(max_length=150, unique=True)
     password = models.CharField(max_length=128)
     rating = models.IntegerField(default=1200)
+    profile_version = models.PositiveIntegerField(default=0)    # Bumped whenever a PROFILE_FIELDS value changes
 
     friends = models.ManyToManyField('self', blank=True)
 
     USERNAME_FIELD = 'username'
 
+    # Fields copied into access tokens and cached user snapshots
+    PROFILE_FIELDS = ('username', 'rating')
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance.saved_profile = instance.get_profile()
+        return instance
+
+    def get_profile(self):
+        return tuple(self.__dict__.get(field) for field in self.PROFILE_FIELDS)
+
+    def get_changed_profile_fields(self):
+        saved_profile = getattr(self, 'saved_profile', None)
+        if saved_profile is None:
+            return self.PROFILE_FIELDS
+
+        return tuple(
+            field for field, saved, current in zip(self.PROFILE_FIELDS, saved_profile, self.get_profile())
+            if saved != current
+        )
+
+    def save(self, *args, **kwargs):
+        # Kept until the next save, for the post_save handlers
+        self.changed_profile_fields = self.get_changed_profile_fields()
+
+        if self.pk is None or not self.changed_profile_fields:
+            super().save(*args, **kwargs)
+            self.saved_profile = self.get_profile()
+            return
+
+        # Bumped by the database, so concurrent updates never get the same version
+        self.profile_version = models.F('profile_version') + 1
+
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None:
+            kwargs['update_fields'] = {*update_fields, 'profile_version'}
+
+        using = kwargs.pop('using', None) or router.db_for_write(self.__class__, instance=self)
+        with transaction.atomic(using=using):
+            super().save(*args, using=using, **kwargs)
+            # Read back while the update still holds the row lock, so it is this update's version
+            self.refresh_from_db(using=using, fields=['profile_version'])
+
+        self.saved_profile = self.get_profile()
+
     def __str__(self):
         return self.username
\ No newline at end of file
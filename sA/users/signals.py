@@ -0,0 +1,48 @@
+from django.db.models.signals import post_save, post_delete, m2m_changed, pre_delete
+from django.dispatch import receiver
+from django.db import transaction
+from .models import User
+from .snapshots import store_snapshot, store_tombstone
+from .events import publish_user_event, events_enabled
+
+
+# The cached snapshots are written through once the change commits, so they never lag
+# behind the database and a rolled back change is never cached
+
+@receiver(post_save, sender=User, dispatch_uid='user_snapshot_on_save')
+def refresh_user_snapshot(sender, instance, created, using, **kwargs):
+    changed_fields = getattr(instance, 'changed_profile_fields', ())
+
+    def on_commit():
+        store_snapshot(instance)
+        if not created and changed_fields:
+            publish_user_event(instance.id, changed_fields, instance.profile_version, using)
+
+    transaction.on_commit(on_commit, using=using)
+
+@receiver(post_delete, sender=User, dispatch_uid='user_snapshot_on_delete')
+def tombstone_user_snapshot(sender, instance, using, **kwargs):
+    user_id = instance.id   # Set to None once the deletion is done
+    transaction.on_commit(lambda: store_tombstone(user_id), using=using)
+    publish_user_event(user_id, ['deleted'], instance.profile_version, using)
+
+@receiver(pre_delete, sender=User, dispatch_uid='user_friends_on_delete')
+def announce_lost_friend(sender, instance, using, **kwargs):
+    # Their friend lists lose this user without m2m_changed being sent
+    if events_enabled():
+        announce_friends_change(sender, instance, 'pre_clear', None, using)
+
+@receiver(m2m_changed, sender=User.friends.through, dispatch_uid='user_friends_on_change')
+def announce_friends_change(sender, instance, action, pk_set, using, **kwargs):
+    if action == 'pre_clear' and events_enabled():
+        # The friends being removed are only known before the clear
+        friend_ids = list(instance.friends.values_list('id', flat=True))
+    elif action in ('post_add', 'post_remove'):
+        friend_ids = list(pk_set)
+    else:
+        return
+
+    # Friendships are symmetrical, both sides' lists change. Their profiles do not,
+    # so there is no new profile version to announce.
+    for user_id in [instance.id, *friend_ids]:
+        publish_user_event(user_id, ['friends'], None, using)
@@ -0,0 +1,83 @@
+import logging
+from django.conf import settings
+from django.core.cache import cache
+from .models import User
+
+logger = logging.getLogger(__name__)
+
+
+def get_snapshot_key(user_id):
+    return f'user_snapshot_{user_id}'
+
+def make_snapshot(user):
+    snapshot = {field: getattr(user, field) for field in User.PROFILE_FIELDS}
+    snapshot.update(id=user.id, profile_version=user.profile_version)
+    return snapshot
+
+# The user is saved by the time these run, a cache outage must not fail the request
+
+def store_snapshot(user):
+    try:
+        cache.set(get_snapshot_key(user.id), make_snapshot(user), timeout=settings.USER_SNAPSHOT_TTL_S)
+    except Exception as e:
+        logger.error(f"Could not cache the snapshot of user#{user.id}: {e}")
+
+def store_tombstone(user_id):
+    # Outlives every token the user could still hold, so those keep getting rejected
+    try:
+        cache.set(get_snapshot_key(user_id), {'id': user_id, 'deleted': True}, timeout=settings.USER_TOMBSTONE_TTL_S)
+    except Exception as e:
+        logger.error(f"Could not cache the tombstone of user#{user_id}: {e}")
+
+def get_snapshot(user_id, min_version=0):
+    """
+    Returns the cached profile of a user, at least as new as `min_version`, or None if
+    the user no longer exists. Only a missing or outdated snapshot costs a query.
+    """
+    return get_snapshots({user_id: min_version})[user_id]
+
+def get_snapshots(min_versions):
+    """
+    get_snapshot() for many users at once, given as {user_id: min_version}. Returns
+    {user_id: snapshot or None}, reading the cache once and the database at most once.
+    Without the cache, every user is read from the database.
+    """
+    keys = {get_snapshot_key(user_id): user_id for user_id in min_versions}
+
+    try:
+        cached = cache.get_many(keys)
+    except Exception as e:
+        logger.error(f"Could not read cached user snapshots: {e}")
+        cached = {}
+
+    snapshots = {}
+    outdated_ids = []
+
+    for key, user_id in keys.items():
+        snapshot = cached.get(key)
+
+        if snapshot is not None and snapshot.get('deleted'):
+            snapshots[user_id] = None
+        elif snapshot is not None and snapshot['profile_version'] >= min_versions[user_id]:
+            snapshots[user_id] = snapshot
+        else:
+            outdated_ids.append(user_id)
+
+    if outdated_ids:
+        users = {user.id: user for user in User.objects.filter(id__in=outdated_ids)}
+        fresh = {}
+
+        for user_id in outdated_ids:
+            user = users.get(user_id)
+            if user is None:
+                store_tombstone(user_id)
+                snapshots[user_id] = None
+            else:
+                snapshots[user_id] = fresh[get_snapshot_key(user_id)] = make_snapshot(user)
+
+        try:
+            cache.set_many(fresh, timeout=settings.USER_SNAPSHOT_TTL_S)
+        except Exception as e:
+            logger.error(f"Could not cache user snapshots: {e}")
+
+    return snapshots
@@ -3,6 +3,12 @@ from rest_framework.test import APITestCase
 from rest_framework import status
 from users.models import User
 from unittest.mock import patch
+from django.core.cache import cache
+from django.test import override_settings
+from django.db import transaction
+from users.snapshots import get_snapshot_key
+from users.events import publish_user_event
+import json
 
 
 class UserUpdateRatingViewTest(APITestCase):
@@ -18,6 +24,7 @@ class UserUpdateRatingViewTest(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.user.refresh_from_db()
         self.assertEqual(self.user.rating, 1300)
+        self.assertEqual(self.user.profile_version, 1)
 
     @patch('sA.permissions.ProvidesValidRootPassword.has_permission')
     def test_update_user_rating_missing_params(self, mock_permission):
@@ -50,3 +57,166 @@ class UserUpdateRatingViewTest(APITestCase):
         response = self.client.patch(f'{self.url}?id=1&delta=100')
         self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
         self.assertEqual(response.data['detail'], "Authentication credentials were not provided.")
+
+
+class UserBulkViewTest(APITestCase):
+    def setUp(self):
+        self.users = [User.objects.create(username=f"username{i}") for i in range(3)]
+        self.url = reverse('user-bulk')
+
+    @patch('sA.permissions.ProvidesValidRootPassword.has_permission')
+    def test_bulk_lookup_success(self, mock_permission):
+        mock_permission.return_value = True
+
+        ids = ','.join(str(user.id) for user in self.users)
+        response = self.client.get(f'{self.url}?ids={ids},9999')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([user['username'] for user in response.data['users']], ['username0', 'username1', 'username2'])
+
+    @patch('sA.permissions.ProvidesValidRootPassword.has_permission')
+    def test_bulk_lookup_single_query(self, mock_permission):
+        mock_permission.return_value = True
+
+        # Nothing cached, so all of them come from one query
+        cache.clear()
+        ids = ','.join(str(user.id) for user in self.users)
+        with self.assertNumQueries(1):
+            response = self.client.get(f'{self.url}?ids={ids}')
+        self.assertEqual(len(response.data['users']), 3)
+
+    @patch('users.snapshots.cache.set_many', side_effect=ConnectionError("Cache unreachable"))
+    @patch('users.snapshots.cache.get_many', side_effect=ConnectionError("Cache unreachable"))
+    @patch('sA.permissions.ProvidesValidRootPassword.has_permission')
+    def test_bulk_lookup_without_cache(self, mock_permission, mock_get_many, mock_set_many):
+        mock_permission.return_value = True
+
+        ids = ','.join(str(user.id) for user in self.users)
+        response = self.client.get(f'{self.url}?ids={ids}')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data['users']), 3)
+
+    @patch('sA.permissions.ProvidesValidRootPassword.has_permission')
+    def test_bulk_lookup_invalid_ids(self, mock_permission):
+        mock_permission.return_value = True
+
+        response = self.client.get(f'{self.url}?ids=1,abc')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    @patch('sA.permissions.ProvidesValidRootPassword.has_permission')
+    @override_settings(BULK_LOOKUP_MAX_ITEMS=2)
+    def test_bulk_lookup_too_many_ids(self, mock_permission):
+        mock_permission.return_value = True
+
+        response = self.client.get(f'{self.url}?ids=1,2,3')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+@override_settings(USER_EVENTS_REDIS_URL='redis://user-events')
+class UserEventsTest(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create(username="username")
+
+    def published_events(self, mock_send):
+        return [json.loads(call.args[0]) for call in mock_send.call_args_list]
+
+    @patch('users.events.send')
+    @patch('sA.permissions.ProvidesValidRootPassword.has_permission')
+    def test_rating_update_is_published(self, mock_permission, mock_send):
+        mock_permission.return_value = True
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.patch(f"{reverse('user-rating-upd')}?id={self.user.id}&delta=100")
+
+        self.assertEqual(self.published_events(mock_send), [{'user_id': self.user.id, 'fields': ['rating'], 'version': 1}])
+
+    @patch('users.events.send')
+    def test_unchanged_profile_is_not_published(self, mock_send):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.save()
+
+        mock_send.assert_not_called()
+
+    @patch('users.events.send')
+    def test_not_published_before_commit(self, mock_send):
+        self.user.rating += 1
+
+        with self.captureOnCommitCallbacks(execute=False) as callbacks:
+            self.user.save()
+
+        mock_send.assert_not_called()
+        self.assertEqual(len(callbacks), 1)
+
+    @patch('users.events.send')
+    def test_deletion_is_published(self, mock_send):
+        friend = User.objects.create(username="friend")
+        self.user.friends.add(friend)
+        user_id = self.user.id
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.delete()
+
+        events = self.published_events(mock_send)
+        self.assertIn({'user_id': friend.id, 'fields': ['friends'], 'version': None}, events)
+        self.assertIn({'user_id': user_id, 'fields': ['deleted'], 'version': 0}, events)
+
+    @patch('users.events.transaction.on_commit')
+    def test_published_on_the_write_alias(self, mock_on_commit):
+        publish_user_event(self.user.id, ['rating'], 1, using='replica1')
+        self.assertEqual(mock_on_commit.call_args.kwargs['using'], 'replica1')
+
+        # e.g. a replica promoted after the master failed
+        with patch('users.events.router.db_for_write', return_value='replica2'):
+            publish_user_event(self.user.id, ['rating'], 1)
+        self.assertEqual(mock_on_commit.call_args.kwargs['using'], 'replica2')
+
+
+class UserSnapshotTest(APITestCase):
+    def setUp(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user = User.objects.create(username="username")
+
+    def get_cached_snapshot(self):
+        return cache.get(get_snapshot_key(self.user.id))
+
+    def test_snapshot_cached_on_commit(self):
+        self.user.rating = 1300
+
+        with self.captureOnCommitCallbacks(execute=False) as callbacks:
+            self.user.save()
+        self.assertEqual(self.get_cached_snapshot()['rating'], 1200)
+
+        callbacks[0]()
+        self.assertEqual(self.get_cached_snapshot()['rating'], 1300)
+
+    def test_rolled_back_save_is_not_cached(self):
+        with self.assertRaises(RuntimeError):
+            with transaction.atomic():
+                self.user.rating = 1300
+                self.user.save()
+                raise RuntimeError()
+
+        self.assertEqual(self.get_cached_snapshot()['rating'], 1200)
+
+    @patch('users.snapshots.cache.set', side_effect=ConnectionError("Cache unreachable"))
+    @patch('sA.permissions.ProvidesValidRootPassword.has_permission')
+    def test_cache_outage_does_not_fail_rating_update(self, mock_permission, mock_cache_set):
+        mock_permission.return_value = True
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.patch(f"{reverse('user-rating-upd')}?id={self.user.id}&delta=100")
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(mock_cache_set.called)
+        self.assertEqual(User.objects.get(id=self.user.id).rating, 1300)
+
+    def test_concurrent_updates_get_distinct_versions(self):
+        # Two requests holding their own copy of the same user
+        first, second = User.objects.get(id=self.user.id), User.objects.get(id=self.user.id)
+
+        first.rating = 1300
+        first.save()
+        second.username = "renamed"
+        second.save()
+
+        self.assertEqual((first.profile_version, second.profile_version), (1, 2))
+        self.assertEqual(User.objects.get(id=self.user.id).profile_version, 2)
@@ -1,9 +1,10 @@
 from django.urls import path
-from .views import UserListView, UserDestroyView, UserUpdateRatingView
+from .views import UserListView, UserBulkView, UserDestroyView, UserUpdateRatingView
 
 
 urlpatterns = [
     path('list', UserListView.as_view(), name='user-list'),
+    path('bulk', UserBulkView.as_view(), name='user-bulk'),
     path('<int:pk>/destroy', UserDestroyView.as_view(), name='user-destroy'),
     path('rating/upd', UserUpdateRatingView.as_view(), name='user-rating-upd'),
 ]
\ No newline at end of file
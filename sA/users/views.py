@@ -5,6 +5,8 @@ from rest_framework import status
 from rest_framework.response import Response
 from rest_framework.views import APIView
 from sA.permissions import ProvidesValidRootPassword
+from django.conf import settings
+from .snapshots import get_snapshots
 
 
 class UserListView(generics.ListAPIView):
@@ -19,6 +21,33 @@ class UserListView(generics.ListAPIView):
         return User.objects.all()
 
 
+class UserBulkView(APIView):
+    permission_classes = [ProvidesValidRootPassword]
+
+    def get(self, request, *args, **kwargs):
+        ids = request.query_params.get('ids', '')
+
+        try:
+            user_ids = list(dict.fromkeys(int(user_id) for user_id in ids.split(',') if user_id))
+        except ValueError:
+            return Response({"detail": "'ids' must be a comma separated list of integers!"}, status=status.HTTP_400_BAD_REQUEST)
+
+        if not user_ids:
+            return Response({"detail": "'ids' query parameter is required!"}, status=status.HTTP_400_BAD_REQUEST)
+
+        if len(user_ids) > settings.BULK_LOOKUP_MAX_ITEMS:
+            return Response({"detail": f"At most {settings.BULK_LOOKUP_MAX_ITEMS} users can be looked up at once!"}, status=status.HTTP_400_BAD_REQUEST)
+
+        # Served from the cached snapshots, the ones missing are loaded with a single query
+        snapshots = get_snapshots({user_id: 0 for user_id in user_ids})
+        users = [
+            {field: snapshot[field] for field in ('id', 'username', 'rating')}
+            for snapshot in snapshots.values() if snapshot is not None
+        ]
+
+        return Response({'users': users}, status=status.HTTP_200_OK)
+
+
 class UserDestroyView(generics.DestroyAPIView):
     queryset = User.objects.all()
     serializer_class = UserSerializer
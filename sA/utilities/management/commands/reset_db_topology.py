@@ -0,0 +1,17 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from sA.db_topology import TopologyStore
+
+
+class Command(BaseCommand):
+    help = "Clears the database layout shared by the sA workers, they go back to the configured master and replicas."
+
+    def handle(self, *args, **options):
+        if not settings.DB_TOPOLOGY_REDIS_URL:
+            raise CommandError("DB_TOPOLOGY_REDIS_URL is not set, there is no shared topology to reset.")
+
+        store = TopologyStore(settings.DB_TOPOLOGY_REDIS_URL)
+        version, layout = store.load()
+        store.reset()
+
+        self.stdout.write(f"Reset the shared database topology (was v{version}: {layout}).")
@@ -4,12 +4,26 @@ from rest_framework import status
 from users.models import User
 from rest_framework_simplejwt.tokens import AccessToken
 from unittest.mock import patch
+from django.core.cache import cache
+from sA.tokens import AccessToken as SignedAccessToken
 from rest_framework.exceptions import ErrorDetail
+from django.test import SimpleTestCase
+from django.db import OperationalError, InterfaceError
+from unittest.mock import MagicMock
+import os
+import time
+import redis
+import threading
+from django.conf import settings
+from sA.db_routing import PostgreSQLRouter, RoutingContext, routing_context
+from sA.db_topology import TopologyStore
 
 
 class ValidateTokenForBViewTest(APITestCase):
     def setUp(self):
-        self.user = User.objects.create(username="username0")
+        # The snapshots are cached once the writes commit
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user = User.objects.create(username="username0")
         self.url = reverse('validate-token')
 
         self.token = str(AccessToken.for_user(self.user))
@@ -38,7 +52,8 @@ class ValidateTokenForBViewTest(APITestCase):
         mock_permission.return_value = True
 
         # Try to use token for a non-existent user
-        self.user.delete()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.delete()
 
         response = self.client.get(self.url)
         self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
@@ -49,4 +64,332 @@ class ValidateTokenForBViewTest(APITestCase):
 
         response = self.client.get(self.url)
         self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
-        self.assertIsInstance(response.data['detail'], ErrorDetail)
\ No newline at end of file
+        self.assertIsInstance(response.data['detail'], ErrorDetail)
+
+    @patch('sA.permissions.ProvidesValidRootPassword.has_permission')
+    def test_validate_token_without_queries(self, mock_permission):
+        mock_permission.return_value = True
+
+        with self.assertNumQueries(0):
+            response = self.client.get(self.url)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, {'id': self.user.id, 'username': 'username0', 'rating': 1200})
+
+    @patch('users.snapshots.cache.get_many', side_effect=ConnectionError("Cache unreachable"))
+    @patch('sA.permissions.ProvidesValidRootPassword.has_permission')
+    def test_validate_token_without_cache(self, mock_permission, mock_get_many):
+        mock_permission.return_value = True
+
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['id'], self.user.id)
+
+    @patch('sA.permissions.ProvidesValidRootPassword.has_permission')
+    def test_validate_token_reflects_rating_change(self, mock_permission):
+        mock_permission.return_value = True
+
+        self.user.rating = 1300
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.save()
+
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['rating'], 1300)
+
+
+class ValidateTokensForBViewTest(APITestCase):
+    def setUp(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.users = [User.objects.create(username=f"username{i}") for i in range(2)]
+        self.tokens = [str(SignedAccessToken.for_user(user)) for user in self.users]
+        self.url = reverse('validate-tokens')
+
+    @patch('sA.permissions.ProvidesValidRootPassword.has_permission')
+    def test_validate_tokens_success(self, mock_permission):
+        mock_permission.return_value = True
+
+        response = self.client.post(self.url, {'tokens': [self.tokens[1], 'garbage', self.tokens[0]]}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        users = response.data['users']
+        self.assertEqual(users[0]['id'], self.users[1].id)
+        self.assertIsNone(users[1])
+        self.assertEqual(users[2]['username'], 'username0')
+
+    @patch('sA.permissions.ProvidesValidRootPassword.has_permission')
+    def test_validate_tokens_deleted_user(self, mock_permission):
+        mock_permission.return_value = True
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.users[0].delete()
+
+        response = self.client.post(self.url, {'tokens': self.tokens}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIsNone(response.data['users'][0])
+        self.assertEqual(response.data['users'][1]['id'], self.users[1].id)
+
+    @patch('sA.permissions.ProvidesValidRootPassword.has_permission')
+    def test_validate_tokens_single_query(self, mock_permission):
+        mock_permission.return_value = True
+
+        cache.clear()
+        with self.assertNumQueries(1):
+            response = self.client.post(self.url, {'tokens': self.tokens}, format='json')
+        self.assertEqual(len([user for user in response.data['users'] if user]), 2)
+
+    @patch('users.snapshots.cache.get_many', side_effect=ConnectionError("Cache unreachable"))
+    @patch('sA.permissions.ProvidesValidRootPassword.has_permission')
+    def test_validate_tokens_without_cache(self, mock_permission, mock_get_many):
+        mock_permission.return_value = True
+
+        response = self.client.post(self.url, {'tokens': self.tokens}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([user['id'] for user in response.data['users']], [user.id for user in self.users])
+
+    @patch('sA.permissions.ProvidesValidRootPassword.has_permission')
+    def test_validate_tokens_missing_list(self, mock_permission):
+        mock_permission.return_value = True
+
+        response = self.client.post(self.url, {}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class MetricsViewTest(APITestCase):
+    def setUp(self):
+        self.url = reverse('metrics')
+
+    @patch('sA.permissions.ProvidesValidRootPassword.has_permission')
+    def test_metrics_report_router_decisions(self, mock_permission):
+        mock_permission.return_value = True
+
+        User.objects.create(username="username0")
+        list(User.objects.all())
+
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        stats = response.data['db_router']
+        self.assertIn(stats['write_db'], stats['counters']['writes'])
+        self.assertGreater(sum(stats['counters']['reads'].values()), 0)
+
+    @patch('sA.permissions.ProvidesValidRootPassword.has_permission')
+    def test_metrics_unauthorized(self, mock_permission):
+        mock_permission.return_value = False
+
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+
+class PostgreSQLRouterTest(SimpleTestCase):
+    def setUp(self):
+        self.router = PostgreSQLRouter()
+        for db_alias in ('default', 'replica1', 'replica2'):
+            self.set_health(db_alias, True)
+
+        self.context_token = routing_context.set(RoutingContext())
+
+    def tearDown(self):
+        routing_context.reset(self.context_token)
+
+    def set_health(self, db_alias, healthy):
+        self.router.health_state[db_alias] = (healthy, time.monotonic())
+
+    def run_failing_query(self, error, usable=True):
+        connection = MagicMock(alias='default', in_atomic_block=False)
+        connection.connection.closed = False
+        connection.connection.broken = False
+        connection.is_usable.return_value = usable
+
+        def execute(sql, params, many, context):
+            raise error
+
+        with self.assertRaises(type(error)):
+            self.router.observe_query(execute, 'SELECT 1', None, False, {'connection': connection})
+
+    def test_reads_go_to_replicas(self):
+        self.assertIn(self.router.db_for_read(None), ('replica1', 'replica2'))
+
+    def test_read_after_write_goes_to_master(self):
+        self.assertEqual(self.router.db_for_write(None), 'default')
+        self.assertEqual(self.router.db_for_read(None), 'default')
+
+    def test_sticky_read_goes_to_caught_up_replica(self):
+        routing_context.set(RoutingContext(user_id=1, sticky=True, sticky_lsn=100))
+        self.router.replay_lsn = {'replica1': 50, 'replica2': 150}
+
+        self.assertEqual(self.router.db_for_read(None), 'replica2')
+
+    def test_sticky_read_without_position_goes_to_master(self):
+        routing_context.set(RoutingContext(user_id=1, sticky=True))
+
+        self.assertEqual(self.router.db_for_read(None), 'default')
+
+    def test_unhealthy_replica_is_skipped(self):
+        self.set_health('replica1', False)
+
+        self.assertEqual(self.router.db_for_read(None), 'replica2')
+        self.assertEqual(self.router.ejected_replicas, ['replica1'])
+
+    def test_ejected_replica_is_readmitted(self):
+        self.router.remove_failed_replica('replica1')
+        self.router.readmit_replica('replica1')
+
+        self.assertIn('replica1', self.router.replica_list)
+        self.assertEqual(self.router.ejected_replicas, [])
+
+    @patch('sA.db_routing.PostgreSQLRouter.is_connection_healthy_no_reconnect')
+    def test_health_is_cached_for_its_ttl(self, mock_check):
+        mock_check.return_value = True
+        self.router.health_state.clear()
+
+        self.assertTrue(self.router.is_healthy('replica1'))
+        self.assertTrue(self.router.is_healthy('replica1'))
+        self.assertEqual(mock_check.call_count, 1)
+
+        # Past the TTL the state is checked again
+        self.router.health_state['replica1'] = (True, time.monotonic() - self.router.health_ttl - 1)
+        self.router.is_healthy('replica1')
+        self.assertEqual(mock_check.call_count, 2)
+
+    def test_failed_query_keeps_usable_connection_healthy(self):
+        self.run_failing_query(OperationalError('deadlock detected'))
+
+        self.assertTrue(self.router.health_state['default'][0])
+        self.assertEqual(self.router.db_for_write(None), 'default')
+
+    def test_lost_connection_does_not_fail_master_over(self):
+        self.run_failing_query(OperationalError('server closed the connection'), usable=False)
+        self.run_failing_query(InterfaceError('connection already closed'))
+
+        self.assertFalse(self.router.health_state['default'][0])
+        self.assertEqual(self.router.db_for_write(None), 'default')
+
+    @patch('sA.db_routing.PostgreSQLRouter.is_connection_healthy_no_reconnect')
+    def test_failed_health_check_promotes_replica(self, mock_check):
+        mock_check.side_effect = lambda db_alias, connection=None: db_alias != 'default'
+        self.router.health_state.clear()
+
+        # A single failed check is not enough
+        self.assertEqual(self.router.db_for_write(None), 'default')
+
+        for _ in range(self.router.master_failed_probes - 1):
+            self.router.refresh_health('default')
+        self.assertEqual(self.router.db_for_write(None), 'replica1')
+        self.assertEqual(self.router.replica_list, ['replica2'])
+        self.assertEqual(self.router.demoted_masters, ['default'])
+
+    def test_demoted_master_readmitted_once_in_recovery(self):
+        self.router.promote_replica_to_master()
+
+        self.router.readmit_demoted_master('default', in_recovery=False)
+        self.assertEqual(self.router.demoted_masters, ['default'])
+
+        self.router.readmit_demoted_master('default', in_recovery=True)
+        self.assertEqual(self.router.demoted_masters, [])
+        self.assertEqual(self.router.replica_list, ['replica2', 'default'])
+
+    def test_concurrent_master_failures_promote_once(self):
+        for _ in range(self.router.master_failed_probes):
+            self.router.failed_probes['default'] += 1
+
+        threads = [threading.Thread(target=self.router.db_for_write, args=(None,)) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.router.write_db, 'replica1')
+        self.assertEqual(self.router.replica_list, ['replica2'])
+        self.assertEqual(dict(self.router.counters['promotions']), {'replica1': 1})
+
+    def test_probes_are_not_timed(self):
+        connection = self.router.get_probe_connection('replica1')
+        self.router.install_query_observer(None, connection)
+
+        self.assertNotIn(self.router.observe_query, connection.execute_wrappers)
+        self.assertEqual(connection.settings_dict['OPTIONS']['connect_timeout'], self.router.probe_timeout)
+        self.assertNotIn('pool', connection.settings_dict['OPTIONS'])
+
+    def test_apply_topology(self):
+        layout = {'write_db': 'replica1', 'replicas': ['replica2'], 'ejected_replicas': [], 'demoted_masters': ['default']}
+        self.router.apply_topology(2, layout)
+
+        self.assertEqual(self.router.write_db, 'replica1')
+        self.assertEqual(self.router.replica_list, ['replica2'])
+        self.assertEqual(self.router.topology_version, 2)
+
+        # Older layouts and ones naming unknown databases are ignored
+        self.router.apply_topology(1, {**layout, 'write_db': 'replica2'})
+        self.router.apply_topology(3, {**layout, 'write_db': 'nowhere'})
+        self.assertEqual(self.router.write_db, 'replica1')
+        self.assertEqual(self.router.topology_version, 2)
+
+    def test_reset_topology(self):
+        self.router.promote_replica_to_master()
+
+        # Only an explicit reset brings the configured layout back
+        self.router.apply_topology(0, None)
+        self.assertEqual(self.router.write_db, 'replica1')
+
+        self.router.reset_shared_topology()
+        self.assertEqual(self.router.write_db, 'default')
+        self.assertEqual(self.router.replica_list, ['replica1', 'replica2'])
+        self.assertEqual(self.router.demoted_masters, [])
+        self.assertEqual(self.router.topology_version, 0)
+
+    def test_missing_topology_is_published_again(self):
+        self.router.topology_store = MagicMock()
+        self.router.topology_store.publish.return_value = (True, 4, {})
+
+        # Nothing to restore before any failover
+        self.router.restore_shared_topology()
+        self.router.topology_store.publish.assert_not_called()
+
+        layout = {'write_db': 'replica1', 'replicas': ['replica2'], 'ejected_replicas': [], 'demoted_masters': ['default']}
+        self.router.apply_topology(3, layout)
+        self.router.restore_shared_topology()
+
+        version, shared_layout = self.router.topology_store.publish.call_args.args
+        self.assertEqual((version, shared_layout['write_db']), (3, 'replica1'))
+        self.assertEqual(self.router.topology_version, 4)
+
+
+class TopologyStoreTest(SimpleTestCase):
+    LAYOUT = {'write_db': 'default', 'replicas': ['replica1', 'replica2'], 'ejected_replicas': [], 'demoted_masters': []}
+    PROMOTED = {'write_db': 'replica1', 'replicas': ['replica2'], 'ejected_replicas': [], 'demoted_masters': ['default']}
+
+    def setUp(self):
+        self.store = TopologyStore(os.getenv('TEST_REDIS_URL', settings.REDIS_URL))
+        self.store.KEY = 'sA:test_db_topology'
+        self.store.CHANNEL = 'sA:test_db_topology_changes'
+
+        try:
+            self.store.redis.delete(self.store.KEY)
+        except redis.RedisError:
+            self.skipTest("Redis is not reachable, set TEST_REDIS_URL")
+        self.addCleanup(self.store.redis.delete, self.store.KEY)
+
+    def test_publish_is_compare_and_set(self):
+        self.assertEqual(self.store.publish(0, self.LAYOUT), (True, 1, self.LAYOUT))
+        self.assertEqual(self.store.publish(1, self.PROMOTED), (True, 2, self.PROMOTED))
+
+        # A worker that missed v2 gets it back instead
+        self.assertEqual(self.store.publish(1, self.LAYOUT), (False, 2, self.PROMOTED))
+        self.assertEqual(self.store.load(), (2, self.PROMOTED))
+
+    def test_publish_after_the_layout_is_lost(self):
+        self.store.publish(0, self.LAYOUT)
+        self.store.publish(1, self.PROMOTED)
+        self.assertEqual(self.store.redis.ttl(self.store.KEY), -1)  # A failover never expires
+
+        # Redis lost its data, the next publish restores a layout instead of returning none
+        self.store.redis.delete(self.store.KEY)
+        self.assertEqual(self.store.publish(2, self.PROMOTED), (True, 3, self.PROMOTED))
+        self.assertEqual(self.store.publish(1, self.LAYOUT), (False, 3, self.PROMOTED))
+
+    def test_reset(self):
+        self.store.publish(0, self.PROMOTED)
+        self.store.reset()
+
+        self.assertEqual(self.store.load(), (0, None))
@@ -1,9 +1,11 @@
 from django.urls import path
-from .views import ValidateTokenForBView, StatusView, SleepyView
+from .views import ValidateTokenForBView, ValidateTokensForBView, StatusView, SleepyView, MetricsView
 
 
 urlpatterns = [
     path('validate-token', ValidateTokenForBView.as_view(),  name='validate-token'),
+    path('validate-tokens', ValidateTokensForBView.as_view(),  name='validate-tokens'),
     path('ping', StatusView.as_view(), name='ping'),
     path('sleepy', SleepyView.as_view(), name='sleepy'),
+    path('metrics', MetricsView.as_view(), name='metrics'),
 ]
\ No newline at end of file
@@ -1,23 +1,81 @@
 from rest_framework.views import APIView
 from sA.permissions import ProvidesValidRootPassword
 from rest_framework.permissions import IsAuthenticated
-from users.models import User
+from rest_framework_simplejwt.authentication import JWTStatelessUserAuthentication
+from rest_framework.exceptions import AuthenticationFailed
 from rest_framework.response import Response
 from rest_framework import status
-from users.serializers import UserSerializer
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.settings import api_settings as jwt_settings
+from django.conf import settings
+from users.snapshots import get_snapshot, get_snapshots
+from sA.tokens import AccessToken
+from sA.db_routing import get_router
+from sA.middleware import logger as logstash_logger
 import time
 import os
 
 
 class ValidateTokenForBView(APIView):
+    # The token is trusted as is and the profile comes from the cached snapshot,
+    # so a warm snapshot means no query at all
+    authentication_classes = [JWTStatelessUserAuthentication]
     permission_classes = [ProvidesValidRootPassword, IsAuthenticated]
 
     def get(self, request):
         user_id = request.user.id
-        user = User.objects.get(id=user_id)
+        snapshot = get_snapshot(user_id, min_version=request.auth.get('profile_version', 0))
 
-        basic_user_info = UserSerializer(user).data
+        if snapshot is None:
+            raise AuthenticationFailed("User not found", code="user_not_found")
+
+        basic_user_info = {field: snapshot[field] for field in ('id', 'username', 'rating')}
         return Response(basic_user_info, status=status.HTTP_200_OK)
+
+
+class ValidateTokensForBView(APIView):
+    """
+    ValidateTokenForBView for a list of tokens. Answers with the user info of every
+    token in the same order, or null for tokens that are invalid or whose user is gone.
+    """
+    authentication_classes = []
+    permission_classes = [ProvidesValidRootPassword]
+
+    def post(self, request):
+        tokens = request.data.get('tokens')
+
+        if not isinstance(tokens, list) or not tokens:
+            return Response({"detail": "'tokens' must be a non-empty list."}, status=status.HTTP_400_BAD_REQUEST)
+
+        if len(tokens) > settings.BULK_LOOKUP_MAX_ITEMS:
+            return Response(
+                {"detail": f"At most {settings.BULK_LOOKUP_MAX_ITEMS} tokens can be validated at once."},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        # (user id, profile version) of every valid token
+        claims = []
+        for raw_token in tokens:
+            try:
+                token = AccessToken(raw_token)
+                claims.append((token[jwt_settings.USER_ID_CLAIM], token.get('profile_version', 0)))
+            except (TokenError, KeyError, TypeError):
+                claims.append(None)
+
+        min_versions = {}
+        for claim in claims:
+            if claim is not None:
+                user_id, profile_version = claim
+                min_versions[user_id] = max(min_versions.get(user_id, 0), profile_version)
+
+        snapshots = get_snapshots(min_versions)
+
+        users = []
+        for claim in claims:
+            snapshot = snapshots.get(claim[0]) if claim is not None else None
+            users.append({field: snapshot[field] for field in ('id', 'username', 'rating')} if snapshot else None)
+
+        return Response({'users': users}, status=status.HTTP_200_OK)
     
 
 class StatusView(APIView):
@@ -40,3 +98,18 @@ class SleepyView(APIView):
             {'message': f"You are not supposed to see this message!"},
             status=status.HTTP_202_ACCEPTED
         )
+
+
+class MetricsView(APIView):
+    permission_classes = [ProvidesValidRootPassword]
+
+    def get(self, request):
+        router = get_router()
+
+        return Response(
+            {
+                'db_router': router.get_stats() if router else None,
+                'logstash': logstash_logger.stats(),
+            },
+            status=status.HTTP_200_OK
+        )
@@ -0,0 +1,305 @@
+import os
+import json
+import asyncio
+import redis
+from . import games
+
+
+# Spectator sockets served by one relay task
+BROADCAST_SHARD_SIZE = int(os.getenv('BROADCAST_SHARD_SIZE', 500))
+
+# Frames a spectator socket may fall behind by before it is disconnected
+BROADCAST_SOCKET_QUEUE = int(os.getenv('BROADCAST_SOCKET_QUEUE', 64))
+
+# Close code telling a dropped spectator to reconnect later
+SLOW_CONSUMER_CLOSE_CODE = 4008
+
+# First and longest wait before a hub that lost its channel subscribes again
+RESUBSCRIBE_DELAY_S = float(os.getenv('BROADCAST_RESUBSCRIBE_DELAY_S', 1))
+RESUBSCRIBE_MAX_DELAY_S = float(os.getenv('BROADCAST_RESUBSCRIBE_MAX_DELAY_S', 30))
+
+
+class Subscriber:
+    """
+    One spectator socket. Frames are queued and written by its own task, so a slow
+    client only ever holds up itself.
+    """
+    __slots__ = ('hub', 'consumer', 'frames', 'writer')
+
+    def __init__(self, hub, consumer):
+        self.hub = hub
+        self.consumer = consumer
+        self.frames = asyncio.Queue(BROADCAST_SOCKET_QUEUE)
+        self.writer = asyncio.get_running_loop().create_task(self.write_forever())
+
+    def offer(self, frame):
+        try:
+            self.frames.put_nowait(frame)
+            return True
+        except asyncio.QueueFull:
+            return False
+
+    async def write_forever(self):
+        while True:
+            frame = await self.frames.get()
+            try:
+                await self.consumer.send(text_data=frame)
+            except Exception as e:
+                # The socket is broken, nothing written to it from now on would arrive
+                self.hub.failures += 1
+                print(f"LOG: Could not write to a spectator of {self.hub.group_name}, closing it: {e}")
+                break
+
+        try:
+            await self.hub.unsubscribe(self.consumer)
+            await self.consumer.close()
+        except Exception as e:
+            print(f"LOG: Could not drop a broken spectator of {self.hub.group_name}: {e}")
+
+    def stop(self):
+        # Not from within the writer, which stops on its own after unsubscribing
+        if self.writer is not asyncio.current_task():
+            self.writer.cancel()
+
+
+class RelayShard:
+    """
+    Hands every frame to up to BROADCAST_SHARD_SIZE spectator sockets. Each shard runs
+    as its own task, so the loop gets to run other work between shards.
+    """
+
+    def __init__(self, hub):
+        self.hub = hub
+        self.subscribers = set()
+        self.frames = asyncio.Queue()
+        self.relay = asyncio.get_running_loop().create_task(self.relay_forever())
+
+    async def relay_forever(self):
+        while True:
+            frame = await self.frames.get()
+
+            for subscriber in list(self.subscribers):
+                if not subscriber.offer(frame):
+                    self.hub.drop_slow(subscriber)
+
+    def stop(self):
+        self.relay.cancel()
+
+
+class BroadcastHub:
+    """
+    Relays a broadcast lobby's messages to the spectators connected to this process.
+    The hub is the process's only member of the lobby group, so a move costs one
+    channel layer delivery and one JSON encoding per process, whatever the audience.
+    It also keeps the lobby's membership for the spectator consumers, which share it.
+    """
+
+    def __init__(self, channel_layer, group_name, players, spectators):
+        self.channel_layer = channel_layer
+        self.group_name = group_name
+        self.players = players
+        self.spectators = spectators
+
+        self.channel_name = None
+        self.shards = []
+        self.subscriptions = {}     # consumer -> (shard, subscriber)
+        self.starting = None
+        self.receiver = None
+        self.stopped = False
+
+        self.frames = 0
+        self.dropped = 0
+        self.failures = 0
+        self.resubscribes = 0
+
+    async def start(self):
+        self.channel_name = await self.channel_layer.new_channel()
+        await self.channel_layer.group_add(self.group_name, self.channel_name)
+        self.receiver = asyncio.get_running_loop().create_task(self.receive_forever())
+
+    async def receive_forever(self):
+        while True:
+            try:
+                event = await self.channel_layer.receive(self.channel_name)
+            except Exception as e:
+                self.failures += 1
+                print(f"LOG: Broadcast relay of {self.group_name} lost its channel: {e}")
+                await self.resubscribe()
+                continue
+
+            if event.get('type') == 'channel.overflow':
+                # The layer gave up on this channel, see RedisClusterChannelLayer.overflow()
+                self.failures += 1
+                print(f"LOG: Broadcast relay of {self.group_name} fell behind")
+                await self.resubscribe()
+                continue
+
+            try:
+                self.dispatch(event)
+            except Exception as e:
+                # Nothing was relayed, the next event is
+                self.failures += 1
+                print(f"LOG: Broadcast relay of {self.group_name} could not relay {event!r}: {e}")
+
+    async def resubscribe(self):
+        """
+        Moves the hub to a new channel, waiting longer after every failed attempt. What was
+        sent to the lobby meanwhile is lost, so the spectators get the game state again.
+        """
+        delay = RESUBSCRIBE_DELAY_S
+
+        while True:
+            await asyncio.sleep(delay)
+            try:
+                channel_name = await self.channel_layer.new_channel()
+                await self.channel_layer.group_add(self.group_name, channel_name)
+                break
+            except Exception as e:
+                print(f"LOG: Broadcast relay of {self.group_name} could not subscribe again: {e}")
+                delay = min(delay * 2, RESUBSCRIBE_MAX_DELAY_S)
+
+        old_channel_name, self.channel_name = self.channel_name, channel_name
+        self.resubscribes += 1
+
+        try:
+            await self.channel_layer.group_discard(self.group_name, old_channel_name)
+        except Exception as e:
+            print(f"LOG: Could not leave {self.group_name} with the old relay channel: {e}")
+
+        await self.resync()
+
+    async def resync(self):
+        # This process's copy of the game may have missed moves as well
+        games.forget_game(self.group_name)
+
+        try:
+            game = await games.get_game(self.group_name)
+        except redis.RedisError as e:
+            print(f"LOG: Could not load the game of {self.group_name} to resync its spectators: {e}")
+            return
+
+        self.relay(json.dumps({'type': 'game_state', 'game': game.info(), 'moves': game.moves}))
+
+    def dispatch(self, event):
+        if event['type'] == 'lobby_membership' and event['action'] == 'close':
+            # Every spectator is told and closed, the last one to go stops the hub
+            for consumer in list(self.subscriptions):
+                asyncio.get_running_loop().create_task(consumer.lobby_membership(event))
+            return
+
+        if event['type'] == 'lobby_membership':
+            user_id = event['user_id']
+            self.players.discard(user_id)
+            self.spectators.discard(user_id)
+            if event['action'] == 'join':
+                (self.players if event['role'] == 'player' else self.spectators).add(user_id)
+            return
+
+        if event['type'] not in ('chat_message', 'move_message'):
+            return
+
+        frame = {'type': event['type'], 'message': event['message']}
+        if event['type'] == 'move_message':
+            games.apply_event(self.group_name, event['game'])
+            frame['game'] = event['game']
+
+        # Encoded once for every spectator in the process
+        self.relay(json.dumps(frame))
+
+    def relay(self, frame):
+        self.frames += 1
+
+        for shard in self.shards:
+            shard.frames.put_nowait(frame)
+
+    def subscribe(self, consumer):
+        shard = next((shard for shard in self.shards if len(shard.subscribers) < BROADCAST_SHARD_SIZE), None)
+        if shard is None:
+            shard = RelayShard(self)
+            self.shards.append(shard)
+
+        subscriber = Subscriber(self, consumer)
+        shard.subscribers.add(subscriber)
+        self.subscriptions[consumer] = (shard, subscriber)
+
+    async def unsubscribe(self, consumer):
+        shard, subscriber = self.subscriptions.pop(consumer, (None, None))
+        if shard is None:
+            return
+
+        subscriber.stop()
+        shard.subscribers.discard(subscriber)
+
+        # Its shard may already be gone if it was dropped for being slow
+        if not shard.subscribers and shard in self.shards:
+            shard.stop()
+            self.shards.remove(shard)
+
+        if not self.subscriptions:
+            await self.stop()
+
+    def drop_slow(self, subscriber):
+        # Skipping frames would leave the spectator with a wrong board, so it reconnects instead
+        shard, _ = self.subscriptions.get(subscriber.consumer, (None, None))
+        if shard is None:
+            return
+
+        shard.subscribers.discard(subscriber)
+        subscriber.stop()
+        self.dropped += 1
+
+        print(f"LOG: Dropped a slow spectator of {self.group_name}")
+        asyncio.get_running_loop().create_task(subscriber.consumer.close(code=SLOW_CONSUMER_CLOSE_CODE))
+
+    async def stop(self):
+        self.stopped = True
+        if hubs.get(self.group_name) is self:
+            del hubs[self.group_name]
+
+        for shard in self.shards:
+            shard.stop()
+        if self.receiver is not None:
+            self.receiver.cancel()
+        if self.channel_name is not None:
+            await self.channel_layer.group_discard(self.group_name, self.channel_name)
+
+    def stats(self):
+        return {
+            'spectators': len(self.subscriptions),
+            'shards': len(self.shards),
+            'frames': self.frames,
+            'dropped': self.dropped,
+            'failures': self.failures,
+            'resubscribes': self.resubscribes,
+        }
+
+
+hubs = {}   # group name -> BroadcastHub of this process
+
+async def subscribe(consumer):
+    """
+    Subscribes a spectator consumer to its lobby's hub, starting the hub if needed.
+    Returns the hub, whose membership sets the consumer should use from then on.
+    """
+    while True:
+        hub = hubs.get(consumer.room_group_name)
+        if hub is None:
+            hub = hubs[consumer.room_group_name] = BroadcastHub(
+                consumer.channel_layer, consumer.room_group_name, consumer.players, consumer.spectators
+            )
+            hub.starting = asyncio.get_running_loop().create_task(hub.start())
+
+        try:
+            await asyncio.shield(hub.starting)
+        except Exception:
+            if hubs.get(consumer.room_group_name) is hub:
+                del hubs[consumer.room_group_name]
+            raise
+
+        # It may have lost its last spectator while this one waited
+        if not hub.stopped:
+            hub.subscribe(consumer)
+            return hub
+
+def get_stats():
+    return {group_name: hub.stats() for group_name, hub in hubs.items()}
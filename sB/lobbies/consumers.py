@@ -1,8 +1,19 @@
-import os
-import requests
+import jwt
+import redis
 from channels.generic.websocket import AsyncJsonWebsocketConsumer
 from channels.db import database_sync_to_async
-from sB.utilities import get_timeout_from_token, cache_get, cache_set
+from sB.tokens import verify_token, user_data_from_claims
+from sB import http_client
+from sB.singleflight import AsyncSingleFlight
+from sB.loaders import async_token_loader, LoadError
+from sB.user_events import async_has_outdated_profile
+from sB.utilities import get_timeout_from_token, async_cache_get, async_cache_set, async_index_user_token, token_cache_key, get_stale_user_data, is_rejected_token, remember_rejected_token
+from .membership import get_group_name, membership_event
+from . import broadcast, games
+
+
+# Concurrent connects with the same uncached token share one validation
+token_validations = AsyncSingleFlight()
 
 
 class LobbyConsumer(AsyncJsonWebsocketConsumer):
@@ -10,7 +21,12 @@ class LobbyConsumer(AsyncJsonWebsocketConsumer):
         await self.accept()
 
         self.lobby_identifier = self.scope['url_route']['kwargs']['lobby_identifier']
-        self.room_group_name = f'lobby_{self.lobby_identifier}'
+        self.room_group_name = get_group_name(self.lobby_identifier)
+        self.user_id = None
+        self.players = set()
+        self.spectators = set()
+        self.broadcast = False
+        self.hub = None
 
         # Extract the authorization header from the WebSocket request
         token = self.get_token_from_headers(self.scope['headers'])
@@ -28,18 +44,29 @@ class LobbyConsumer(AsyncJsonWebsocketConsumer):
 
         self.user_id = self.scope['user_data']['id']
 
+        # Joined first, so no membership change can slip in between loading and listening
+        await self.channel_layer.group_add(
+            self.room_group_name,
+            self.channel_name
+        )
+
         # Check if connecting user is registered to be in the lobby
-        if not (await self.is_player_in_lobby(self.user_id) or await self.is_spectator_in_lobby(self.user_id)):
+        await self.load_membership()
+        if self.user_id not in self.players and self.user_id not in self.spectators:
+            await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
             self.user_id = None
             await self.send_error("This is an unauthorized access attempt.")
             await self.close()
             return
 
-        # Join lobby group
-        await self.channel_layer.group_add(
-            self.room_group_name,
-            self.channel_name
-        )
+        if self.broadcast and self.user_id not in self.players:
+            # Spectators of a broadcast are served by the process's relay instead of the
+            # group, and come and go without an announcement
+            self.hub = await broadcast.subscribe(self)
+            await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
+            self.players, self.spectators = self.hub.players, self.hub.spectators
+            await self.send_game_state()
+            return
 
         await self.channel_layer.group_send(
             self.room_group_name,
@@ -49,7 +76,15 @@ class LobbyConsumer(AsyncJsonWebsocketConsumer):
             }
         )
 
+        await self.send_game_state()
+
     async def disconnect(self, close_code):
+        if self.hub is not None:
+            await self.hub.unsubscribe(self)
+            await self.remove_user_from_lobby(self.user_id)
+            await self.channel_layer.group_send(self.room_group_name, membership_event('leave', self.user_id))
+            return
+
         if self.user_id:
             await self.channel_layer.group_send(
                 self.room_group_name,
@@ -69,16 +104,26 @@ class LobbyConsumer(AsyncJsonWebsocketConsumer):
 
             # Remove user from the lobby
             await self.remove_user_from_lobby(user_id)
+            await self.channel_layer.group_send(self.room_group_name, membership_event('leave', user_id))
 
     async def receive_json(self, content, **kwargs):
         type = content.get('type', '')
         message = content.get('message', '')
 
+        # Anything else would reach the group's internal handlers
+        if type not in ('chat_message', 'move_message'):
+            await self.send_error("Unknown message type.")
+            return
+
         # Check if the user is a player in the lobby
-        if await self.is_spectator_in_lobby(self.user_id) and type == 'move_message':
+        if type == 'move_message' and self.user_id not in self.players:
             await self.send_error("Only players can issue moves.")
             return
 
+        if type == 'move_message':
+            await self.play_move(message)
+            return
+
         # Send message to lobby group
         await self.channel_layer.group_send(
             self.room_group_name,
@@ -89,6 +134,10 @@ class LobbyConsumer(AsyncJsonWebsocketConsumer):
         )
 
     async def chat_message(self, event):
+        # Sent before switching over to the relay, which delivers it as well
+        if self.hub is not None:
+            return
+
         type = event['type']
         message = event['message']
 
@@ -99,65 +148,142 @@ class LobbyConsumer(AsyncJsonWebsocketConsumer):
         })
 
     async def move_message(self, event):
-        type = event['type']
-        message = event['message']
+        if self.hub is not None:
+            return
+
+        games.apply_event(self.room_group_name, event['game'])
 
         # Send message to WebSocket
         await self.send_json({
-            'type': type,
-            'message': message
+            'type': event['type'],
+            'message': event['message'],
+            'game': event['game']
         })
 
+    async def play_move(self, text):
+        try:
+            event = await games.play_move(
+                self.room_group_name, self.user_id, self.scope['user_data']['username'], text, self.players
+            )
+        except games.IllegalMove as e:
+            await self.send_error(str(e))
+            return
+        except redis.RedisError as e:
+            print(f"LOG: Could not play a move in {self.room_group_name}: {e}")
+            await self.send_error("Moves cannot be played right now.")
+            return
+
+        await self.channel_layer.group_send(self.room_group_name, event)
+
+    async def send_game_state(self):
+        # Sent after joining, so a move made meanwhile may arrive twice, never not at all.
+        # Clients tell them apart by ply.
+        try:
+            game = await games.get_game(self.room_group_name)
+        except redis.RedisError as e:
+            print(f"LOG: Could not load the game of {self.room_group_name}: {e}")
+            return
+
+        await self.send_json({'type': 'game_state', 'game': game.info(), 'moves': game.moves})
+
+    async def channel_overflow(self, event):
+        # The channel layer dropped messages meant for this socket, it has to reconnect
+        # to get the game state again
+        await self.close(code=broadcast.SLOW_CONSUMER_CLOSE_CODE)
+
+    async def lobby_membership(self, event):
+        if event['action'] == 'close':
+            games.forget_game(self.room_group_name)
+            self.players.clear()
+            self.spectators.clear()
+            await self.send_error("The lobby was closed.")
+            await self.close()
+            return
+
+        user_id = event['user_id']
+
+        self.players.discard(user_id)
+        self.spectators.discard(user_id)
+
+        if event['action'] == 'join':
+            (self.players if event['role'] == 'player' else self.spectators).add(user_id)
+
     async def validate_token_and_fetch_user_data(self, full_token_str):
         token = full_token_str.split(' ')[1]
 
-        cached_user_data = cache_get(token + "_user_data")
+        if is_rejected_token(token):
+            return False
+
+        cached_user_data = await async_cache_get(token_cache_key(token, 'user_data'))
         if cached_user_data:
             print(f"LOG: Using cached data for user #{cached_user_data.get('id')}")
             self.scope['user_data'] = cached_user_data
             return True
 
-        try:
-            response = requests.get(f'{os.getenv("API_GATEWAY_BASE_URL")}sA/api/utilities/validate-token', headers={
-                'Authorization': full_token_str,
-                'X-Root-Password': os.getenv('ROOT_PASSWORD')
-            })
-            
-            if response.status_code == 200:
-                user_data = response.json()
-                self.scope['user_data'] = user_data
-                self.cache_user_data(token, user_data)
-                return True
-        except requests.RequestException:
+        user_data = await token_validations.do(
+            token_cache_key(token, 'user_data'),
+            lambda: self.validate_token(full_token_str, token)
+        )
+
+        if user_data is None:
             return False
-        
-        return False
-    
-    def cache_user_data(self, token, user_data):
+
+        self.scope['user_data'] = user_data
+        return True
+
+    async def validate_token(self, full_token_str, token):
+        # Tokens carrying the profile fields need no call to Service A at all
+        try:
+            claims = verify_token(token)
+        except jwt.InvalidTokenError:
+            remember_rejected_token(token)
+            return None
+
+        if claims is not None:
+            user_data = user_data_from_claims(claims)
+            if user_data is not None and not await async_has_outdated_profile(claims):
+                await self.cache_user_data(token, user_data)
+                return user_data
+
+        try:
+            # Awaited on pooled connections, together with the other sockets connecting meanwhile
+            user_data = await async_token_loader.load(token)
+
+            if user_data is not None:
+                await self.cache_user_data(token, user_data)
+                return user_data
+
+            remember_rejected_token(token)
+            return None
+        except LoadError as e:
+            print(f"Request failed: {e}")
+            if e.status_code < 500:
+                return None
+        except http_client.RequestError as e:
+            print(f"Request failed: {e}")
+
+        return get_stale_user_data(token)
+
+    async def cache_user_data(self, token, user_data):
         timeout = get_timeout_from_token(token)
 
         if timeout is not None:
-            cache_set(token + "_user_data", user_data, timeout=timeout)
+            await async_cache_set(token_cache_key(token, 'user_data'), user_data, timeout=timeout)
+            await async_index_user_token(user_data['id'], token, timeout)
             print(f"LOG: Cached data for user #{user_data.get('id')}")
     
-    async def is_player_in_lobby(self, user_id):
+    async def load_membership(self):
+        # The only read of the lobby, later changes arrive as lobby_membership events
         from lobbies.models import GameLobby
 
-        try:
-            lobby = await database_sync_to_async(GameLobby.objects.get)(identifier=self.lobby_identifier)
-            return user_id in lobby.players
-        except GameLobby.DoesNotExist:
-            return False
-        
-    async def is_spectator_in_lobby(self, user_id):
-        from lobbies.models import GameLobby
+        lobby = await database_sync_to_async(
+            GameLobby.objects.filter(identifier=self.lobby_identifier).values('players', 'spectators', 'broadcast').first
+        )()
+
+        self.players = set(lobby['players']) if lobby else set()
+        self.spectators = set(lobby['spectators']) if lobby else set()
+        self.broadcast = lobby['broadcast'] if lobby else False
 
-        try:
-            lobby = await database_sync_to_async(GameLobby.objects.get)(identifier=self.lobby_identifier)
-            return user_id in lobby.spectators 
-        except GameLobby.DoesNotExist:
-            return False
-    
     async def remove_user_from_lobby(self, user_id):
         from lobbies.models import GameLobby
 
@@ -175,6 +301,7 @@ class LobbyConsumer(AsyncJsonWebsocketConsumer):
             # If the lobby is empty - destroy it
             if not lobby.players and not lobby.spectators:
                 await database_sync_to_async(lobby.delete)()
+                await games.async_delete_game(self.room_group_name)
 
         except GameLobby.DoesNotExist:
             # Handle case where the lobby does not exist
@@ -0,0 +1,400 @@
+WHITE, BLACK = 0, 1
+PAWN, KNIGHT, BISHOP, ROOK, QUEEN, KING = range(6)
+
+PIECE_LETTERS = 'pnbrqk'
+
+# Squares are numbered a1 = 0, b1 = 1, ..., h8 = 63, bit n of a bitboard being square n
+FULL = (1 << 64) - 1
+RANK_1 = 0xFF
+RANK_3 = RANK_1 << 16
+RANK_6 = RANK_1 << 40
+RANK_8 = RANK_1 << 56
+DARK_SQUARES = 0xAA55AA55AA55AA55
+
+# Castling rights
+WHITE_SHORT, WHITE_LONG, BLACK_SHORT, BLACK_LONG = 1, 2, 4, 8
+
+START_FEN = 'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1'
+
+
+def step_table(offsets):
+    table = []
+    for sq in range(64):
+        file, rank = sq % 8, sq // 8
+        bb = 0
+        for df, dr in offsets:
+            if 0 <= file + df < 8 and 0 <= rank + dr < 8:
+                bb |= 1 << (sq + df + 8 * dr)
+        table.append(bb)
+    return table
+
+def ray_table(df, dr):
+    table = []
+    for sq in range(64):
+        file, rank = sq % 8 + df, sq // 8 + dr
+        bb = 0
+        while 0 <= file < 8 and 0 <= rank < 8:
+            bb |= 1 << (file + 8 * rank)
+            file, rank = file + df, rank + dr
+        table.append(bb)
+    return table
+
+
+KNIGHT_ATTACKS = step_table([(1, 2), (2, 1), (2, -1), (1, -2), (-1, -2), (-2, -1), (-2, 1), (-1, 2)])
+KING_ATTACKS = step_table([(1, 0), (1, 1), (0, 1), (-1, 1), (-1, 0), (-1, -1), (0, -1), (1, -1)])
+PAWN_ATTACKS = [step_table([(-1, 1), (1, 1)]), step_table([(-1, -1), (1, -1)])]
+
+# The nearest blocker on a ray towards higher squares is its lowest set bit, on a ray
+# towards lower squares its highest one
+NORTH, EAST, NORTH_EAST, NORTH_WEST = ray_table(0, 1), ray_table(1, 0), ray_table(1, 1), ray_table(-1, 1)
+SOUTH, WEST, SOUTH_WEST, SOUTH_EAST = ray_table(0, -1), ray_table(-1, 0), ray_table(-1, -1), ray_table(1, -1)
+
+# Rights lost when a move starts or ends on the square
+CASTLING_MASK = [15] * 64
+CASTLING_MASK[0] = 15 ^ WHITE_LONG
+CASTLING_MASK[4] = 15 ^ WHITE_SHORT ^ WHITE_LONG
+CASTLING_MASK[7] = 15 ^ WHITE_SHORT
+CASTLING_MASK[56] = 15 ^ BLACK_LONG
+CASTLING_MASK[60] = 15 ^ BLACK_SHORT ^ BLACK_LONG
+CASTLING_MASK[63] = 15 ^ BLACK_SHORT
+
+
+def bits(bb):
+    while bb:
+        low = bb & -bb
+        yield low.bit_length() - 1
+        bb ^= low
+
+def slide(sq, occupied, rising, falling):
+    attacks = 0
+
+    for rays in rising:
+        ray = rays[sq]
+        blockers = ray & occupied
+        if blockers:
+            ray ^= rays[(blockers & -blockers).bit_length() - 1]
+        attacks |= ray
+
+    for rays in falling:
+        ray = rays[sq]
+        blockers = ray & occupied
+        if blockers:
+            ray ^= rays[blockers.bit_length() - 1]
+        attacks |= ray
+
+    return attacks
+
+def bishop_attacks(sq, occupied):
+    return slide(sq, occupied, (NORTH_EAST, NORTH_WEST), (SOUTH_WEST, SOUTH_EAST))
+
+def rook_attacks(sq, occupied):
+    return slide(sq, occupied, (NORTH, EAST), (SOUTH, WEST))
+
+def square_name(sq):
+    return 'abcdefgh'[sq % 8] + str(sq // 8 + 1)
+
+def parse_square(name):
+    if len(name) != 2 or name[0] not in 'abcdefgh' or name[1] not in '12345678':
+        raise ValueError(f"Not a square: {name}")
+    return 'abcdefgh'.index(name[0]) + 8 * (int(name[1]) - 1)
+
+def parse_uci(text):
+    """
+    Turns a move like 'e2e4' or 'e7e8q' into (from, to, promotion), raising ValueError.
+    """
+    if not isinstance(text, str) or len(text) not in (4, 5):
+        raise ValueError(f"Not a move: {text!r}")
+
+    promotion = None
+    if len(text) == 5:
+        if text[4] not in 'nbrq':
+            raise ValueError(f"Not a promotion: {text!r}")
+        promotion = PIECE_LETTERS.index(text[4])
+
+    return parse_square(text[:2]), parse_square(text[2:4]), promotion
+
+def move_to_uci(move):
+    frm, to, promotion = move
+    return square_name(frm) + square_name(to) + (PIECE_LETTERS[promotion] if promotion is not None else '')
+
+
+class Position:
+    """
+    A chess position on bitboards: one per piece kind and one per colour.
+    Moves are (from, to, promotion) tuples. Only play() counts towards repetitions,
+    push() and pop() are for trying moves out.
+    """
+    __slots__ = ('pieces', 'colours', 'turn', 'castling', 'ep', 'halfmoves', 'fullmoves', 'seen')
+
+    def __init__(self, fen=START_FEN):
+        placement, turn, castling, ep, halfmoves, fullmoves = fen.split()
+
+        self.pieces = [0] * 6
+        self.colours = [0, 0]
+        for rank, row in enumerate(reversed(placement.split('/'))):
+            file = 0
+            for char in row:
+                if char.isdigit():
+                    file += int(char)
+                    continue
+                bit = 1 << (file + 8 * rank)
+                self.pieces[PIECE_LETTERS.index(char.lower())] |= bit
+                self.colours[WHITE if char.isupper() else BLACK] |= bit
+                file += 1
+
+        self.turn = WHITE if turn == 'w' else BLACK
+        self.castling = sum(right for right, char in zip((WHITE_SHORT, WHITE_LONG, BLACK_SHORT, BLACK_LONG), 'KQkq') if char in castling)
+        self.ep = None if ep == '-' else parse_square(ep)
+        self.halfmoves = int(halfmoves)
+        self.fullmoves = int(fullmoves)
+        self.seen = {self.key(): 1}
+
+    # Board queries
+
+    def piece_at(self, sq):
+        bit = 1 << sq
+        for kind in range(6):
+            if self.pieces[kind] & bit:
+                return kind
+        return None
+
+    def king(self, colour):
+        return (self.pieces[KING] & self.colours[colour]).bit_length() - 1
+
+    def is_attacked(self, sq, by):
+        pieces, attackers = self.pieces, self.colours[by]
+        occupied = self.colours[WHITE] | self.colours[BLACK]
+
+        return bool(
+            KNIGHT_ATTACKS[sq] & pieces[KNIGHT] & attackers
+            or KING_ATTACKS[sq] & pieces[KING] & attackers
+            or PAWN_ATTACKS[by ^ 1][sq] & pieces[PAWN] & attackers
+            or bishop_attacks(sq, occupied) & (pieces[BISHOP] | pieces[QUEEN]) & attackers
+            or rook_attacks(sq, occupied) & (pieces[ROOK] | pieces[QUEEN]) & attackers
+        )
+
+    def is_check(self):
+        return self.is_attacked(self.king(self.turn), self.turn ^ 1)
+
+    # Move generation
+
+    def pseudo_moves(self, sources=FULL):
+        """
+        Moves of the pieces on `sources` that may still leave their own king in check.
+        """
+        us, them = self.turn, self.turn ^ 1
+        own, enemy = self.colours[us], self.colours[them]
+        empty = ~(own | enemy) & FULL
+        pieces = self.pieces
+
+        pawns = pieces[PAWN] & own & sources
+        if us == WHITE:
+            single = (pawns << 8) & empty
+            double = ((single & RANK_3) << 8) & empty
+            forward, last_rank = 8, RANK_8
+        else:
+            single = (pawns >> 8) & empty
+            double = ((single & RANK_6) >> 8) & empty
+            forward, last_rank = -8, RANK_1
+
+        for to in bits(single):
+            yield from self.pawn_moves(to - forward, to, last_rank)
+        for to in bits(double):
+            yield to - 2 * forward, to, None
+
+        targets = enemy | (1 << self.ep if self.ep is not None else 0)
+        for frm in bits(pawns):
+            for to in bits(PAWN_ATTACKS[us][frm] & targets):
+                yield from self.pawn_moves(frm, to, last_rank)
+
+        for frm in bits(pieces[KNIGHT] & own & sources):
+            for to in bits(KNIGHT_ATTACKS[frm] & ~own):
+                yield frm, to, None
+
+        occupied = own | enemy
+        for frm in bits((pieces[BISHOP] | pieces[QUEEN]) & own & sources):
+            for to in bits(bishop_attacks(frm, occupied) & ~own):
+                yield frm, to, None
+
+        for frm in bits((pieces[ROOK] | pieces[QUEEN]) & own & sources):
+            for to in bits(rook_attacks(frm, occupied) & ~own):
+                yield frm, to, None
+
+        for frm in bits(pieces[KING] & own & sources):
+            for to in bits(KING_ATTACKS[frm] & ~own):
+                yield frm, to, None
+            yield from self.castling_moves(frm, occupied)
+
+    def pawn_moves(self, frm, to, last_rank):
+        if (1 << to) & last_rank:
+            for promotion in (QUEEN, ROOK, BISHOP, KNIGHT):
+                yield frm, to, promotion
+        else:
+            yield frm, to, None
+
+    def castling_moves(self, king, occupied):
+        us, them = self.turn, self.turn ^ 1
+        short, long = (WHITE_SHORT, WHITE_LONG) if us == WHITE else (BLACK_SHORT, BLACK_LONG)
+
+        if not self.castling & (short | long) or self.is_attacked(king, them):
+            return
+
+        # The king may not pass through an attacked square either
+        if self.castling & short and not occupied & (0b11 << king + 1) \
+                and not self.is_attacked(king + 1, them) and not self.is_attacked(king + 2, them):
+            yield king, king + 2, None
+
+        if self.castling & long and not occupied & (0b111 << king - 3) \
+                and not self.is_attacked(king - 1, them) and not self.is_attacked(king - 2, them):
+            yield king, king - 2, None
+
+    def is_legal(self, move):
+        us = self.turn
+
+        undo = self.push(move)
+        legal = not self.is_attacked(self.king(us), us ^ 1)
+        self.pop(undo)
+
+        return legal
+
+    def legal_moves(self, sources=FULL):
+        for move in self.pseudo_moves(sources):
+            if self.is_legal(move):
+                yield move
+
+    def has_legal_move(self):
+        return next(self.legal_moves(), None) is not None
+
+    def parse_move(self, text):
+        """
+        Returns the move for its UCI text if it is legal here, None otherwise.
+        Only the moves of the piece on the starting square are generated.
+        """
+        try:
+            move = parse_uci(text)
+        except ValueError:
+            return None
+
+        if move in self.pseudo_moves(1 << move[0]) and self.is_legal(move):
+            return move
+        return None
+
+    # Making moves
+
+    def push(self, move):
+        frm, to, promotion = move
+        us, them = self.turn, self.turn ^ 1
+        pieces, colours = self.pieces, self.colours
+
+        undo = (pieces[:], colours[:], self.castling, self.ep, self.halfmoves, self.fullmoves)
+
+        from_bit, to_bit = 1 << frm, 1 << to
+        kind = self.piece_at(frm)
+        captured = self.piece_at(to)
+
+        if captured is not None:
+            pieces[captured] ^= to_bit
+            colours[them] ^= to_bit
+
+        pieces[kind] ^= from_bit | to_bit
+        colours[us] ^= from_bit | to_bit
+
+        ep = None
+        if kind == PAWN:
+            if to == self.ep:
+                taken = 1 << (to - 8 if us == WHITE else to + 8)
+                pieces[PAWN] ^= taken
+                colours[them] ^= taken
+            elif abs(to - frm) == 16 and PAWN_ATTACKS[us][(frm + to) // 2] & pieces[PAWN] & colours[them]:
+                # Only kept when it can be taken, so it does not tell repetitions apart otherwise
+                ep = (frm + to) // 2
+
+            if promotion is not None:
+                pieces[PAWN] ^= to_bit
+                pieces[promotion] |= to_bit
+        elif kind == KING and abs(to - frm) == 2:
+            rook_from, rook_to = (frm + 3, frm + 1) if to > frm else (frm - 4, frm - 1)
+            rook = (1 << rook_from) | (1 << rook_to)
+            pieces[ROOK] ^= rook
+            colours[us] ^= rook
+
+        self.castling &= CASTLING_MASK[frm] & CASTLING_MASK[to]
+        self.ep = ep
+        self.halfmoves = 0 if kind == PAWN or captured is not None else self.halfmoves + 1
+        self.fullmoves += us
+        self.turn = them
+
+        return undo
+
+    def pop(self, undo):
+        self.pieces, self.colours, self.castling, self.ep, self.halfmoves, self.fullmoves = undo
+        self.turn ^= 1
+
+    def play(self, move):
+        self.push(move)
+
+        key = self.key()
+        self.seen[key] = self.seen.get(key, 0) + 1
+
+    def key(self):
+        return (*self.pieces, self.colours[WHITE], self.turn, self.castling, self.ep)
+
+    # Game end
+
+    def has_insufficient_material(self):
+        pieces = self.pieces
+        if pieces[PAWN] | pieces[ROOK] | pieces[QUEEN]:
+            return False
+
+        minors = pieces[KNIGHT] | pieces[BISHOP]
+        if minors.bit_count() <= 1:
+            return True
+
+        # Bishops alone, all on squares of one colour
+        return not pieces[KNIGHT] and (not pieces[BISHOP] & DARK_SQUARES or not pieces[BISHOP] & ~DARK_SQUARES)
+
+    def outcome(self):
+        """
+        Returns (result, termination) once the game is over, None while it is not.
+        The fifty move rule and threefold repetition end it right away, nobody claims them.
+        """
+        if not self.has_legal_move():
+            if self.is_check():
+                return ('0-1' if self.turn == WHITE else '1-0'), 'checkmate'
+            return '1/2-1/2', 'stalemate'
+
+        if self.has_insufficient_material():
+            return '1/2-1/2', 'insufficient material'
+        if self.halfmoves >= 100:
+            return '1/2-1/2', 'fifty moves'
+        if self.seen.get(self.key(), 0) >= 3:
+            return '1/2-1/2', 'threefold repetition'
+
+        return None
+
+    def fen(self):
+        rows = []
+        for rank in range(7, -1, -1):
+            row, empty = '', 0
+            for file in range(8):
+                sq = file + 8 * rank
+                kind = self.piece_at(sq)
+                if kind is None:
+                    empty += 1
+                    continue
+                if empty:
+                    row, empty = row + str(empty), 0
+                letter = PIECE_LETTERS[kind]
+                row += letter.upper() if self.colours[WHITE] >> sq & 1 else letter
+            rows.append(row + (str(empty) if empty else ''))
+
+        castling = ''.join(char for right, char in zip((WHITE_SHORT, WHITE_LONG, BLACK_SHORT, BLACK_LONG), 'KQkq') if self.castling & right)
+
+        return ' '.join((
+            '/'.join(rows),
+            'w' if self.turn == WHITE else 'b',
+            castling or '-',
+            square_name(self.ep) if self.ep is not None else '-',
+            str(self.halfmoves),
+            str(self.fullmoves),
+        ))
@@ -0,0 +1,252 @@
+import os
+import redis
+from collections import OrderedDict
+from django.db import DatabaseError
+from django.utils import timezone
+from channels.db import database_sync_to_async
+from sB.singleflight import AsyncSingleFlight
+from sB.utilities import rc, get_async_rc
+from .engine import Position, WHITE, parse_uci, move_to_uci
+
+
+# How long an abandoned game's moves are kept in Redis
+GAME_TTL_S = int(os.getenv('GAME_TTL_S', 86400))
+
+# Games a process keeps in memory, the least recently used ones are rebuilt from Redis
+MAX_LOCAL_GAMES = int(os.getenv('MAX_LOCAL_GAMES', 10000))
+
+# Appends the move only if the list holds exactly the moves it was validated after, so
+# every process and socket agrees on the order. The first move fixes the colours, the
+# first two record the players' names for the GameRecord.
+APPEND_MOVE_SCRIPT = """
+if redis.call('LLEN', KEYS[1]) ~= tonumber(ARGV[1]) then
+    return 0
+end
+if ARGV[1] == '0' then
+    redis.call('HSET', KEYS[2], 'white', ARGV[3], 'black', ARGV[4], 'white_name', ARGV[5])
+elseif ARGV[1] == '1' then
+    redis.call('HSET', KEYS[2], 'black_name', ARGV[5])
+end
+redis.call('RPUSH', KEYS[1], ARGV[2])
+redis.call('EXPIRE', KEYS[1], ARGV[6])
+redis.call('EXPIRE', KEYS[2], ARGV[6])
+return 1
+"""
+
+
+class IllegalMove(Exception):
+    pass
+
+
+class GameState:
+    """
+    A lobby's game as this process knows it. Redis holds its moves and colours, so any
+    process can rebuild it and it may be dropped whenever it falls behind.
+    """
+    __slots__ = ('position', 'moves', 'white', 'black', 'outcome')
+
+    def __init__(self, moves=(), white=None, black=None):
+        self.position = Position()
+        self.moves = []
+        self.white = white
+        self.black = black
+        self.outcome = None
+
+        for uci in moves:
+            self.play(parse_uci(uci))
+
+    @property
+    def ply(self):
+        return len(self.moves)
+
+    def play(self, move):
+        self.position.play(move)
+        self.moves.append(move_to_uci(move))
+        self.outcome = self.position.outcome()
+
+    def info(self):
+        # Everything a client needs to show the board without validating anything itself
+        result, termination = self.outcome or (None, None)
+        return {
+            'ply': self.ply,
+            'move': self.moves[-1] if self.moves else None,
+            'fen': self.position.fen(),
+            'check': self.position.is_check(),
+            'white': self.white,
+            'black': self.black,
+            'result': result,
+            'termination': termination,
+        }
+
+
+games = OrderedDict()   # group name -> GameState of this process, least recently used first
+loading = {}            # group name -> game infos received while it was being loaded
+loads = AsyncSingleFlight()
+
+def moves_key(group_name):
+    return f'game:{{{group_name}}}:moves'
+
+def players_key(group_name):
+    return f'game:{{{group_name}}}:players'
+
+def remember_game(group_name, game):
+    games[group_name] = game
+    games.move_to_end(group_name)
+
+    while len(games) > MAX_LOCAL_GAMES:
+        games.popitem(last=False)
+
+def forget_game(group_name):
+    games.pop(group_name, None)
+
+def delete_game(group_name):
+    """
+    Deletes the game of a lobby that was destroyed, so a new lobby with the same
+    identifier starts from scratch. Other processes drop their copies on its 'close'.
+    """
+    forget_game(group_name)
+
+    try:
+        rc.delete(moves_key(group_name), players_key(group_name))
+    except redis.RedisError as e:
+        print(f"LOG: Could not delete the game of {group_name}: {e}")
+
+async def async_delete_game(group_name):
+    forget_game(group_name)
+
+    try:
+        await get_async_rc().delete(moves_key(group_name), players_key(group_name))
+    except redis.RedisError as e:
+        print(f"LOG: Could not delete the game of {group_name}: {e}")
+
+async def get_game(group_name):
+    game = games.get(group_name)
+    if game is not None:
+        games.move_to_end(group_name)
+        return game
+
+    return await loads.do(group_name, lambda: load_game(group_name))
+
+async def load_game(group_name):
+    loading[group_name] = []
+
+    try:
+        # Both keys share the hash tag, so this is one round trip to one node
+        pipe = get_async_rc().pipeline()
+        pipe.lrange(moves_key(group_name), 0, -1)
+        pipe.hmget(players_key(group_name), 'white', 'black')
+        moves, (white, black) = await pipe.execute()
+
+        game = GameState(
+            [move.decode('ascii') for move in moves],
+            int(white) if white else None,
+            int(black) if black else None
+        )
+
+        # Moves announced while the reply was on its way
+        for info in loading[group_name]:
+            if info['ply'] == game.ply + 1:
+                apply_info(game, info)
+    finally:
+        del loading[group_name]
+
+    remember_game(group_name, game)
+    return game
+
+def apply_info(game, info):
+    if info['ply'] == 1:
+        game.white, game.black = info['white'], info['black']
+    game.play(parse_uci(info['move']))
+
+def apply_event(group_name, info):
+    """
+    Plays a move announced to the lobby group on this process's copy of the game.
+    Every consumer of the lobby calls it, only the first call for a move plays it.
+    """
+    if group_name in loading:
+        loading[group_name].append(info)
+        return
+
+    game = games.get(group_name)
+    if game is None or info['ply'] <= game.ply:
+        return
+
+    if info['ply'] == game.ply + 1:
+        apply_info(game, info)
+    else:
+        # A move was missed, the game is rebuilt from Redis the next time it is needed
+        forget_game(group_name)
+
+async def play_move(group_name, user_id, username, text, players):
+    """
+    Validates the user's move and plays it. Returns the event announcing it to the
+    lobby group, or raises IllegalMove with the reason it was refused.
+    """
+    game = await get_game(group_name)
+
+    if game.outcome is not None:
+        raise IllegalMove("The game is over.")
+
+    white, black = game.white, game.black
+    if white is None:
+        # Whoever moves first plays white
+        opponents = players - {user_id}
+        if len(opponents) != 1:
+            raise IllegalMove("The game starts once both players are in the lobby.")
+        white, black = user_id, next(iter(opponents))
+
+    if user_id != (white if game.position.turn == WHITE else black):
+        raise IllegalMove("It is not your turn.")
+
+    move = game.position.parse_move(text)
+    if move is None:
+        raise IllegalMove("Illegal move.")
+
+    appended = await get_async_rc().eval(
+        APPEND_MOVE_SCRIPT, 2, moves_key(group_name), players_key(group_name),
+        game.ply, move_to_uci(move), white, black, username, GAME_TTL_S
+    )
+    if not appended:
+        # Another socket moved first, or this copy had fallen behind
+        forget_game(group_name)
+        raise IllegalMove("The board changed meanwhile, try again.")
+
+    game.white, game.black = white, black
+    game.play(move)
+
+    if game.outcome is not None:
+        await export_game(group_name, game)
+
+    return {
+        'type': 'move_message',
+        'message': f"{username}: {game.moves[-1]}",
+        'game': game.info()
+    }
+
+async def export_game(group_name, game):
+    # Only the socket that made the final move gets here, so it is saved once
+    from records.models import GameRecord
+
+    try:
+        white_name, black_name = await get_async_rc().hmget(players_key(group_name), 'white_name', 'black_name')
+    except redis.RedisError as e:
+        print(f"LOG: Could not load the player names of {group_name}: {e}")
+        white_name = black_name = None
+
+    try:
+        record = await database_sync_to_async(GameRecord.objects.create)(
+            white_player=player_name(white_name, game.white),
+            black_player=player_name(black_name, game.black),
+            moves=game.moves,
+            finished_at=timezone.now()
+        )
+        print(f"LOG: Saved game record #{record.id} of {group_name}: {game.outcome[0]} by {game.outcome[1]}")
+    except DatabaseError as e:
+        print(f"LOG: Could not save the game of {group_name}: {e}")
+
+def player_name(name, user_id):
+    # The names are gone if the players' hash expired or was deleted meanwhile
+    return name.decode('utf-8') if name else f'user#{user_id}'
+
+def get_stats():
+    return {'local_games': len(games), 'loads': loads.stats()}
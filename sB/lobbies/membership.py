@@ -0,0 +1,24 @@
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+import redis
+
+
+def get_group_name(lobby_identifier):
+    return f'lobby_{lobby_identifier}'
+
+def membership_event(action, user_id=None, role=None):
+    """
+    Tells the lobby's consumers that a user joined as `role` ('player' or 'spectator')
+    or left, so they never re-read the lobby. 'close' means the lobby was deleted.
+    """
+    return {'type': 'lobby_membership', 'action': action, 'user_id': user_id, 'role': role}
+
+def announce_membership(lobby_identifier, action, user_id=None, role=None):
+    # For sync views. The change is already saved, connecting sockets read it from the DB.
+    try:
+        async_to_sync(get_channel_layer().group_send)(
+            get_group_name(lobby_identifier),
+            membership_event(action, user_id, role)
+        )
+    except redis.RedisError as e:
+        print(f"LOG: Could not announce {action} of user#{user_id} in lobby {lobby_identifier}: {e}")
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.1 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lobbies', '0003_gamelobby_connect_url'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='gamelobby',
+            name='broadcast',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -35,6 +35,9 @@ class GameLobby(models.Model):
 
     rating = models.IntegerField(blank=True)
 
+    # Featured games: spectators are served through per-process relays
+    broadcast = models.BooleanField(default=False)
+
     def save(self, *args, **kwargs):
         service_ip = get_docker_container_ip()
         service_port = os.getenv('PORT')
@@ -5,7 +5,13 @@ from .models import GameLobby
 class GameLobbySerializer(serializers.ModelSerializer):
     class Meta:
         model = GameLobby
-        fields = ['id', 'identifier', 'players', 'spectators', 'rating']
+        fields = ['id', 'identifier', 'players', 'spectators', 'rating', 'broadcast']
+
+
+class GameLobbyBroadcastSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = GameLobby
+        fields = ['broadcast']
 
 
 class GameLobbyListSerialzer(serializers.ModelSerializer):
@@ -1,3 +1,397 @@
-from django.test import TestCase
+import asyncio
+from django.test import SimpleTestCase
+from unittest.mock import patch, MagicMock, AsyncMock
+from records.models import GameRecord
+from lobbies import games, broadcast
+from lobbies.consumers import LobbyConsumer
+from lobbies.membership import membership_event
+from lobbies.views import GameLobbyDestroyView
+from lobbies.engine import Position, parse_uci
 
-# Create your tests here.
+
+START_FEN = 'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1'
+KIWIPETE_FEN = 'r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1'
+PROMOTIONS_FEN = 'r3k2r/Pppp1ppp/1b3nbN/nP6/BBP1P3/q4N2/Pp1P2PP/R2Q1RK1 w kq - 0 1'
+
+FOOLS_MATE = ['f2f3', 'e7e5', 'g2g4', 'd8h4']
+
+
+def perft(position, depth):
+    if depth == 0:
+        return 1
+
+    nodes = 0
+    for move in list(position.legal_moves()):
+        undo = position.push(move)
+        nodes += perft(position, depth - 1)
+        position.pop(undo)
+
+    return nodes
+
+def play(position, moves):
+    for text in moves:
+        move = position.parse_move(text)
+        assert move is not None, text
+        position.play(move)
+    return position
+
+
+class PositionTest(SimpleTestCase):
+    def test_perft_start_position(self):
+        for depth, nodes in ((1, 20), (2, 400), (3, 8902)):
+            self.assertEqual(perft(Position(START_FEN), depth), nodes)
+
+    def test_perft_kiwipete(self):
+        # Castling both ways, en passant, pins and promotions
+        for depth, nodes in ((1, 48), (2, 2039), (3, 97862)):
+            self.assertEqual(perft(Position(KIWIPETE_FEN), depth), nodes)
+
+    def test_perft_promotions(self):
+        for depth, nodes in ((1, 6), (2, 264), (3, 9467)):
+            self.assertEqual(perft(Position(PROMOTIONS_FEN), depth), nodes)
+
+    def test_parse_move(self):
+        position = Position()
+
+        self.assertEqual(position.parse_move('e2e4'), parse_uci('e2e4'))
+        self.assertIsNone(position.parse_move('e2e5'))
+        self.assertIsNone(position.parse_move('e7e5'))
+        self.assertIsNone(position.parse_move('z9e4'))
+        self.assertIsNone(position.parse_move(None))
+
+    def test_pinned_piece_cannot_move(self):
+        position = Position('4k3/4r3/8/8/8/8/4R3/4K3 w - - 0 1')
+
+        self.assertIsNone(position.parse_move('e2d2'))
+        self.assertIsNotNone(position.parse_move('e2e7'))
+
+    def test_special_moves(self):
+        position = play(Position(), ['e2e4', 'a7a6', 'e4e5', 'd7d5', 'e5d6'])
+        self.assertEqual(position.fen(), 'rnbqkbnr/1pp1pppp/p2P4/8/8/8/PPPP1PPP/RNBQKBNR b KQkq - 0 3')
+
+        position = play(Position('r3k2r/8/8/8/8/8/8/R3K2R w KQkq - 0 1'), ['e1g1', 'e8c8'])
+        self.assertEqual(position.fen(), '2kr3r/8/8/8/8/8/8/R4RK1 w - - 2 2')
+
+        position = play(Position('8/P7/8/8/8/8/8/k6K w - - 0 1'), ['a7a8n'])
+        self.assertEqual(position.fen(), 'N7/8/8/8/8/8/8/k6K b - - 0 1')
+
+    def test_ongoing_game(self):
+        self.assertIsNone(play(Position(), ['e2e4', 'e7e5']).outcome())
+
+    def test_checkmate(self):
+        position = play(Position(), FOOLS_MATE)
+
+        self.assertTrue(position.is_check())
+        self.assertEqual(position.outcome(), ('0-1', 'checkmate'))
+
+    def test_stalemate(self):
+        position = play(Position('7k/8/5QK1/8/8/8/8/8 w - - 0 1'), ['f6f7'])
+
+        self.assertFalse(position.is_check())
+        self.assertEqual(position.outcome(), ('1/2-1/2', 'stalemate'))
+
+    def test_fifty_moves(self):
+        position = Position('4k3/8/8/8/8/8/8/R3K3 w - - 99 80')
+        self.assertIsNone(position.outcome())
+
+        play(position, ['a1a2'])
+        self.assertEqual(position.outcome(), ('1/2-1/2', 'fifty moves'))
+
+    def test_threefold_repetition(self):
+        position = play(Position(), ['g1f3', 'g8f6', 'f3g1', 'f6g8'])
+        self.assertIsNone(position.outcome())
+
+        play(position, ['g1f3', 'g8f6', 'f3g1', 'f6g8'])
+        self.assertEqual(position.outcome(), ('1/2-1/2', 'threefold repetition'))
+
+    def test_insufficient_material(self):
+        self.assertEqual(Position('8/8/8/4k3/8/8/2B5/4K3 w - - 0 1').outcome(), ('1/2-1/2', 'insufficient material'))
+        self.assertIsNone(Position('8/8/8/4k3/8/8/2R5/4K3 w - - 0 1').outcome())
+
+
+class FakeRedis:
+    """
+    Just enough of the Redis cluster client for the games module, APPEND_MOVE_SCRIPT included.
+    """
+
+    def __init__(self):
+        self.lists = {}
+        self.hashes = {}
+
+    async def eval(self, script, numkeys, moves_key, players_key, ply, move, white, black, username, ttl):
+        moves = self.lists.setdefault(moves_key, [])
+        if len(moves) != ply:
+            return 0
+
+        players = self.hashes.setdefault(players_key, {})
+        if ply == 0:
+            players.update(white=str(white).encode(), black=str(black).encode(), white_name=username.encode())
+        elif ply == 1:
+            players['black_name'] = username.encode()
+
+        moves.append(move.encode())
+        return 1
+
+    async def hmget(self, key, *fields):
+        return [self.hashes.get(key, {}).get(field) for field in fields]
+
+    async def delete(self, *keys):
+        for key in keys:
+            self.lists.pop(key, None)
+            self.hashes.pop(key, None)
+
+    def pipeline(self):
+        return FakePipeline(self)
+
+
+class FakePipeline:
+    def __init__(self, client):
+        self.client = client
+        self.calls = []
+
+    def lrange(self, key, start, end):
+        self.calls.append(lambda: list(self.client.lists.get(key, [])))
+
+    def hmget(self, key, *fields):
+        self.calls.append(lambda: [self.client.hashes.get(key, {}).get(field) for field in fields])
+
+    async def execute(self):
+        return [call() for call in self.calls]
+
+
+class PlayMoveTest(SimpleTestCase):
+    GROUP = 'lobby_testgame'
+    PLAYERS = {1, 2}
+
+    def setUp(self):
+        games.games.clear()
+        self.redis = FakeRedis()
+
+        patcher = patch('lobbies.games.get_async_rc', return_value=self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        patcher = patch.object(GameRecord.objects, 'create', return_value=MagicMock(id=1))
+        self.mock_create = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def play(self, user_id, text):
+        return await games.play_move(self.GROUP, user_id, f'u{user_id}', text, self.PLAYERS)
+
+    async def test_first_mover_plays_white(self):
+        event = await self.play(2, 'e2e4')
+
+        self.assertEqual(event['type'], 'move_message')
+        self.assertEqual(event['game']['ply'], 1)
+        self.assertEqual((event['game']['white'], event['game']['black']), (2, 1))
+
+    async def test_game_needs_both_players(self):
+        with self.assertRaisesMessage(games.IllegalMove, "both players"):
+            await games.play_move(self.GROUP, 1, 'u1', 'e2e4', {1})
+
+    async def test_out_of_turn_move_is_rejected(self):
+        await self.play(1, 'e2e4')
+
+        with self.assertRaisesMessage(games.IllegalMove, "not your turn"):
+            await self.play(1, 'd2d4')
+
+    async def test_wrong_colour_move_is_rejected(self):
+        await self.play(1, 'e2e4')
+
+        # Black trying to move one of white's pawns
+        with self.assertRaisesMessage(games.IllegalMove, "Illegal move"):
+            await self.play(2, 'd2d4')
+
+    async def test_move_after_game_end_is_rejected(self):
+        for user_id, text in zip((1, 2, 1, 2), FOOLS_MATE):
+            event = await self.play(user_id, text)
+
+        self.assertEqual((event['game']['result'], event['game']['termination']), ('0-1', 'checkmate'))
+        self.mock_create.assert_called_once()
+        self.assertEqual(self.mock_create.call_args.kwargs['moves'], FOOLS_MATE)
+        self.assertEqual(self.mock_create.call_args.kwargs['white_player'], 'u1')
+        self.assertEqual(self.mock_create.call_args.kwargs['black_player'], 'u2')
+
+        with self.assertRaisesMessage(games.IllegalMove, "game is over"):
+            await self.play(1, 'e2e4')
+
+    async def test_game_without_names_is_saved(self):
+        for user_id, text in zip((1, 2, 1), FOOLS_MATE):
+            await self.play(user_id, text)
+
+        self.redis.hashes[games.players_key(self.GROUP)].pop('white_name')
+        await self.play(2, FOOLS_MATE[-1])
+
+        self.assertEqual(self.mock_create.call_args.kwargs['white_player'], 'user#1')
+        self.assertEqual(self.mock_create.call_args.kwargs['black_player'], 'u2')
+
+    async def test_deleted_game_starts_over(self):
+        await self.play(1, 'e2e4')
+
+        # A new lobby reusing the identifier
+        await games.async_delete_game(self.GROUP)
+
+        self.assertNotIn(self.GROUP, games.games)
+        game = await games.get_game(self.GROUP)
+        self.assertEqual((game.moves, game.white), ([], None))
+
+        event = await self.play(2, 'e2e4')
+        self.assertEqual((event['game']['white'], event['game']['black']), (2, 1))
+
+    async def test_stale_copy_is_rebuilt(self):
+        await self.play(1, 'e2e4')
+
+        # Another process played a move this one never heard of
+        self.redis.lists[games.moves_key(self.GROUP)].append(b'e7e5')
+
+        with self.assertRaisesMessage(games.IllegalMove, "changed meanwhile"):
+            await self.play(2, 'd7d5')
+
+        with self.assertRaisesMessage(games.IllegalMove, "not your turn"):
+            await self.play(2, 'd7d5')
+
+        event = await self.play(1, 'd2d4')
+        self.assertEqual(event['game']['ply'], 3)
+
+    async def test_announced_moves_are_applied_once(self):
+        event = await self.play(1, 'e2e4')
+
+        # Every consumer of the lobby in the process gets the event
+        games.apply_event(self.GROUP, event['game'])
+        games.apply_event(self.GROUP, event['game'])
+
+        game = await games.get_game(self.GROUP)
+        self.assertEqual(game.moves, ['e2e4'])
+
+        # A gap means a missed move, the copy is rebuilt from Redis
+        games.apply_event(self.GROUP, {**event['game'], 'ply': 3})
+        self.assertNotIn(self.GROUP, games.games)
+
+
+def make_consumer(players=(), spectators=()):
+    consumer = LobbyConsumer()
+    consumer.room_group_name = 'lobby_closed'
+    consumer.players = set(players)
+    consumer.spectators = set(spectators)
+    consumer.send_error = AsyncMock()
+    consumer.close = AsyncMock()
+    return consumer
+
+
+class LobbyClosedTest(SimpleTestCase):
+    async def test_consumer_closes(self):
+        consumer = make_consumer({1, 2}, {3})
+
+        await consumer.lobby_membership(membership_event('close'))
+
+        self.assertEqual((consumer.players, consumer.spectators), (set(), set()))
+        consumer.send_error.assert_awaited_once_with("The lobby was closed.")
+        consumer.close.assert_awaited_once()
+
+    async def test_hub_closes_its_spectators(self):
+        hub = broadcast.BroadcastHub(MagicMock(), 'lobby_closed', {1, 2}, {3, 4})
+        consumers = [make_consumer(), make_consumer()]
+        for consumer in consumers:
+            hub.subscribe(consumer)
+
+        hub.dispatch(membership_event('close'))
+        await asyncio.sleep(0)
+
+        for consumer in consumers:
+            consumer.close.assert_awaited_once()
+            await hub.unsubscribe(consumer)
+
+    def test_destroy_announces(self):
+        lobby = MagicMock(identifier='abc')
+
+        with patch('lobbies.views.announce_membership') as announce, patch('lobbies.games.rc') as rc:
+            GameLobbyDestroyView().perform_destroy(lobby)
+
+        lobby.delete.assert_called_once()
+        announce.assert_called_once_with('abc', 'close')
+        rc.delete.assert_called_once_with(games.moves_key('lobby_abc'), games.players_key('lobby_abc'))
+
+
+async def settle():
+    # Lets the relay and writer tasks run
+    for _ in range(10):
+        await asyncio.sleep(0)
+
+
+class BroadcastHubTest(SimpleTestCase):
+    def setUp(self):
+        patcher = patch('lobbies.broadcast.BROADCAST_SHARD_SIZE', 2)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def make_hub(self):
+        return broadcast.BroadcastHub(MagicMock(), 'lobby_broadcast', {1, 2}, set())
+
+    def make_spectator(self):
+        consumer = make_consumer()
+        consumer.send = AsyncMock()
+        return consumer
+
+    async def test_frames_reach_every_shard(self):
+        hub = self.make_hub()
+        consumers = [self.make_spectator() for _ in range(5)]
+        for consumer in consumers:
+            hub.subscribe(consumer)
+
+        self.assertEqual([len(shard.subscribers) for shard in hub.shards], [2, 2, 1])
+
+        hub.relay('frame')
+        await settle()
+
+        for consumer in consumers:
+            consumer.send.assert_awaited_once_with(text_data='frame')
+            await hub.unsubscribe(consumer)
+
+    async def test_unsubscribe(self):
+        hub = self.make_hub()
+        first, second, third = consumers = [self.make_spectator() for _ in range(3)]
+        for consumer in consumers:
+            hub.subscribe(consumer)
+        full_shard = hub.shards[0]
+
+        # A shard goes with its last spectator
+        await hub.unsubscribe(third)
+        self.assertEqual(hub.shards, [full_shard])
+
+        await hub.unsubscribe(first)
+        self.assertEqual(hub.shards, [full_shard])
+        self.assertFalse(hub.stopped)
+
+        # The hub goes with the last spectator of the process
+        await hub.unsubscribe(second)
+        await settle()
+        self.assertEqual(hub.shards, [])
+        self.assertTrue(hub.stopped)
+        self.assertTrue(full_shard.relay.cancelled())
+
+        hub.relay('frame')
+        await settle()
+        for consumer in consumers:
+            consumer.send.assert_not_awaited()
+
+    async def test_broken_spectator_is_dropped(self):
+        hub = self.make_hub()
+        broken, healthy = self.make_spectator(), self.make_spectator()
+        broken.send.side_effect = ConnectionError("gone")
+        hub.subscribe(broken)
+        hub.subscribe(healthy)
+
+        hub.relay('first')
+        await settle()
+
+        broken.close.assert_awaited_once()
+        self.assertNotIn(broken, hub.subscriptions)
+        self.assertEqual(hub.failures, 1)
+
+        # The others are not held up by it
+        hub.relay('second')
+        await settle()
+        self.assertEqual([call.kwargs['text_data'] for call in healthy.send.await_args_list], ['first', 'second'])
+        broken.send.assert_awaited_once()
+
+        await hub.unsubscribe(healthy)
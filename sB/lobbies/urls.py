@@ -1,10 +1,11 @@
 from django.urls import path
-from .views import GameLobbyListView, GameLobbyDestroyView, CreateGameLobbyView, DiscoverGamesyLobbiesByRatingView, ConnectToGameLobbyView, DiscoverGamesyLobbiesWithFriendsView
+from .views import GameLobbyListView, GameLobbyDestroyView, GameLobbyBroadcastView, CreateGameLobbyView, DiscoverGamesyLobbiesByRatingView, ConnectToGameLobbyView, DiscoverGamesyLobbiesWithFriendsView
 
 
 urlpatterns = [
     path('list',GameLobbyListView.as_view(), name='gl-list'),
     path('<int:pk>/destroy', GameLobbyDestroyView.as_view(), name='gl-destroy'),
+    path('<int:pk>/broadcast', GameLobbyBroadcastView.as_view(), name='gl-broadcast'),
     path('create', CreateGameLobbyView.as_view(), name='gl-create'),
     path('discover/rating', DiscoverGamesyLobbiesByRatingView.as_view(), name='dl-discover-rating'),
     path('discover/friends', DiscoverGamesyLobbiesWithFriendsView.as_view(), name='dl-discover-friends'),
@@ -1,31 +1,33 @@
 from rest_framework import generics, status
 from .models import GameLobby
-from .serializers import GameLobbySerializer, CreateGameLobbySerializer, GameLobbyListSerialzer, ConnectToGameLobbySerializer
+from .serializers import GameLobbySerializer, CreateGameLobbySerializer, GameLobbyListSerialzer, ConnectToGameLobbySerializer, GameLobbyBroadcastSerializer
 from django.db.models import Q
 from rest_framework.response import Response
 from rest_framework.exceptions import ValidationError, NotFound
 from sB.permissions import ProvidesValidRootPassword, ValidateTokenWithServiceA
-import requests
 import os
-from sB.utilities import get_timeout_from_token, cache_get, cache_set
+from sB import http_client
+from sB.utilities import get_timeout_from_token, cache_get, cache_set, cache_get_stale, token_cache_key, index_user_token
 from rest_framework.exceptions import APIException
+from .membership import announce_membership, get_group_name
+from . import games
 
 
 def get_new_access_token(user_id):
     try:
-        service_a_url = f"{os.getenv('API_GATEWAY_BASE_URL')}sA/api/authen/token/{user_id}"
+        service_a_path = f"sA/api/authen/token/{user_id}"
         headers = {
             'X-Root-Password': os.getenv('ROOT_PASSWORD')
         }
 
-        response = requests.get(service_a_url, headers=headers)
+        response = http_client.get(service_a_path, headers=headers)
 
         if response.status_code == 200:
             return response.json().get('access')
         else:
             raise APIException(f"Failed to get a new token from A: {response.status_code}, {response.text}")
     
-    except requests.RequestException as e:
+    except http_client.RequestError as e:
         raise APIException(f"Error communicating with Service A: {str(e)}")
 
 
@@ -81,32 +83,47 @@ class DiscoverGamesyLobbiesByRatingView(generics.ListAPIView):
 class DiscoverGamesyLobbiesWithFriendsView(generics.ListAPIView):
     serializer_class = GameLobbyListSerialzer
     permission_classes = [ValidateTokenWithServiceA]
+    token_cache_prefetch = ('friends_ids',)
 
     def get_queryset(self):
         token = self.request.headers.get('Authorization').split(' ')[1]
 
-        cached_friends_ids = cache_get(token + "_friends_ids")
+        # Already fetched by the permission check, in the same round trip as the user data
+        token_cache = getattr(self.request, 'token_cache', None)
+        if token_cache is not None:
+            cached_friends_ids = token_cache.get('friends_ids')
+        else:
+            cached_friends_ids = cache_get(token_cache_key(token, 'friends_ids'))
         if cached_friends_ids is not None:
-            print(f"LOG: Using cached friends IDs for token: {token}")
+            print(f"LOG: Using cached friends IDs for user#{self.request.user_data.get('id')}")
             friends_ids = cached_friends_ids
         else:
             # Retrieve the list of friend IDs from service A
-            friends_ids_response = requests.get(
-                f'{os.getenv('API_GATEWAY_BASE_URL')}sA/api/friends/get-ids',
-                headers={
-                    'Authorization': f"Bearer {token}",
-                    'X-Root-Password': os.getenv('ROOT_PASSWORD')
-                }
-            )
+            try:
+                friends_ids_response = http_client.get(
+                    'sA/api/friends/get-ids',
+                    headers={
+                        'Authorization': f"Bearer {token}",
+                        'X-Root-Password': os.getenv('ROOT_PASSWORD')
+                    }
+                )
+            except http_client.RequestError as e:
+                print(f"Request failed: {e}")
+                friends_ids_response = None
             
-            if friends_ids_response.status_code == 200:
+            if friends_ids_response is None or friends_ids_response.status_code >= 500:
+                # Service A is unavailable, a recently expired list beats none at all
+                friends_ids = cache_get_stale(token_cache_key(token, 'friends_ids')) or []
+
+            elif friends_ids_response.status_code == 200:
                 friends_ids = friends_ids_response.json().get('friends', [])
                 
                 # Cache the friend IDs with the appropriate timeout
                 timeout = get_timeout_from_token(token)  # Use the timeout function
                 if timeout is not None:
-                    cache_set(token + "_friends_ids", friends_ids, timeout=timeout)
-                    print(f"LOG: Cached friends IDs for user token: {token}")
+                    cache_set(token_cache_key(token, 'friends_ids'), friends_ids, timeout=timeout)
+                    index_user_token(self.request.user_data['id'], token, timeout)
+                    print(f"LOG: Cached friends IDs for user#{self.request.user_data.get('id')}")
 
             else:
                 friends_ids = []
@@ -186,6 +203,8 @@ class ConnectToGameLobbyView(generics.UpdateAPIView):
             )
 
         lobby.save()
+        announce_membership(lobby.identifier, 'join', user_id, 'player' if is_player else 'spectator')
+
         return Response(
             {
                 'lobby': self.get_serializer(lobby).data,
@@ -195,11 +214,30 @@ class ConnectToGameLobbyView(generics.UpdateAPIView):
         )
     
 
+class GameLobbyBroadcastView(generics.UpdateAPIView):
+    """
+    Turns broadcast mode on or off for a featured lobby. Spectators already connected
+    keep the mode they connected with.
+    """
+    queryset = GameLobby.objects.all()
+    serializer_class = GameLobbyBroadcastSerializer
+    permission_classes = [ProvidesValidRootPassword]
+    http_method_names = ['patch']
+
+
 class GameLobbyDestroyView(generics.DestroyAPIView):
     queryset = GameLobby.objects.all()
     serializer_class = GameLobbySerializer
     permission_classes = [ProvidesValidRootPassword]
 
+    def perform_destroy(self, instance):
+        identifier = instance.identifier
+        instance.delete()
+
+        # Connected sockets would otherwise keep playing in a lobby that is gone
+        games.delete_game(get_group_name(identifier))
+        announce_membership(identifier, 'close')
+
     def delete(self, request, *args, **kwargs):
         super().delete(request, *args, **kwargs)
 
@@ -20,6 +20,7 @@ from django.core.asgi import get_asgi_application
 from channels.routing import ProtocolTypeRouter, URLRouter
 from channels.auth import AuthMiddlewareStack
 from lobbies.routing import websocket_urlpatterns
+from sB import user_events, http_client
 
 
 application = ProtocolTypeRouter({
@@ -30,3 +31,10 @@ application = ProtocolTypeRouter({
         )
     ),
 })
+
+# Cached user data is evicted as soon as sA announces a change
+user_events.start()
+
+# The registry is read in the background, so it is ready before the first call to sA
+for resolver in http_client.resolvers.values():
+    resolver.start()
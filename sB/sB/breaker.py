@@ -0,0 +1,78 @@
+import time
+import threading
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    """
+    Stops calling a dependency after `failure_threshold` failed calls in a row. After
+    `open_s` seconds one probe call is let through (half-open): its success closes the
+    circuit again, its failure keeps it open for another `open_s`.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name, failure_threshold=5, open_s=10):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.open_s = open_s
+
+        self.lock = threading.Lock()
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0
+        self.probing = False
+
+        self.rejected = 0
+        self.times_opened = 0
+
+    def allow(self):
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.open_s:
+                self.state = self.HALF_OPEN
+
+            if self.state == self.HALF_OPEN and not self.probing:
+                self.probing = True
+                return True
+
+            self.rejected += 1
+            return False
+
+    def check(self):
+        if not self.allow():
+            raise CircuitOpenError(f"Calls to {self.name} are suspended, the circuit is open")
+
+    def record(self, ok):
+        with self.lock:
+            if self.state == self.HALF_OPEN:
+                self.probing = False
+
+            if ok:
+                if self.state != self.CLOSED:
+                    print(f"LOG: Circuit to {self.name} closed")
+                self.state = self.CLOSED
+                self.consecutive_failures = 0
+                return
+
+            self.consecutive_failures += 1
+            if self.state == self.HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+                if self.state == self.CLOSED:
+                    self.times_opened += 1
+                    print(f"LOG: Circuit to {self.name} opened after {self.consecutive_failures} failures")
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+    def stats(self):
+        return {
+            'state': self.state,
+            'consecutive_failures': self.consecutive_failures,
+            'times_opened': self.times_opened,
+            'rejected': self.rejected,
+        }
@@ -0,0 +1,333 @@
+import time
+import uuid
+import asyncio
+import weakref
+from redis.asyncio.cluster import RedisCluster as AsyncRedis
+from channels.layers import BaseChannelLayer
+from channels.exceptions import ChannelFull
+from sB import codec
+
+
+# Appends to a list unless it already holds `capacity` entries (0 meaning unbounded)
+PUSH_SCRIPT = """
+if tonumber(ARGV[2]) > 0 and redis.call('LLEN', KEYS[1]) >= tonumber(ARGV[2]) then
+    return 0
+end
+redis.call('RPUSH', KEYS[1], ARGV[1])
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+return 1
+"""
+
+
+class LoopState:
+    # Clients and tasks are bound to the event loop they were created in
+    def __init__(self, client):
+        self.client = client
+        self.outbox = []        # (key, entry, capacity, future) waiting to be pipelined
+        self.flush_scheduled = False
+        self.reader = None
+
+
+class RedisClusterChannelLayer(BaseChannelLayer):
+    """
+    Channel layer on the Redis cluster, so that a lobby's sockets can be spread over
+    several sB processes.
+
+    Every process has one inbox list, and each entry in it carries a message and the
+    local channels it is for. A group_send pushes one entry per process that has sockets
+    in the group, not one per socket. Groups are sorted sets hash-tagged by their name,
+    so a lobby's membership stays in one slot. Pushes made during the same loop
+    iteration go out together in one pipeline. Everything is encoded with msgpack.
+    """
+    extensions = ['groups', 'flush']
+
+    def __init__(self, host='localhost', port=6379, prefix='asgi', expiry=60, group_expiry=86400,
+                 capacity=100, channel_capacity=None, inbox_capacity=10000):
+        super().__init__(expiry=expiry, capacity=capacity, channel_capacity=channel_capacity)
+        self.channel_capacity = self.compile_capacities(channel_capacity or {})
+
+        self.host = host
+        self.port = port
+        self.prefix = prefix
+        self.group_expiry = group_expiry
+        self.inbox_capacity = inbox_capacity    # Messages a process may fall behind by
+
+        self.inbox = uuid.uuid4().hex
+        self.queues = {}    # specific channel of this process -> asyncio.Queue
+        self.overflowed = set()     # Local channels that fell behind, see overflow()
+        self.states = weakref.WeakKeyDictionary()
+
+        self.pushed = 0
+        self.pipelines = 0
+        self.delivered = 0
+        self.dropped = 0
+        self.overflows = 0
+        self.refused = 0        # Group messages not pushed because an inbox or channel was full
+        self.undeliverable = 0  # Inbox entries that could not be decoded or delivered
+
+    def get_state(self):
+        loop = asyncio.get_running_loop()
+
+        state = self.states.get(loop)
+        if state is None:
+            state = self.states[loop] = LoopState(AsyncRedis(host=self.host, port=self.port))
+
+        return state
+
+    # Keys
+
+    def inbox_key(self, inbox):
+        return f'{self.prefix}:inbox:{{{inbox}}}'
+
+    def channel_key(self, channel):
+        return f'{self.prefix}:channel:{{{channel}}}'
+
+    def group_key(self, group):
+        return f'{self.prefix}:group:{{{group}}}'
+
+    def inbox_of(self, channel):
+        # 'specific.<inbox>!<local part>'
+        return self.non_local_name(channel)[:-1].rsplit('.', 1)[-1]
+
+    # Channel layer API
+
+    async def new_channel(self, prefix='specific'):
+        channel = f'{prefix}.{self.inbox}!{uuid.uuid4().hex[:12]}'
+
+        # Created now, so messages sent to it before the first receive() are kept
+        self.queues[channel] = asyncio.Queue()
+        return channel
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), "message is not a dict"
+        assert self.valid_channel_name(channel), "Channel name not valid"
+        assert '__asgi_channel__' not in message
+
+        if '!' in channel:
+            key, capacity = self.inbox_key(self.inbox_of(channel)), self.inbox_capacity
+        else:
+            key, capacity = self.channel_key(channel), self.get_capacity(channel)
+
+        if not await self.push(key, self.make_entry([channel], codec.encode(message)), capacity):
+            raise ChannelFull(channel)
+
+    async def receive(self, channel):
+        assert self.valid_channel_name(channel), "Channel name not valid"
+
+        if '!' not in channel:
+            return await self.receive_general(channel)
+
+        self.start_reader()
+        queue = self.queues.setdefault(channel, asyncio.Queue())
+
+        try:
+            return await queue.get()
+        except asyncio.CancelledError:
+            # The consumer is gone, later messages for it are dropped on arrival
+            self.queues.pop(channel, None)
+            self.overflowed.discard(channel)
+            raise
+
+    async def receive_general(self, channel):
+        client = self.get_state().client
+
+        while True:
+            popped = await client.blpop([self.channel_key(channel)], timeout=1)
+            if popped is None:
+                continue
+
+            _, message, sent_at = codec.decode(popped[1])
+            if sent_at + self.expiry >= time.time():
+                return codec.decode(message)
+
+    # Groups extension
+
+    async def group_add(self, group, channel):
+        assert self.valid_group_name(group), "Group name not valid"
+        assert self.valid_channel_name(channel), "Channel name not valid"
+
+        pipe = self.get_state().client.pipeline()
+        pipe.zadd(self.group_key(group), {channel: time.time()})
+        pipe.expire(self.group_key(group), self.group_expiry)
+        await pipe.execute()
+
+    async def group_discard(self, group, channel):
+        assert self.valid_group_name(group), "Group name not valid"
+        assert self.valid_channel_name(channel), "Channel name not valid"
+
+        await self.get_state().client.zrem(self.group_key(group), channel)
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), "Message is not a dict"
+        assert self.valid_group_name(group), "Group name not valid"
+
+        key = self.group_key(group)
+        pipe = self.get_state().client.pipeline()
+        pipe.zremrangebyscore(key, 0, time.time() - self.group_expiry)
+        pipe.zrange(key, 0, -1)
+        _, channels = await pipe.execute()
+
+        # Encoded once, however many sockets it is for
+        message = codec.encode(message)
+
+        pushes = []
+        targets = []        # Channels each push is for
+        by_inbox = {}
+        for channel in (channel.decode('utf-8') for channel in channels):
+            if '!' in channel:
+                by_inbox.setdefault(self.inbox_of(channel), []).append(channel)
+            else:
+                pushes.append(self.push(self.channel_key(channel), self.make_entry([channel], message), self.get_capacity(channel)))
+                targets.append([channel])
+
+        for inbox, inbox_channels in by_inbox.items():
+            pushes.append(self.push(self.inbox_key(inbox), self.make_entry(inbox_channels, message), self.inbox_capacity))
+            targets.append(inbox_channels)
+
+        # Full channels are skipped, like the other layers do for groups, but not silently
+        for pushed, target in zip(await asyncio.gather(*pushes), targets):
+            if not pushed:
+                self.refused += len(target)
+                print(f"LOG: Dropped a message to group {group} for {len(target)} channels, their queue is full: {', '.join(target)}")
+
+    # Flush extension
+
+    async def flush(self):
+        client = self.get_state().client
+
+        async for key in client.scan_iter(match=f'{self.prefix}:*'):
+            await client.delete(key)
+
+        for queue in self.queues.values():
+            while not queue.empty():
+                queue.get_nowait()
+
+    async def close(self):
+        state = self.states.pop(asyncio.get_running_loop(), None)
+        if state is None:
+            return
+
+        if state.reader is not None:
+            state.reader.cancel()
+        await state.client.aclose()
+
+    # Batched pushes
+
+    def make_entry(self, channels, message):
+        return codec.encode([channels, message, time.time()])
+
+    async def push(self, key, entry, capacity):
+        """
+        Queues the entry for the next pipeline and returns whether it was accepted.
+        """
+        state = self.get_state()
+        future = asyncio.get_running_loop().create_future()
+        state.outbox.append((key, entry, capacity, future))
+
+        if not state.flush_scheduled:
+            state.flush_scheduled = True
+            # Runs once the pushes of the current iteration have all been queued
+            asyncio.get_running_loop().create_task(self.flush_outbox(state))
+
+        return await future
+
+    async def flush_outbox(self, state):
+        batch, state.outbox = state.outbox, []
+        state.flush_scheduled = False
+
+        self.pipelines += 1
+        pipe = state.client.pipeline()
+        for key, entry, capacity, _ in batch:
+            pipe.execute_command('EVAL', PUSH_SCRIPT, 1, key, entry, capacity, self.expiry)  # eval() is blocked on cluster pipelines
+
+        try:
+            results = await pipe.execute()
+        except Exception as e:
+            for *_, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for (*_, future), pushed in zip(batch, results):
+            self.pushed += 1
+            if not future.done():
+                future.set_result(bool(pushed))
+
+    # Inbox reader
+
+    def start_reader(self):
+        state = self.get_state()
+        if state.reader is None or state.reader.done():
+            state.reader = asyncio.get_running_loop().create_task(self.read_inbox(state.client))
+
+    async def read_inbox(self, client):
+        key = self.inbox_key(self.inbox)
+
+        while True:
+            try:
+                entries = await client.lpop(key, 100)
+                if not entries:
+                    popped = await client.blpop([key], timeout=1)
+                    entries = [popped[1]] if popped is not None else []
+            except Exception as e:
+                # Whatever goes wrong, this task is the only one delivering to the process's sockets
+                print(f"LOG: Could not read the channel layer inbox: {e}")
+                await asyncio.sleep(1)
+                continue
+
+            for entry in entries:
+                try:
+                    self.deliver(entry)
+                except Exception as e:
+                    self.undeliverable += 1
+                    print(f"LOG: Could not deliver channel layer entry {entry[:100]!r}: {e!r}")
+
+    def deliver(self, entry):
+        channels, message, sent_at = codec.decode(entry)
+
+        if sent_at + self.expiry < time.time():
+            self.dropped += len(channels)
+            return
+
+        for channel in channels:
+            queue = self.queues.get(channel)
+            if queue is None or channel in self.overflowed:
+                self.dropped += 1
+                continue
+
+            if queue.qsize() >= self.get_capacity(channel):
+                self.overflow(channel, queue)
+                continue
+
+            # Every consumer gets its own copy
+            queue.put_nowait(codec.decode(message))
+            self.delivered += 1
+
+    def overflow(self, channel, queue):
+        """
+        A consumer that can't keep up would miss messages (e.g. moves, leaving it with a
+        wrong board), so what it has queued is dropped and it is sent a 'channel.overflow'
+        message instead, which it should answer by closing. Nothing more is delivered to it.
+        """
+        dropped = queue.qsize() + 1
+        while not queue.empty():
+            queue.get_nowait()
+        queue.put_nowait({'type': 'channel.overflow'})
+
+        self.overflowed.add(channel)
+        self.overflows += 1
+        self.dropped += dropped
+        print(f"LOG: Channel {channel} fell {dropped} messages behind, dropped them and told its consumer to close")
+
+    def stats(self):
+        return {
+            'inbox': self.inbox,
+            'local_channels': len(self.queues),
+            'pushed': self.pushed,
+            'pipelines': self.pipelines,
+            'delivered': self.delivered,
+            'dropped': self.dropped,
+            'overflows': self.overflows,
+            'refused': self.refused,
+            'undeliverable': self.undeliverable,
+        }
@@ -0,0 +1,99 @@
+import json
+import uuid
+import datetime
+import decimal
+import msgpack
+
+
+# Every value written by encode() starts with this byte. Entries written before the
+# codec existed are plain JSON or str() output, which never starts with it.
+MSGPACK_TAG = b'\x01'
+
+# msgpack extension types for the Python types it has no native representation for
+EXT_TUPLE = 1
+EXT_SET = 2
+EXT_FROZENSET = 3
+EXT_DATETIME = 4
+EXT_DATE = 5
+EXT_DECIMAL = 6
+EXT_UUID = 7
+
+
+def pack_ext(obj):
+    # strict_types sends subclasses here too, so that e.g. a tuple never turns into a list
+    if isinstance(obj, tuple):
+        return msgpack.ExtType(EXT_TUPLE, pack(list(obj)))
+    if isinstance(obj, frozenset):
+        return msgpack.ExtType(EXT_FROZENSET, pack(list(obj)))
+    if isinstance(obj, set):
+        return msgpack.ExtType(EXT_SET, pack(list(obj)))
+    if isinstance(obj, datetime.datetime):
+        return msgpack.ExtType(EXT_DATETIME, obj.isoformat().encode('utf-8'))
+    if isinstance(obj, datetime.date):
+        return msgpack.ExtType(EXT_DATE, obj.isoformat().encode('utf-8'))
+    if isinstance(obj, decimal.Decimal):
+        return msgpack.ExtType(EXT_DECIMAL, str(obj).encode('utf-8'))
+    if isinstance(obj, uuid.UUID):
+        return msgpack.ExtType(EXT_UUID, obj.bytes)
+
+    # Subclasses of the natively supported types (OrderedDict, ReturnDict, ...)
+    if isinstance(obj, dict):
+        return dict(obj)
+    if isinstance(obj, list):
+        return list(obj)
+    if isinstance(obj, str):
+        return str(obj)
+    if isinstance(obj, bool):
+        return bool(obj)
+    if isinstance(obj, int):
+        return int(obj)
+
+    raise TypeError(f"Cannot cache a value of type {type(obj).__name__}")
+
+def unpack_ext(code, data):
+    if code == EXT_TUPLE:
+        return tuple(unpack(data))
+    if code == EXT_SET:
+        return set(unpack(data))
+    if code == EXT_FROZENSET:
+        return frozenset(unpack(data))
+    if code == EXT_DATETIME:
+        return datetime.datetime.fromisoformat(data.decode('utf-8'))
+    if code == EXT_DATE:
+        return datetime.date.fromisoformat(data.decode('utf-8'))
+    if code == EXT_DECIMAL:
+        return decimal.Decimal(data.decode('utf-8'))
+    if code == EXT_UUID:
+        return uuid.UUID(bytes=data)
+
+    return msgpack.ExtType(code, data)
+
+def pack(value):
+    return msgpack.packb(value, default=pack_ext, strict_types=True, use_bin_type=True)
+
+def unpack(data):
+    return msgpack.unpackb(data, ext_hook=unpack_ext, raw=False, strict_map_key=False)
+
+
+def encode(value):
+    """
+    Serializes a cache value so that decode() returns an equal value of the same type.
+    """
+    return MSGPACK_TAG + pack(value)
+
+def decode(data):
+    """
+    Deserializes a value produced by encode(), or by the JSON/str encoding used before it.
+    """
+    if not data:
+        return data
+
+    if data[:1] == MSGPACK_TAG:
+        return unpack(data[1:])
+
+    # Legacy entry: JSON for dicts and lists, str() for everything else
+    value = data.decode('utf-8')
+    try:
+        return json.loads(value)
+    except json.JSONDecodeError:
+        return value
@@ -0,0 +1,126 @@
+import time
+import random
+import threading
+import redis
+
+
+class Instance:
+    def __init__(self, ip, port):
+        self.ip = ip
+        self.base_url = f'http://{ip}:{port}/'
+
+        self.outstanding = 0
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.ejections = 0
+        self.ejected_until = 0
+
+    def stats(self, now):
+        return {
+            'outstanding': self.outstanding,
+            'requests': self.requests,
+            'failures': self.failures,
+            'ejected_for_s': round(max(0, self.ejected_until - now), 2),
+        }
+
+
+class ServiceResolver:
+    """
+    Follows the instances registered under `service:<type>` by the service discovery and
+    picks the one with the fewest outstanding calls. Instances failing several calls in a
+    row are ejected for a while, for longer each time they are ejected again.
+    """
+
+    def __init__(self, redis_url, service_type, port, refresh_interval=5, eject_after=3, ejection_s=5, max_ejection_s=60):
+        self.redis = redis.Redis.from_url(redis_url, socket_timeout=1, socket_connect_timeout=1)
+        self.key = f'service:{service_type}'
+        self.port = port
+
+        self.refresh_interval = refresh_interval
+        self.eject_after = eject_after
+        self.ejection_s = ejection_s
+        self.max_ejection_s = max_ejection_s
+
+        self.lock = threading.Lock()
+        self.instances = {}     # ip -> Instance
+        self.watcher = None
+
+    def start(self):
+        with self.lock:
+            if self.watcher is not None:
+                return
+            self.watcher = threading.Thread(target=self.watch_forever, name=f'{self.key}-resolver', daemon=True)
+
+        self.watcher.start()
+
+    def watch_forever(self):
+        # Even the first refresh happens here, acquire() may be called on an event loop
+        while True:
+            self.refresh()
+            time.sleep(self.refresh_interval)
+
+    def refresh(self):
+        try:
+            ips = {ip.decode('utf-8') for ip in self.redis.lrange(self.key, 0, -1)}
+        except redis.RedisError as e:
+            # Keep routing to the instances known so far
+            print(f"LOG: Could not refresh {self.key}: {e}")
+            return
+
+        with self.lock:
+            for ip in ips - self.instances.keys():
+                self.instances[ip] = Instance(ip, self.port)
+            for ip in self.instances.keys() - ips:
+                del self.instances[ip]
+
+    def acquire(self):
+        """
+        Returns the instance to call, with the call counted as outstanding, or None when no
+        instance is available (e.g. the registry is still being read). Never blocks on Redis.
+        Every acquired instance must be released.
+        """
+        self.start()
+        now = time.monotonic()
+
+        with self.lock:
+            available = [instance for instance in self.instances.values() if instance.ejected_until <= now]
+            if not available:
+                return None
+
+            fewest = min(instance.outstanding for instance in available)
+            instance = random.choice([instance for instance in available if instance.outstanding == fewest])
+
+            instance.outstanding += 1
+            instance.requests += 1
+            return instance
+
+    def release(self, instance, ok):
+        with self.lock:
+            instance.outstanding -= 1
+
+            if ok:
+                instance.consecutive_failures = 0
+                instance.ejections = 0
+                return
+
+            instance.failures += 1
+            now = time.monotonic()
+
+            # Calls that were already under way when it got ejected do not extend the ejection
+            if instance.ejected_until > now:
+                return
+
+            instance.consecutive_failures += 1
+
+            if instance.consecutive_failures >= self.eject_after:
+                instance.ejections += 1
+                instance.consecutive_failures = 0
+                duration = min(self.max_ejection_s, self.ejection_s * 2 ** (instance.ejections - 1))
+                instance.ejected_until = now + duration
+                print(f"LOG: Ejected {self.key} instance {instance.ip} for {duration}s")
+
+    def stats(self):
+        now = time.monotonic()
+        with self.lock:
+            return {ip: instance.stats(now) for ip, instance in self.instances.items()}
@@ -0,0 +1,240 @@
+import os
+import time
+import asyncio
+import weakref
+import threading
+from collections import deque
+from contextlib import contextmanager
+import httpx
+from .discovery import ServiceResolver
+from .breaker import CircuitBreaker, CircuitOpenError
+
+
+API_GATEWAY_BASE_URL = os.getenv('API_GATEWAY_BASE_URL', '')
+
+# Unless a call passes its own timeout
+TIMEOUT = httpx.Timeout(
+    float(os.getenv('HTTP_TIMEOUT_S', 3)),
+    connect=float(os.getenv('HTTP_CONNECT_TIMEOUT_S', 1))
+)
+
+# Connections are kept open between calls, so most calls cost a single round trip
+LIMITS = httpx.Limits(
+    max_connections=int(os.getenv('HTTP_POOL_MAX_CONNECTIONS', 50)),
+    max_keepalive_connections=int(os.getenv('HTTP_POOL_MAX_KEEPALIVE', 20)),
+    keepalive_expiry=float(os.getenv('HTTP_POOL_KEEPALIVE_S', 30))
+)
+
+# Raised for connection problems, timeouts and open circuits, like requests.RequestException was
+RequestError = (httpx.RequestError, CircuitOpenError)
+
+# The request never reached the instance
+NotConnectedErrors = (httpx.ConnectError, httpx.ConnectTimeout)
+
+# With the registry available, calls to 'sA/...' go straight to an sA instance instead of
+# through the gateway. The gateway is still used when no instance can be reached.
+SM_REDIS_URL = os.getenv('SM_REDIS_URL')
+
+resolvers = {}
+if SM_REDIS_URL:
+    resolvers['sA'] = ServiceResolver(
+        SM_REDIS_URL,
+        'A',
+        port=int(os.getenv('SERVICE_A_PORT', 8000)),
+        refresh_interval=float(os.getenv('DISCOVERY_REFRESH_S', 5)),
+        eject_after=int(os.getenv('DISCOVERY_EJECT_AFTER_FAILURES', 3)),
+        ejection_s=float(os.getenv('DISCOVERY_EJECTION_S', 5))
+    )
+
+# While sA keeps failing, calls to it fail immediately instead of queueing up
+breakers = {
+    'sA': CircuitBreaker(
+        'sA',
+        failure_threshold=int(os.getenv('BREAKER_FAILURE_THRESHOLD', 5)),
+        open_s=float(os.getenv('BREAKER_OPEN_S', 10))
+    ),
+}
+
+
+class ClientStats:
+    """
+    Call counts and latency percentiles over the last `window` calls.
+    """
+
+    def __init__(self, window=1000):
+        self.lock = threading.Lock()
+        self.latencies = deque(maxlen=window)
+
+        self.requests = 0
+        self.errors = 0
+        self.in_flight = 0
+
+    @contextmanager
+    def track(self):
+        with self.lock:
+            self.in_flight += 1
+        started_at = time.monotonic()
+
+        try:
+            yield
+        except Exception:
+            with self.lock:
+                self.errors += 1
+            raise
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+                self.requests += 1
+                self.latencies.append(time.monotonic() - started_at)
+
+    def snapshot(self):
+        with self.lock:
+            latencies = sorted(self.latencies)
+
+        percentiles = {}
+        for p in (50, 95, 99):
+            if latencies:
+                percentiles[f'p{p}'] = round(latencies[min(len(latencies) - 1, len(latencies) * p // 100)] * 1000, 2)
+
+        return {
+            'requests': self.requests,
+            'errors': self.errors,
+            'in_flight': self.in_flight,
+            'latency_ms': percentiles,
+        }
+
+
+stats = ClientStats()
+
+client = httpx.Client(base_url=API_GATEWAY_BASE_URL, timeout=TIMEOUT, limits=LIMITS)
+
+# Async clients are bound to the event loop they were created in, so there is one per loop
+async_clients = weakref.WeakKeyDictionary()
+
+def get_async_client():
+    loop = asyncio.get_running_loop()
+
+    async_client = async_clients.get(loop)
+    if async_client is None:
+        async_client = async_clients[loop] = httpx.AsyncClient(base_url=API_GATEWAY_BASE_URL, timeout=TIMEOUT, limits=LIMITS)
+
+    return async_client
+
+
+def pick_instance(path):
+    # 'sA/api/...' is served by an sA instance as 'api/...'
+    service, _, instance_path = path.partition('/')
+
+    resolver = resolvers.get(service)
+    instance = resolver.acquire() if resolver is not None else None
+
+    return resolver, instance, instance_path
+
+def drop_unset_headers(kwargs):
+    # requests silently skipped headers set to None (e.g. an unset ROOT_PASSWORD), httpx does not
+    if kwargs.get('headers'):
+        kwargs['headers'] = {name: value for name, value in kwargs['headers'].items() if value is not None}
+
+def request(method, path, **kwargs):
+    """
+    Calls `path` (relative to the API gateway) over a pooled keep-alive connection.
+    Raises CircuitOpenError without calling when the service's circuit is open.
+    """
+    drop_unset_headers(kwargs)
+
+    breaker = breakers.get(path.partition('/')[0])
+    if breaker is not None:
+        breaker.check()
+
+    ok = False
+    try:
+        response = send(method, path, **kwargs)
+        ok = response.status_code < 500
+        return response
+    finally:
+        if breaker is not None:
+            breaker.record(ok)
+
+def send(method, path, **kwargs):
+    resolver, instance, instance_path = pick_instance(path)
+
+    if instance is not None:
+        ok = False
+        try:
+            with stats.track():
+                response = client.request(method, instance.base_url + instance_path, **kwargs)
+            ok = response.status_code < 500
+            return response
+        except NotConnectedErrors:
+            pass    # Never reached the instance, so it is safe to go through the gateway
+        finally:
+            resolver.release(instance, ok)
+
+    with stats.track():
+        return client.request(method, path, **kwargs)
+
+def get(path, **kwargs):
+    return request('GET', path, **kwargs)
+
+def post(path, **kwargs):
+    return request('POST', path, **kwargs)
+
+async def async_request(method, path, **kwargs):
+    drop_unset_headers(kwargs)
+
+    breaker = breakers.get(path.partition('/')[0])
+    if breaker is not None:
+        breaker.check()
+
+    ok = False
+    try:
+        response = await async_send(method, path, **kwargs)
+        ok = response.status_code < 500
+        return response
+    finally:
+        if breaker is not None:
+            breaker.record(ok)
+
+async def async_send(method, path, **kwargs):
+    resolver, instance, instance_path = pick_instance(path)
+
+    if instance is not None:
+        ok = False
+        try:
+            with stats.track():
+                response = await get_async_client().request(method, instance.base_url + instance_path, **kwargs)
+            ok = response.status_code < 500
+            return response
+        except NotConnectedErrors:
+            pass
+        finally:
+            resolver.release(instance, ok)
+
+    with stats.track():
+        return await get_async_client().request(method, path, **kwargs)
+
+async def async_get(path, **kwargs):
+    return await async_request('GET', path, **kwargs)
+
+async def async_post(path, **kwargs):
+    return await async_request('POST', path, **kwargs)
+
+
+def get_pool_stats(http_client):
+    # httpx does not expose its pool, the transport's is read defensively
+    pool = getattr(getattr(http_client, '_transport', None), '_pool', None)
+    connections = list(getattr(pool, 'connections', []))
+
+    return {
+        'connections': len(connections),
+        'idle': sum(1 for connection in connections if connection.is_idle()),
+    }
+
+def get_stats():
+    return {
+        'calls': stats.snapshot(),
+        'pool': get_pool_stats(client),
+        'async_pools': [get_pool_stats(async_client) for async_client in list(async_clients.values())],
+        'instances': {service: resolver.stats() for service, resolver in resolvers.items()},
+        'breakers': {service: breaker.stats() for service, breaker in breakers.items()},
+    }
@@ -0,0 +1,218 @@
+import os
+import asyncio
+import weakref
+import threading
+from . import http_client
+from .singleflight import Call
+
+
+BATCH_WINDOW_S = float(os.getenv('BATCH_WINDOW_MS', 2)) / 1000
+BATCH_MAX_ITEMS = int(os.getenv('BATCH_MAX_ITEMS', 100))   # Must not exceed sA's BULK_LOOKUP_MAX_ITEMS
+
+
+class LoadError(Exception):
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class BatchLoader:
+    """
+    Collects the keys asked for by concurrent threads within `window_s` and loads them
+    with one `fetch_many(keys)` call, which returns {key: result}. The first thread of a
+    batch waits out the window and makes the call, the others wait for its outcome.
+    An exception raised by the call fails every key, one returned as a key's result
+    fails that key only.
+    """
+
+    def __init__(self, fetch_many, window_s=BATCH_WINDOW_S, max_batch=BATCH_MAX_ITEMS):
+        self.fetch_many = fetch_many
+        self.window_s = window_s
+        self.max_batch = max_batch
+
+        self.lock = threading.Lock()
+        self.pending = {}   # key -> Call
+        self.full = threading.Event()
+
+        self.loads = 0
+        self.batches = 0
+
+    def load(self, key):
+        with self.lock:
+            self.loads += 1
+            leader = not self.pending
+
+            call = self.pending.get(key)
+            if call is None:
+                call = self.pending[key] = Call()
+            if len(self.pending) >= self.max_batch:
+                self.full.set()
+
+        if leader:
+            self.full.wait(self.window_s)
+
+            with self.lock:
+                batch, self.pending = self.pending, {}
+                self.full.clear()
+
+            self.run(batch)
+
+        call.done.wait()
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def run(self, batch):
+        keys = list(batch)
+
+        # Keys that came in after the batch filled up go in follow-up calls
+        for start in range(0, len(keys), self.max_batch):
+            chunk = keys[start:start + self.max_batch]
+            self.batches += 1
+
+            try:
+                results = self.fetch_many(chunk)
+                for key in chunk:
+                    result = results.get(key)
+                    if isinstance(result, Exception):
+                        batch[key].error = result
+                    else:
+                        batch[key].result = result
+            except Exception as e:
+                for key in chunk:
+                    batch[key].error = e
+
+            for key in chunk:
+                batch[key].done.set()
+
+    def stats(self):
+        return {'loads': self.loads, 'batches': self.batches}
+
+
+class AsyncBatchLoader:
+    """
+    BatchLoader for coroutines, `fetch_many` being a coroutine function. The batch is
+    sent `window_s` after its first key, or as soon as it is full.
+    """
+
+    def __init__(self, fetch_many, window_s=BATCH_WINDOW_S, max_batch=BATCH_MAX_ITEMS):
+        self.fetch_many = fetch_many
+        self.window_s = window_s
+        self.max_batch = max_batch
+
+        self.pending = weakref.WeakKeyDictionary()  # event loop -> {key: future}
+
+        self.loads = 0
+        self.batches = 0
+
+    async def load(self, key):
+        loop = asyncio.get_running_loop()
+        pending = self.pending.setdefault(loop, {})
+        self.loads += 1
+
+        if not pending:
+            loop.call_later(self.window_s, self.flush, loop, pending)
+
+        future = pending.get(key)
+        if future is None:
+            future = pending[key] = loop.create_future()
+        if len(pending) >= self.max_batch:
+            self.flush(loop, pending)
+
+        # A caller being cancelled does not cancel the load for the others
+        return await asyncio.shield(future)
+
+    def flush(self, loop, pending):
+        # The window's timer may fire after the batch was already sent for being full
+        if not pending or self.pending.get(loop) is not pending:
+            return
+
+        batch = dict(pending)
+        self.pending[loop] = {}
+        self.batches += 1
+        loop.create_task(self.run(batch))
+
+    async def run(self, batch):
+        try:
+            results = await self.fetch_many(list(batch))
+            for key, future in batch.items():
+                if future.done():
+                    continue
+
+                result = results.get(key)
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+        except Exception as e:
+            for future in batch.values():
+                if not future.done():
+                    future.set_exception(e)
+
+    def stats(self):
+        return {'loads': self.loads, 'batches': self.batches}
+
+
+def parse_token_validations(tokens, response):
+    if response.status_code != 200:
+        raise LoadError(f"Bulk token validation failed: {response.status_code}, {response.text}", response.status_code)
+
+    # One entry per token, null for the invalid ones
+    return dict(zip(tokens, response.json()['users']))
+
+def parse_users(user_ids, response):
+    if response.status_code != 200:
+        raise LoadError(f"Bulk user lookup failed: {response.status_code}, {response.text}", response.status_code)
+
+    # Users that do not exist are left out
+    users = {user['id']: user for user in response.json()['users']}
+    return {user_id: users.get(user_id) for user_id in user_ids}
+
+def fetch_token_validations(tokens):
+    response = http_client.post(
+        'sA/api/utilities/validate-tokens',
+        json={'tokens': tokens},
+        headers={'X-Root-Password': os.getenv('ROOT_PASSWORD')}
+    )
+    return parse_token_validations(tokens, response)
+
+def fetch_users(user_ids):
+    response = http_client.get(
+        'sA/api/users/bulk',
+        params={'ids': ','.join(str(user_id) for user_id in user_ids)},
+        headers={'X-Root-Password': os.getenv('ROOT_PASSWORD')}
+    )
+    return parse_users(user_ids, response)
+
+async def async_fetch_token_validations(tokens):
+    response = await http_client.async_post(
+        'sA/api/utilities/validate-tokens',
+        json={'tokens': tokens},
+        headers={'X-Root-Password': os.getenv('ROOT_PASSWORD')}
+    )
+    return parse_token_validations(tokens, response)
+
+async def async_fetch_users(user_ids):
+    response = await http_client.async_get(
+        'sA/api/users/bulk',
+        params={'ids': ','.join(str(user_id) for user_id in user_ids)},
+        headers={'X-Root-Password': os.getenv('ROOT_PASSWORD')}
+    )
+    return parse_users(user_ids, response)
+
+
+# load(token) -> user info or None, load(user_id) -> user or None. Both raise LoadError
+# when sA answers with an error and http_client.RequestError when it cannot be reached.
+token_loader = BatchLoader(fetch_token_validations)
+user_loader = BatchLoader(fetch_users)
+async_token_loader = AsyncBatchLoader(async_fetch_token_validations)
+async_user_loader = AsyncBatchLoader(async_fetch_users)
+
+
+def get_stats():
+    return {
+        'tokens': token_loader.stats(),
+        'users': user_loader.stats(),
+        'async_tokens': async_token_loader.stats(),
+        'async_users': async_user_loader.stats(),
+    }
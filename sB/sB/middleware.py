@@ -1,32 +1,54 @@
 import json
-import requests
-from datetime import datetime
 import os
+import queue
 import socket
+import threading
+import time
+from datetime import datetime
 
 class LogstashLogger:
+    """
+    Ships log records to Logstash's tcp json_lines input from a background thread.
+    Records wait in a bounded queue and are sent in batches over one persistent
+    connection; when the queue is full they are dropped, so logging never blocks a request.
+    """
     def __init__(self):
         self.logstash_host = os.getenv('LOGSTASH_HOST', 'logstash')
-        self.logstash_port = os.getenv('LOGSTASH_PORT', 6000)
+        self.logstash_port = int(os.getenv('LOGSTASH_PORT', 5000))
         self.service_name = os.getenv('SERVICE_NAME', f'service_{os.getenv('SERVICE_TYPE').lower()}')
 
+        self.batch_size = int(os.getenv('LOGSTASH_BATCH_SIZE', 100))
+        self.flush_interval = float(os.getenv('LOGSTASH_FLUSH_INTERVAL_S', 1))
+        self.records = queue.Queue(maxsize=int(os.getenv('LOGSTASH_QUEUE_SIZE', 10000)))
+
+        self.sock = None
+        self.reconnect_at = 0
+        self.shipper_pid = None
+        self.shipped = 0
+        self.dropped = 0
+
+        # Guards starting the shipper and the counters, which every logging thread updates.
+        # A fork could copy it while held, so the child gets a fresh one.
+        self.lock = threading.Lock()
+        os.register_at_fork(after_in_child=self.reset_lock)
+
+    def reset_lock(self):
+        self.lock = threading.Lock()
+
     def log(self, message, level='info'):
+        log_data = {
+            "service": self.service_name,
+            "message": message,
+            "timestamp": datetime.utcnow().isoformat(),
+            "level": level
+        }
+
+        self.ensure_shipper()
+
         try:
-            log_data = {
-                "service": self.service_name,
-                "message": message,
-                "timestamp": datetime.utcnow().isoformat(),
-                "level": level
-            }
-            
-            requests.post(
-                f'http://{self.logstash_host}:{self.logstash_port}',
-                json=log_data,
-                headers={'Content-Type': 'application/json'},
-                timeout=1
-            )
-        except Exception:
-            pass
+            self.records.put_nowait(log_data)
+        except queue.Full:
+            self.count_dropped(1)
 
     def info(self, message):
         self.log(message, 'info')
@@ -40,17 +62,97 @@ class LogstashLogger:
     def debug(self, message):
         self.log(message, 'debug')
 
+    def stats(self):
+        return {
+            'queued': self.records.qsize(),
+            'shipped': self.shipped,
+            'dropped': self.dropped,
+        }
+
+    def count_dropped(self, count):
+        with self.lock:
+            self.dropped += count
+
+    def ensure_shipper(self):
+        # Threads don't survive a fork, so every worker process starts its own shipper
+        if self.shipper_pid == os.getpid():
+            return
+
+        with self.lock:
+            # Only the first of the threads logging at once may start it
+            if self.shipper_pid != os.getpid():
+                self.sock = None
+                threading.Thread(target=self.ship_forever, name='logstash-shipper', daemon=True).start()
+                self.shipper_pid = os.getpid()
+
+    def ship_forever(self):
+        while True:
+            # Wait for the first record, then collect more until the batch is full or the interval passes
+            batch = [self.records.get()]
+            flush_at = time.monotonic() + self.flush_interval
+
+            while len(batch) < self.batch_size:
+                timeout = flush_at - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.records.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            self.send_batch(batch)
+
+    def send_batch(self, batch):
+        payload = b''.join(json.dumps(record).encode('utf-8') + b'\n' for record in batch)
+
+        # One retry on a fresh connection, as Logstash may have closed the old one
+        for _ in range(2):
+            try:
+                self.connect()
+                self.sock.sendall(payload)
+                with self.lock:
+                    self.shipped += len(batch)
+                return
+            except OSError:
+                self.disconnect()
+
+        self.count_dropped(len(batch))
+
+    def connect(self):
+        if self.sock is not None:
+            return
+
+        # Don't hammer a Logstash that is down, drop what comes in meanwhile
+        if time.monotonic() < self.reconnect_at:
+            raise ConnectionError("Logstash is unavailable.")
+
+        try:
+            self.sock = socket.create_connection((self.logstash_host, self.logstash_port), timeout=1)
+        except OSError:
+            self.reconnect_at = time.monotonic() + 5
+            raise
+
+    def disconnect(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+        self.sock = None
+
 logger = LogstashLogger()
 
 class LogstashMiddleware:
     def __init__(self, get_response):
         self.get_response = get_response
+        self.logging = int(os.getenv('LOGGING'))
+        self.service = f"{logger.service_name}_{socket.gethostbyname(socket.gethostname())}"
 
     def __call__(self, request):
         response = self.get_response(request)
 
         log_info = {
-            "service": f"{logger.service_name}_{socket.gethostbyname(socket.gethostname())}"
+            "service": self.service,
         }
 
         if 400 <= response.status_code < 600:
@@ -63,7 +165,7 @@ class LogstashMiddleware:
         else:
             log_info['msg'] = f"LOG: Request {request.method} : {request.path}"
 
-        if int(os.getenv('LOGGING')):
+        if self.logging:
             logger.info(json.dumps(log_info))
             
         return response
\ No newline at end of file
@@ -1,8 +1,13 @@
 from rest_framework.permissions import BasePermission
 from rest_framework.exceptions import PermissionDenied
 import os
-import requests
-from .utilities import get_timeout_from_token, cache_get, cache_set
+import jwt
+from . import http_client
+from .tokens import verify_token, user_data_from_claims
+from .singleflight import SingleFlight
+from .loaders import token_loader, LoadError
+from .user_events import has_outdated_profile
+from .utilities import get_timeout_from_token, cache_get_many, cache_set, get_stale_user_data, token_cache_key, index_user_token, is_rejected_token, remember_rejected_token
 
 
 class ProvidesValidRootPassword(BasePermission):
@@ -23,49 +28,88 @@ class ProvidesValidRootPassword(BasePermission):
         return True
 
 
+# Concurrent requests with the same uncached token share one validation
+token_validations = SingleFlight()
+
+
 class ValidateTokenWithServiceA(BasePermission):
+    """
+    Views can list extra per-token cache entries in `token_cache_prefetch`. They are
+    fetched together with the user data and exposed as `request.token_cache`.
+    """
 
     def has_permission(self, request, view):
         full_token_str = request.headers.get('Authorization')
 
-        user_data = self.fetch_user_data_by_token(full_token_str)
+        prefetch = getattr(view, 'token_cache_prefetch', ())
+        user_data = self.fetch_user_data_by_token(full_token_str, request, prefetch)
         if user_data:
             request.user_data = user_data
             return True
         
         return False
     
-    def fetch_user_data_by_token(self, full_token_str):
+    def fetch_user_data_by_token(self, full_token_str, request=None, prefetch=()):
         token = full_token_str.split(' ')[1]
 
-        # Check the cache first
-        cached_user_data = cache_get(token + "_user_data")
+        if is_rejected_token(token):
+            return None
+
+        # Check the cache first, along with whatever else the view is going to need
+        kinds = ['user_data', *prefetch]
+        cached = cache_get_many([token_cache_key(token, kind) for kind in kinds])
+        if request is not None:
+            request.token_cache = {kind: cached.get(token_cache_key(token, kind)) for kind in prefetch}
+
+        cached_user_data = cached.get(token_cache_key(token, 'user_data'))
         if cached_user_data:
             print(f"LOG: Using cached basic user info for user#{cached_user_data.get('id')}")
             return cached_user_data
 
+        return token_validations.do(
+            token_cache_key(token, 'user_data'),
+            lambda: self.validate_token(full_token_str, token)
+        )
+
+    def validate_token(self, full_token_str, token):
+        # Tokens carrying the profile fields need no call to Service A at all
+        try:
+            claims = verify_token(token)
+        except jwt.InvalidTokenError as e:
+            print(f"LOG: Rejected token: {e}")
+            remember_rejected_token(token)
+            return None
+
+        if claims is not None:
+            user_data = user_data_from_claims(claims)
+            if user_data is not None and not has_outdated_profile(claims):
+                self.cache_user_data(token, user_data)
+                return user_data
+
         try:
-            # Make the request to Service A to validate the token
-            response = requests.get(
-                f'{os.getenv('API_GATEWAY_BASE_URL')}sA/api/utilities/validate-token',
-                headers={
-                    'Authorization': full_token_str,
-                    'X-Root-Password': os.getenv('ROOT_PASSWORD')
-                }
-            )
-
-            if response.status_code == 200:
-                user_data = response.json()
+            # Concurrent validations are sent to Service A together in one bulk call
+            user_data = token_loader.load(token)
+
+            if user_data is not None:
                 self.cache_user_data(token, user_data)
                 return user_data
-        except requests.RequestException as e:
+
+            # Service A answered that the token is invalid, failures are not remembered
+            remember_rejected_token(token)
+            return None
+        except LoadError as e:
+            print(f"Request failed: {e}")
+            if e.status_code < 500:
+                return None
+        except http_client.RequestError as e:
             print(f"Request failed: {e}")
 
-        return None
+        return get_stale_user_data(token)
 
     def cache_user_data(self, token, user_data):
         timeout = get_timeout_from_token(token)
 
         if timeout is not None:
-            cache_set(token + "_user_data", user_data, timeout=timeout)
+            cache_set(token_cache_key(token, 'user_data'), user_data, timeout=timeout)
+            index_user_token(user_data['id'], token, timeout)
             print(f"LOG: Cached basic user info for user#{user_data.get('id')}")
@@ -81,9 +81,14 @@ ASGI_APPLICATION = 'sB.asgi.application'
 
 import os
 
+# Shared through the Redis cluster, so a lobby's sockets can live in different sB processes
 CHANNEL_LAYERS = {
     'default': {
-        'BACKEND': 'channels.layers.InMemoryChannelLayer',
+        'BACKEND': 'sB.channel_layer.RedisClusterChannelLayer',
+        'CONFIG': {
+            'host': os.getenv('CHANNEL_LAYER_REDIS_HOST', 'ud-redis-node-1'),
+            'port': int(os.getenv('CHANNEL_LAYER_REDIS_PORT', 6379)),
+        },
     },
 }
 
@@ -0,0 +1,86 @@
+import asyncio
+import threading
+import weakref
+
+
+class Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Runs at most one call per key at a time within the process. Threads asking for a key
+    that is already in flight wait for that call and share its result (or exception).
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+        self.started = 0
+        self.coalesced = 0
+
+    def do(self, key, fn):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+
+            if leader:
+                call = self.calls[key] = Call()
+                self.started += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+
+    def stats(self):
+        return {'in_flight': len(self.calls), 'started': self.started, 'coalesced': self.coalesced}
+
+
+class AsyncSingleFlight:
+    """
+    SingleFlight for coroutines. The call runs as its own task, so a caller being
+    cancelled (e.g. its socket closing) does not cancel it for the others.
+    """
+
+    def __init__(self):
+        self.calls = weakref.WeakKeyDictionary()    # event loop -> {key: task}
+
+        self.started = 0
+        self.coalesced = 0
+
+    async def do(self, key, fn):
+        loop = asyncio.get_running_loop()
+        calls = self.calls.setdefault(loop, {})
+
+        task = calls.get(key)
+        if task is None:
+            task = calls[key] = loop.create_task(fn())
+            task.add_done_callback(lambda done: calls.pop(key) if calls.get(key) is done else None)
+            self.started += 1
+        else:
+            self.coalesced += 1
+
+        return await asyncio.shield(task)
+
+    def stats(self):
+        in_flight = sum(len(calls) for calls in self.calls.values())
+        return {'in_flight': in_flight, 'started': self.started, 'coalesced': self.coalesced}
@@ -0,0 +1,60 @@
+import os
+import jwt
+
+
+# Same "<kid>:<secret>,..." list sA signs its tokens with. Without it, every token
+# is validated by sA as before.
+JWT_SIGNING_KEYS = dict(
+    entry.split(':', 1) for entry in os.getenv('JWT_SIGNING_KEYS', '').split(',') if entry
+)
+
+# Key id of the key tokens were signed with before they named one
+LEGACY_KID = 'k0'
+
+# Tolerated clock difference between sA and sB
+JWT_LEEWAY_S = float(os.getenv('JWT_LEEWAY_S', 5))
+
+# The fields sA's validate-token endpoint returns, and the claims that provide them
+PROFILE_CLAIMS = {'id': 'user_id', 'username': 'username', 'rating': 'rating'}
+
+
+def verify_token(token):
+    """
+    Checks the signature and expiry of an sA access token without calling sA. Returns its
+    claims, or None when no signing keys are configured. Raises jwt.InvalidTokenError
+    for tokens that are forged, expired or signed with a key that is no longer listed.
+    """
+    if not JWT_SIGNING_KEYS:
+        return None
+
+    kid = jwt.get_unverified_header(token).get('kid')
+    if kid is None:
+        # Issued before key ids were introduced, signed with the legacy key
+        key = JWT_SIGNING_KEYS.get(LEGACY_KID) or next(iter(JWT_SIGNING_KEYS.values()))
+    elif kid in JWT_SIGNING_KEYS:
+        key = JWT_SIGNING_KEYS[kid]
+    else:
+        raise jwt.InvalidTokenError(f"Token is signed with an unknown key '{kid}'")
+
+    claims = jwt.decode(
+        token,
+        key,
+        algorithms=['HS256'],
+        leeway=JWT_LEEWAY_S,
+        options={'require': ['exp', 'user_id']}
+    )
+
+    if claims.get('token_type') != 'access':
+        raise jwt.InvalidTokenError("Token is not an access token")
+
+    return claims
+
+def user_data_from_claims(claims):
+    """
+    Builds what sA's validate-token endpoint would return, or None if the token does not
+    carry every profile field and sA still has to be asked.
+    """
+    if not all(claim in claims for claim in PROFILE_CLAIMS.values()):
+        return None
+
+    return {field: claims[claim] for field, claim in PROFILE_CLAIMS.items()}
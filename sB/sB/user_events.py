@@ -0,0 +1,138 @@
+import os
+import json
+import time
+import threading
+import redis
+from .utilities import (
+    rc, local_cache, cache_get, cache_set, async_cache_get, user_tokens_key, tagged_cache_key
+)
+
+
+SM_REDIS_URL = os.getenv('SM_REDIS_URL')
+USER_EVENTS_CHANNEL = os.getenv('USER_EVENTS_CHANNEL', 'sA:user_events')
+
+# The newest profile version announced for a user is remembered for as long as tokens
+# carrying an older one may still be in use
+USER_VERSION_TTL_S = int(os.getenv('USER_VERSION_TTL_S', 3600))
+
+# What is cached per token that a change to each field makes outdated
+EVICTED_KINDS = {
+    'username': ('user_data',),
+    'rating': ('user_data',),
+    'friends': ('friends_ids',),
+    'deleted': ('user_data', 'friends_ids'),
+}
+
+PROFILE_FIELDS = ('username', 'rating', 'deleted')
+
+
+def user_version_key(user_id):
+    return f"user_version:{user_id}"
+
+def evict_user(user_id, fields, version=None):
+    """
+    Drops the entries cached under every token of the user that `fields` made outdated,
+    from Redis and from this process's local tier.
+    """
+    kinds = {kind for field in fields for kind in EVICTED_KINDS.get(field, ())}
+
+    if version is not None and any(field in PROFILE_FIELDS for field in fields):
+        # Tokens carry the profile too, the ones issued before this change must not be trusted
+        cache_set(user_version_key(user_id), {'version': version, 'deleted': 'deleted' in fields}, timeout=USER_VERSION_TTL_S)
+
+    tags = rc.smembers(user_tokens_key(user_id))
+    keys = [tagged_cache_key(tag.decode('ascii'), kind) for tag in tags for kind in kinds]
+
+    if keys:
+        # The cluster pipeline sends one batch per node
+        pipe = rc.pipeline()
+        for key in keys:
+            pipe.delete(key)
+        pipe.execute()
+
+    for key in keys:
+        local_cache.delete(key)
+
+    if 'deleted' in fields:
+        rc.delete(user_tokens_key(user_id))
+
+    print(f"LOG: Evicted {len(keys)} cached entries of user#{user_id} after a change to {', '.join(fields)}")
+
+def is_outdated(claims, known):
+    if known is None:
+        return False
+    return known['deleted'] or claims.get('profile_version', 0) < known['version']
+
+def has_outdated_profile(claims):
+    """
+    Whether the profile carried by the token's claims has changed since it was issued.
+    """
+    return is_outdated(claims, cache_get(user_version_key(claims['user_id'])))
+
+async def async_has_outdated_profile(claims):
+    return is_outdated(claims, await async_cache_get(user_version_key(claims['user_id'])))
+
+
+class UserEventSubscriber:
+    """
+    Follows the user changes published by sA and evicts what they made outdated.
+    Every process subscribes, since every process has its own local tier.
+    """
+
+    def __init__(self, url, channel):
+        self.url = url
+        self.channel = channel
+
+        self.lock = threading.Lock()
+        self.listener = None
+
+        self.received = 0
+        self.failed = 0
+        self.reconnects = 0
+
+    def start(self):
+        with self.lock:
+            if self.listener is not None:
+                return
+            self.listener = threading.Thread(target=self.listen_forever, name='user-events-listener', daemon=True)
+
+        self.listener.start()
+
+    def listen_forever(self):
+        while True:
+            try:
+                client = redis.Redis.from_url(self.url, socket_connect_timeout=0.5, health_check_interval=30)
+                pubsub = client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+
+                # Whatever was published while disconnected is lost, so nothing cached
+                # locally before then can be trusted
+                if self.reconnects:
+                    local_cache.clear()
+                self.reconnects += 1
+
+                for message in pubsub.listen():
+                    self.handle(message['data'])
+            except redis.RedisError as e:
+                print(f"LOG: Lost the user events feed: {e}")
+                time.sleep(1)
+
+    def handle(self, data):
+        self.received += 1
+
+        try:
+            event = json.loads(data)
+            evict_user(event['user_id'], event['fields'], event.get('version'))
+        except (ValueError, KeyError, redis.RedisError) as e:
+            self.failed += 1
+            print(f"LOG: Could not apply user event {data!r}: {e}")
+
+    def stats(self):
+        return {'received': self.received, 'failed': self.failed, 'connections': self.reconnects}
+
+
+subscriber = UserEventSubscriber(SM_REDIS_URL, USER_EVENTS_CHANNEL) if SM_REDIS_URL else None
+
+def start():
+    if subscriber is not None:
+        subscriber.start()
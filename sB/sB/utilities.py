@@ -24,37 +24,328 @@ def get_timeout_from_token(token):
 
     return None  # In case of any other errors, return None
 
-import json
+import os
+import time
+import base64
+import hashlib
+import threading
+from collections import OrderedDict
+import asyncio
+import weakref
 from redis.cluster import RedisCluster as Redis
+from redis.asyncio.cluster import RedisCluster as AsyncRedis
 import redis
+from sB import codec
 
 rc = Redis(host='ud-redis-node-1', port=6379)
 
+# Async clients are bound to the event loop they were created in, so there is one per loop
+async_rcs = weakref.WeakKeyDictionary()
+
+def get_async_rc():
+    loop = asyncio.get_running_loop()
+
+    client = async_rcs.get(loop)
+    if client is None:
+        client = async_rcs[loop] = AsyncRedis(host='ud-redis-node-1', port=6379)
+
+    return client
+
+
+class LocalCache:
+    """
+    Bounded, process-local LRU cache with per-key expiry, used as a first tier in front
+    of the Redis cluster. It holds the encoded values, so every hit decodes a fresh copy.
+    Expired entries are kept for `stale_ttl` more seconds, for get_stale() only.
+    """
+    MISSING = object()
+
+    def __init__(self, max_entries, max_ttl, stale_ttl=0):
+        self.max_entries = max_entries
+        self.max_ttl = max_ttl                  # Bounds how long another instance's update can go unseen
+        self.stale_ttl = stale_ttl
+        self.entries = OrderedDict()            # key -> (value, expires_at), least recently used first
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] <= time.monotonic():
+                if entry[1] + self.stale_ttl <= time.monotonic():
+                    del self.entries[key]
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return self.MISSING
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, ttl=None):
+        ttl = self.max_ttl if ttl is None else min(ttl, self.max_ttl)
+        if ttl <= 0:
+            self.delete(key)
+            return
+
+        with self.lock:
+            self.entries[key] = (value, time.monotonic() + ttl)
+            self.entries.move_to_end(key)
+
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def get_stale(self, key):
+        """
+        Returns the value even if it expired, as long as that was less than `stale_ttl` ago.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[1] + self.stale_ttl <= time.monotonic():
+                return self.MISSING
+
+            self.stale_hits += 1
+            return entry[0]
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self.entries),
+            'max_entries': self.max_entries,
+            'hits': self.hits,
+            'misses': self.misses,
+            'stale_hits': self.stale_hits,
+            'evictions': self.evictions,
+            'hit_ratio': round(self.hits / lookups, 4) if lookups else None,
+        }
+
+
+local_cache = LocalCache(
+    max_entries=int(os.getenv('LOCAL_CACHE_MAX_ENTRIES', 10000)),
+    max_ttl=float(os.getenv('LOCAL_CACHE_TTL_S', 30)),
+    stale_ttl=float(os.getenv('LOCAL_CACHE_STALE_S', 300))     # How stale data served while sA is down may get
+)
+
+
+# Tokens that were rejected recently, so clients retrying with them are turned away
+# without any network call. Keyed by digest, so its memory use is fixed per entry.
+rejected_tokens = LocalCache(
+    max_entries=int(os.getenv('REJECTED_TOKENS_MAX_ENTRIES', 10000)),
+    max_ttl=float(os.getenv('REJECTED_TOKENS_TTL_S', 30))
+)
+
+def token_digest(token: str):
+    return hashlib.blake2b(token.encode('utf-8'), digest_size=16).digest()
+
+def remember_rejected_token(token: str):
+    rejected_tokens.set(token_digest(token), True)
+
+def is_rejected_token(token: str):
+    return rejected_tokens.get(token_digest(token)) is not LocalCache.MISSING
+
+def remember(key, value, ttl_ms):
+    # A negative TTL means the key has no expiry in Redis
+    local_cache.set(key, value, ttl_ms / 1000 if ttl_ms >= 0 else None)
+
 def cache_set(key: str, value, timeout: int = None):
-    # If value is a dictionary, convert it to a JSON string
-    if isinstance(value, dict):
-        value = json.dumps(value)
-    # If value is a list, convert it to a JSON string
-    elif isinstance(value, list):
-        value = json.dumps(value)
-    # If value is any other non-Redis compatible type, convert it to a string
-    elif not isinstance(value, (str, bytes, int, float)):
-        value = str(value)
-    
+    value = codec.encode(value)
+
     rc.set(key, value, timeout)
+    local_cache.set(key, value, timeout)
 
 def cache_get(key: str):
-    value = rc.get(key)
-    if value:
-        value = value.decode('utf-8')  # Decode bytes to string
-        # If the value is a string and appears to be a JSON string, try to decode it
-        if isinstance(value, str):
-            try:
-                return json.loads(value)  # Attempt to parse the JSON string back into a dictionary/list
-            except json.JSONDecodeError:
-                # If JSON parsing fails, return the raw string
-                return value
-    return value
+    value = local_cache.get(key)
+
+    if value is LocalCache.MISSING:
+        # The value and its remaining TTL come from the same node in one round trip
+        pipe = rc.pipeline()
+        pipe.get(key)
+        pipe.pttl(key)
+        value, ttl_ms = pipe.execute()
+
+        if value is None:
+            return None
+
+        remember(key, value, ttl_ms)
+
+    return codec.decode(value)
+
+def cache_set_many(values: dict, timeout: int = None):
+    encoded = {key: codec.encode(value) for key, value in values.items()}
+
+    # The cluster pipeline sends one batch per node
+    pipe = rc.pipeline()
+    for key, value in encoded.items():
+        pipe.set(key, value, timeout)
+    pipe.execute()
+
+    for key, value in encoded.items():
+        local_cache.set(key, value, timeout)
+
+def split_by_local_tier(keys):
+    found = {}
+    missing_by_slot = {}
+
+    for key in keys:
+        value = local_cache.get(key)
+        if value is LocalCache.MISSING:
+            missing_by_slot.setdefault(rc.keyslot(key), []).append(key)
+        else:
+            found[key] = value
+
+    return found, missing_by_slot
+
+def queue_slot_reads(pipe, missing_by_slot):
+    for slot_keys in missing_by_slot.values():
+        pipe.execute_command('MGET', *slot_keys)  # The mget() helper is blocked on cluster pipelines
+        for key in slot_keys:
+            pipe.pttl(key)
+
+def collect_slot_reads(results, missing_by_slot, found):
+    results = iter(results)
+
+    for slot_keys in missing_by_slot.values():
+        values = next(results)
+        for key, value in zip(slot_keys, values):
+            ttl_ms = next(results)
+            if value is not None:
+                remember(key, value, ttl_ms)
+                found[key] = value
+
+def cache_get_many(keys):
+    """
+    Returns {key: value} for the keys that are cached. Keys missing locally are fetched
+    with one MGET per hash slot, all pipelined together, so keys sharing a hash tag
+    cost a single round trip.
+    """
+    found, missing_by_slot = split_by_local_tier(keys)
+
+    if missing_by_slot:
+        pipe = rc.pipeline()
+        queue_slot_reads(pipe, missing_by_slot)
+        collect_slot_reads(pipe.execute(), missing_by_slot, found)
+
+    return {key: codec.decode(value) for key, value in found.items()}
+
+def token_tag(token: str):
+    return base64.urlsafe_b64encode(token_digest(token)).rstrip(b'=').decode('ascii')
+
+def tagged_cache_key(tag: str, kind: str):
+    return f"{{{tag}}}:{kind}"
+
+def token_cache_key(token: str, kind: str):
+    # Keyed by a 22 character digest instead of the whole JWT. The braces make Redis
+    # Cluster hash only the digest, so every entry cached for one session (user data,
+    # friend ids, ...) lands in the same slot.
+    return tagged_cache_key(token_tag(token), kind)
+
+def user_tokens_key(user_id):
+    return f"user_tokens:{user_id}"
+
+def index_user_token(user_id, token: str, timeout: int):
+    """
+    Records that entries are cached under the token for the user, so they can be found
+    and evicted when the user changes. The index lives as long as the newest token.
+    """
+    pipe = rc.pipeline()
+    pipe.sadd(user_tokens_key(user_id), token_tag(token))
+    pipe.expire(user_tokens_key(user_id), timeout)
+    pipe.execute()
+
+def cache_get_stale(key: str):
+    """
+    Returns what this process last cached under `key`, even if it has expired since.
+    Only meant as a fallback while the source of the data is unavailable.
+    """
+    value = local_cache.get_stale(key)
+    return None if value is LocalCache.MISSING else codec.decode(value)
+
+def get_stale_user_data(token: str):
+    # While Service A is unavailable, a recently expired copy is better than failing,
+    # provided the token itself has not expired
+    if (get_timeout_from_token(token) or 0) <= 0:
+        return None
+
+    user_data = cache_get_stale(token_cache_key(token, 'user_data'))
+    if user_data:
+        print(f"LOG: Service A unavailable, using stale basic user info for user#{user_data.get('id')}")
+
+    return user_data
+
+def cache_delete(key: str):
+    rc.delete(key)
+    local_cache.delete(key)
+
+
+# Same as the functions above, for code running on an event loop
+
+async def async_cache_set(key: str, value, timeout: int = None):
+    value = codec.encode(value)
+
+    await get_async_rc().set(key, value, timeout)
+    local_cache.set(key, value, timeout)
+
+async def async_cache_get(key: str):
+    value = local_cache.get(key)
+
+    if value is LocalCache.MISSING:
+        pipe = get_async_rc().pipeline()
+        pipe.get(key)
+        pipe.pttl(key)
+        value, ttl_ms = await pipe.execute()
+
+        if value is None:
+            return None
+
+        remember(key, value, ttl_ms)
+
+    return codec.decode(value)
+
+async def async_cache_set_many(values: dict, timeout: int = None):
+    encoded = {key: codec.encode(value) for key, value in values.items()}
+
+    pipe = get_async_rc().pipeline()
+    for key, value in encoded.items():
+        pipe.set(key, value, timeout)
+    await pipe.execute()
+
+    for key, value in encoded.items():
+        local_cache.set(key, value, timeout)
+
+async def async_cache_get_many(keys):
+    found, missing_by_slot = split_by_local_tier(keys)
+
+    if missing_by_slot:
+        pipe = get_async_rc().pipeline()
+        queue_slot_reads(pipe, missing_by_slot)
+        collect_slot_reads(await pipe.execute(), missing_by_slot, found)
+
+    return {key: codec.decode(value) for key, value in found.items()}
+
+async def async_cache_delete(key: str):
+    await get_async_rc().delete(key)
+    local_cache.delete(key)
+
+async def async_index_user_token(user_id, token: str, timeout: int):
+    pipe = get_async_rc().pipeline()
+    pipe.sadd(user_tokens_key(user_id), token_tag(token))
+    pipe.expire(user_tokens_key(user_id), timeout)
+    await pipe.execute()
 
 # docker exec -it <container_id_or_name> redis-cli
 # KEYS *
@@ -1,3 +1,564 @@
-from django.test import TestCase
+import jwt
+import json
+import time
+import uuid
+import asyncio
+import decimal
+import datetime
+import threading
+from collections import OrderedDict
+from unittest.mock import patch, MagicMock, AsyncMock
+from django.conf import settings
+from django.test import SimpleTestCase
+from channels.exceptions import ChannelFull
+from sB import codec, http_client
+from sB.breaker import CircuitBreaker, CircuitOpenError
+from sB.utilities import LocalCache, local_cache, token_cache_key, get_stale_user_data
+from sB.singleflight import SingleFlight, AsyncSingleFlight
+from sB.discovery import ServiceResolver
+from sB.loaders import BatchLoader, AsyncBatchLoader, LoadError
+from sB.channel_layer import RedisClusterChannelLayer
 
-# Create your tests here.
+
+class CodecTest(SimpleTestCase):
+    def assertRoundTrip(self, value):
+        decoded = codec.decode(codec.encode(value))
+
+        self.assertEqual(decoded, value)
+        self.assertIs(type(decoded), type(value))
+        return decoded
+
+    def test_native_types(self):
+        for value in (None, True, 0, -7, 2 ** 40, 1.5, 'text', b'\x00bytes', [1, 'a'], {'a': 1}, {1: 'int keys'}):
+            self.assertRoundTrip(value)
+
+    def test_tagged_types(self):
+        values = (
+            (1, 'a', None),
+            {1, 2, 3},
+            frozenset({'a', 'b'}),
+            datetime.datetime(2024, 5, 17, 13, 45, 30, 123456),
+            datetime.datetime(2024, 5, 17, 13, 45, tzinfo=datetime.timezone(datetime.timedelta(hours=2))),
+            datetime.date(2024, 5, 17),
+            decimal.Decimal('1234.5600'),
+            uuid.UUID('12345678-1234-5678-1234-567812345678'),
+        )
+        for value in values:
+            self.assertRoundTrip(value)
+
+    def test_nested_values(self):
+        decoded = self.assertRoundTrip({'ids': (1, 2), 'tags': {'x'}, 'at': [datetime.date(2024, 1, 1)]})
+
+        self.assertIs(type(decoded['ids']), tuple)
+        self.assertIs(type(decoded['at'][0]), datetime.date)
+
+    def test_subclasses_become_their_base_type(self):
+        decoded = codec.decode(codec.encode(OrderedDict(a=1)))
+
+        self.assertEqual(decoded, {'a': 1})
+        self.assertIs(type(decoded), dict)
+
+    def test_unsupported_type(self):
+        with self.assertRaises(TypeError):
+            codec.encode(object())
+
+    def test_legacy_entries(self):
+        self.assertEqual(codec.decode(json.dumps({'id': 1}).encode('utf-8')), {'id': 1})
+        self.assertEqual(codec.decode(json.dumps([1, 2]).encode('utf-8')), [1, 2])
+        self.assertEqual(codec.decode(b'plain text'), 'plain text')
+        self.assertIsNone(codec.decode(None))
+
+
+def wait_until(condition, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("Timed out")
+        time.sleep(0.001)
+
+
+class SingleFlightTest(SimpleTestCase):
+    FOLLOWERS = 4
+
+    def setUp(self):
+        self.flight = SingleFlight()
+        self.release = threading.Event()
+        self.calls = 0
+
+    def run_followers(self, fn):
+        outcomes = []
+
+        def follow():
+            try:
+                outcomes.append(self.flight.do('key', fn))
+            except Exception as e:
+                outcomes.append(e)
+
+        threads = [threading.Thread(target=follow) for _ in range(self.FOLLOWERS)]
+        for thread in threads:
+            thread.start()
+        return threads, outcomes
+
+    def blocking_call(self, outcome):
+        def fn():
+            self.calls += 1
+            self.release.wait(2)
+            if isinstance(outcome, Exception):
+                raise outcome
+            return outcome
+        return fn
+
+    def test_concurrent_calls_share_the_result(self):
+        fn = self.blocking_call('result')
+        threads, outcomes = self.run_followers(fn)
+
+        wait_until(lambda: self.flight.stats()['coalesced'] == self.FOLLOWERS - 1)
+        self.release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(outcomes, ['result'] * self.FOLLOWERS)
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(self.flight.stats(), {'in_flight': 0, 'started': 1, 'coalesced': self.FOLLOWERS - 1})
+
+    def test_leader_error_reaches_followers(self):
+        error = ConnectionError("sA is down")
+        threads, outcomes = self.run_followers(self.blocking_call(error))
+
+        wait_until(lambda: self.flight.stats()['coalesced'] == self.FOLLOWERS - 1)
+        self.release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(outcomes, [error] * self.FOLLOWERS)
+        self.assertEqual(self.calls, 1)
+
+        # The failed call is not remembered
+        self.assertEqual(self.flight.do('key', lambda: 'retried'), 'retried')
+
+
+class AsyncSingleFlightTest(SimpleTestCase):
+    def setUp(self):
+        self.flight = AsyncSingleFlight()
+        self.calls = 0
+
+    def blocking_call(self, release, outcome):
+        async def fn():
+            self.calls += 1
+            await release.wait()
+            if isinstance(outcome, Exception):
+                raise outcome
+            return outcome
+        return fn
+
+    async def test_leader_error_reaches_followers(self):
+        release = asyncio.Event()
+        error = ConnectionError("sA is down")
+
+        callers = [asyncio.create_task(self.flight.do('key', self.blocking_call(release, error))) for _ in range(3)]
+        await asyncio.sleep(0)
+        release.set()
+        outcomes = await asyncio.gather(*callers, return_exceptions=True)
+
+        self.assertEqual(outcomes, [error] * 3)
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(self.flight.stats(), {'in_flight': 0, 'started': 1, 'coalesced': 2})
+
+    async def test_cancelled_caller_does_not_cancel_the_call(self):
+        release = asyncio.Event()
+        fn = self.blocking_call(release, 'result')
+
+        cancelled = asyncio.create_task(self.flight.do('key', fn))
+        follower = asyncio.create_task(self.flight.do('key', fn))
+        await asyncio.sleep(0)
+
+        cancelled.cancel()
+        await asyncio.sleep(0)
+        release.set()
+
+        self.assertEqual(await follower, 'result')
+        self.assertTrue(cancelled.cancelled())
+        self.assertEqual(self.calls, 1)
+
+
+class ServiceResolverTest(SimpleTestCase):
+    def setUp(self):
+        self.redis = MagicMock()
+        self.loaded = threading.Event()
+        self.lrange_threads = []
+
+        def lrange(key, start, end):
+            self.lrange_threads.append(threading.current_thread())
+            self.loaded.wait(2)
+            return [b'10.0.0.1']
+        self.redis.lrange.side_effect = lrange
+
+        with patch('sB.discovery.redis.Redis.from_url', return_value=self.redis):
+            self.resolver = ServiceResolver('redis://sm-redis', 'A', port=8000, refresh_interval=60)
+
+    def test_first_acquire_does_not_wait_for_the_registry(self):
+        # Through the gateway until the registry has been read
+        self.assertIsNone(self.resolver.acquire())
+
+        self.loaded.set()
+        wait_until(lambda: self.resolver.stats())
+
+        instance = self.resolver.acquire()
+        self.assertEqual(instance.base_url, 'http://10.0.0.1:8000/')
+        self.assertNotIn(threading.current_thread(), self.lrange_threads)
+        self.resolver.release(instance, True)
+
+    def test_failing_instance_is_ejected(self):
+        self.loaded.set()
+        self.resolver.refresh()
+
+        for _ in range(self.resolver.eject_after):
+            self.resolver.release(self.resolver.acquire(), False)
+
+        self.assertIsNone(self.resolver.acquire())
+        self.assertGreater(self.resolver.stats()['10.0.0.1']['ejected_for_s'], 0)
+
+
+class CircuitBreakerTest(SimpleTestCase):
+    def setUp(self):
+        self.now = 1000
+        patcher = patch('sB.breaker.time.monotonic', side_effect=lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.breaker = CircuitBreaker('sA', failure_threshold=3, open_s=10)
+
+    def trip(self):
+        for _ in range(self.breaker.failure_threshold):
+            self.breaker.check()
+            self.breaker.record(False)
+
+    def test_opens_after_consecutive_failures(self):
+        self.breaker.record(False)
+        self.breaker.record(False)
+        self.breaker.record(True)   # A success in between starts the count over
+        self.breaker.record(False)
+        self.breaker.record(False)
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+        self.breaker.record(False)
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+
+        with self.assertRaises(CircuitOpenError):
+            self.breaker.check()
+        self.assertEqual(self.breaker.stats()['rejected'], 1)
+        self.assertEqual(self.breaker.stats()['times_opened'], 1)
+
+    def test_half_open_lets_one_probe_through(self):
+        self.trip()
+        self.now += 10
+
+        self.assertTrue(self.breaker.allow())
+        self.assertEqual(self.breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertFalse(self.breaker.allow())
+
+    def test_successful_probe_closes(self):
+        self.trip()
+        self.now += 10
+
+        self.breaker.check()
+        self.breaker.record(True)
+
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        self.assertTrue(self.breaker.allow())
+        self.assertTrue(self.breaker.allow())
+
+    def test_failed_probe_reopens(self):
+        self.trip()
+        self.now += 10
+
+        self.breaker.check()
+        self.breaker.record(False)
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+
+        # For another full open_s
+        self.now += 9
+        self.assertFalse(self.breaker.allow())
+        self.now += 1
+        self.assertTrue(self.breaker.allow())
+
+    @patch('sB.http_client.send')
+    def test_open_circuit_fails_calls_without_sending(self, mock_send):
+        mock_send.return_value = MagicMock(status_code=503)
+
+        with patch.dict(http_client.breakers, {'sA': self.breaker}):
+            for _ in range(self.breaker.failure_threshold):
+                http_client.get('sA/api/users/bulk')
+
+            with self.assertRaises(http_client.RequestError):
+                http_client.get('sA/api/users/bulk')
+
+        self.assertEqual(mock_send.call_count, self.breaker.failure_threshold)
+
+
+class StaleFallbackTest(SimpleTestCase):
+    USER_DATA = {'id': 1, 'username': 'username0', 'rating': 1200}
+
+    def setUp(self):
+        self.now = 1000
+        patcher = patch('sB.utilities.time.monotonic', side_effect=lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(local_cache.clear)
+
+    def make_token(self, expires_in):
+        return jwt.encode({'user_id': 1, 'exp': int(time.time()) + expires_in}, 'secret', algorithm='HS256')
+
+    def test_stale_entries(self):
+        cache = LocalCache(max_entries=10, max_ttl=30, stale_ttl=60)
+        cache.set('key', b'value', ttl=5)
+
+        self.now += 10
+        self.assertIs(cache.get('key'), LocalCache.MISSING)
+        self.assertEqual(cache.get_stale('key'), b'value')
+
+        self.now += 60
+        self.assertIs(cache.get_stale('key'), LocalCache.MISSING)
+
+    def test_stale_user_data_while_sA_is_down(self):
+        token = self.make_token(expires_in=600)
+        local_cache.set(token_cache_key(token, 'user_data'), codec.encode(self.USER_DATA), ttl=5)
+
+        self.now += 10
+        self.assertEqual(get_stale_user_data(token), self.USER_DATA)
+
+        # Too stale by now
+        self.now += local_cache.stale_ttl
+        self.assertIsNone(get_stale_user_data(token))
+
+    def test_no_stale_user_data_for_expired_token(self):
+        token = self.make_token(expires_in=-10)
+        local_cache.set(token_cache_key(token, 'user_data'), codec.encode(self.USER_DATA), ttl=5)
+
+        self.assertIsNone(get_stale_user_data(token))
+
+
+class BatchLoaderTest(SimpleTestCase):
+    def setUp(self):
+        self.batches = []
+
+    def fetch_many(self, keys):
+        self.batches.append(sorted(keys))
+        if 'down' in keys:
+            raise LoadError("sA answered 503", 503)
+        return {key: LoadError(f"{key} failed") if key == 'bad' else key.upper() for key in keys}
+
+    def load_concurrently(self, loader, keys):
+        outcomes = {}
+
+        def load(key):
+            try:
+                outcomes[key] = loader.load(key)
+            except Exception as e:
+                outcomes[key] = e
+
+        threads = [threading.Thread(target=load, args=(key,)) for key in keys]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return outcomes
+
+    def test_concurrent_loads_share_one_call(self):
+        loader = BatchLoader(self.fetch_many, window_s=0.1)
+        outcomes = self.load_concurrently(loader, ['a', 'b', 'c', 'a'])
+
+        self.assertEqual(outcomes, {'a': 'A', 'b': 'B', 'c': 'C'})
+        self.assertEqual(self.batches, [['a', 'b', 'c']])
+        self.assertEqual(loader.stats(), {'loads': 4, 'batches': 1})
+
+    def test_failed_key_does_not_fail_the_others(self):
+        loader = BatchLoader(self.fetch_many, window_s=0.1)
+        outcomes = self.load_concurrently(loader, ['a', 'bad', 'c'])
+
+        self.assertEqual((outcomes['a'], outcomes['c']), ('A', 'C'))
+        self.assertIsInstance(outcomes['bad'], LoadError)
+        self.assertEqual(len(self.batches), 1)
+
+    def test_failed_call_fails_every_key(self):
+        loader = BatchLoader(self.fetch_many, window_s=0.1)
+        outcomes = self.load_concurrently(loader, ['a', 'down'])
+
+        self.assertIsInstance(outcomes['a'], LoadError)
+        self.assertIs(outcomes['a'], outcomes['down'])
+
+    def test_full_batch_is_split(self):
+        loader = BatchLoader(self.fetch_many, window_s=0.1, max_batch=2)
+        outcomes = self.load_concurrently(loader, ['a', 'b', 'c', 'd', 'e'])
+
+        self.assertEqual(outcomes, {key: key.upper() for key in 'abcde'})
+        self.assertTrue(all(len(batch) <= 2 for batch in self.batches))
+
+
+class AsyncBatchLoaderTest(SimpleTestCase):
+    def setUp(self):
+        self.batches = []
+
+    async def fetch_many(self, keys):
+        self.batches.append(sorted(keys))
+        if 'down' in keys:
+            raise LoadError("sA answered 503", 503)
+        return {key: LoadError(f"{key} failed") if key == 'bad' else key.upper() for key in keys}
+
+    async def load_concurrently(self, loader, keys):
+        return await asyncio.gather(*(loader.load(key) for key in keys), return_exceptions=True)
+
+    async def test_concurrent_loads_share_one_call(self):
+        loader = AsyncBatchLoader(self.fetch_many, window_s=0.01)
+
+        self.assertEqual(await self.load_concurrently(loader, ['a', 'b', 'a']), ['A', 'B', 'A'])
+        self.assertEqual(self.batches, [['a', 'b']])
+
+    async def test_failed_key_does_not_fail_the_others(self):
+        loader = AsyncBatchLoader(self.fetch_many, window_s=0.01)
+        a, bad, c = await self.load_concurrently(loader, ['a', 'bad', 'c'])
+
+        self.assertEqual((a, c), ('A', 'C'))
+        self.assertIsInstance(bad, LoadError)
+        self.assertEqual(len(self.batches), 1)
+
+    async def test_failed_call_fails_every_key(self):
+        loader = AsyncBatchLoader(self.fetch_many, window_s=0.01)
+        outcomes = await self.load_concurrently(loader, ['a', 'down'])
+
+        self.assertTrue(all(isinstance(outcome, LoadError) for outcome in outcomes))
+
+    async def test_full_batch_is_sent_right_away(self):
+        loader = AsyncBatchLoader(self.fetch_many, window_s=10, max_batch=2)
+
+        outcomes = await asyncio.wait_for(self.load_concurrently(loader, ['a', 'b']), 1)
+        self.assertEqual(outcomes, ['A', 'B'])
+
+
+def with_layers(test):
+    async def wrapper(self):
+        await self.asyncSetUp()
+        try:
+            await test(self)
+        finally:
+            await self.close_layers()
+    return wrapper
+
+
+class RedisClusterChannelLayerTest(SimpleTestCase):
+    """
+    Runs against the Redis cluster of CHANNEL_LAYERS, each layer standing for one sB process.
+    """
+
+    async def asyncSetUp(self):
+        config = settings.CHANNEL_LAYERS['default']['CONFIG']
+        self.prefix = f'test{uuid.uuid4().hex[:8]}'
+        self.layers = []
+
+        def make_layer(**kwargs):
+            layer = RedisClusterChannelLayer(host=config['host'], port=config['port'], prefix=self.prefix, **kwargs)
+            self.layers.append(layer)
+            return layer
+        self.make_layer = make_layer
+
+        try:
+            await asyncio.wait_for(make_layer().get_state().client.ping(), 2)
+        except Exception as e:
+            await self.layers[0].close()
+            self.skipTest(f"The Redis cluster is not reachable: {e}")
+
+    async def close_layers(self):
+        client = self.layers[0].get_state().client
+        for layer in self.layers:
+            await client.delete(layer.inbox_key(layer.inbox))
+        await client.delete(self.layers[0].group_key('lobby'))
+
+        for layer in self.layers:
+            await layer.close()
+
+    async def receive(self, layer, channel):
+        return await asyncio.wait_for(layer.receive(channel), 3)
+
+    @with_layers
+    async def test_send_to_another_process(self):
+        sender, receiver = self.make_layer(), self.make_layer()
+        channel = await receiver.new_channel()
+
+        await sender.send(channel, {'type': 'chat.message', 'text': 'hello', 'at': (1, 2)})
+
+        self.assertEqual(await self.receive(receiver, channel), {'type': 'chat.message', 'text': 'hello', 'at': (1, 2)})
+
+    @with_layers
+    async def test_group_send_pushes_once_per_process(self):
+        sender, first, second = self.make_layer(), self.make_layer(), self.make_layer()
+        channels = [await first.new_channel(), await first.new_channel(), await second.new_channel()]
+        for channel in channels:
+            await first.group_add('lobby', channel)
+
+        await sender.group_send('lobby', {'type': 'lobby.message'})
+
+        for layer, channel in zip((first, first, second), channels):
+            self.assertEqual(await self.receive(layer, channel), {'type': 'lobby.message'})
+        self.assertEqual(sender.stats()['pushed'], 2)
+
+        # Discarded channels get nothing more
+        await first.group_discard('lobby', channels[0])
+        await sender.group_send('lobby', {'type': 'lobby.message', 'n': 2})
+        self.assertEqual(await self.receive(first, channels[1]), {'type': 'lobby.message', 'n': 2})
+        self.assertTrue(first.queues[channels[0]].empty())
+
+    @with_layers
+    async def test_full_inbox_is_reported(self):
+        sender, receiver = self.make_layer(inbox_capacity=1), self.make_layer()
+        channel = await receiver.new_channel()
+        await receiver.group_add('lobby', channel)
+
+        # Nothing reads the receiver's inbox yet
+        await sender.group_send('lobby', {'type': 'lobby.message', 'n': 1})
+        await sender.group_send('lobby', {'type': 'lobby.message', 'n': 2})
+        self.assertEqual(sender.stats()['refused'], 1)
+
+        with self.assertRaises(ChannelFull):
+            await sender.send(channel, {'type': 'lobby.message', 'n': 3})
+
+        self.assertEqual(await self.receive(receiver, channel), {'type': 'lobby.message', 'n': 1})
+
+    @with_layers
+    async def test_overflow_closes_the_consumer(self):
+        from lobbies import broadcast
+        from lobbies.consumers import LobbyConsumer
+
+        sender, receiver = self.make_layer(), self.make_layer(capacity=2)
+        channel = await receiver.new_channel()
+
+        for n in range(3):
+            await sender.send(channel, {'type': 'lobby.message', 'n': n})
+        receiver.start_reader()
+
+        # What was queued is dropped, the consumer is told to close and then gets nothing more
+        message = await self.receive(receiver, channel)
+        self.assertEqual(message, {'type': 'channel.overflow'})
+        self.assertEqual(receiver.stats()['overflows'], 1)
+
+        consumer = LobbyConsumer()
+        consumer.close = AsyncMock()
+        await consumer.channel_overflow(message)
+        consumer.close.assert_awaited_once_with(code=broadcast.SLOW_CONSUMER_CLOSE_CODE)
+
+        await sender.send(channel, {'type': 'lobby.message', 'n': 4})
+        await sender.send(channel, {'type': 'lobby.message', 'n': 5})
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(receiver.receive(channel), 0.5)
+
+    @with_layers
+    async def test_bad_entry_does_not_stop_delivery(self):
+        sender, receiver = self.make_layer(), self.make_layer()
+        channel = await receiver.new_channel()
+        receiver.start_reader()
+
+        client = sender.get_state().client
+        await client.rpush(receiver.inbox_key(receiver.inbox), b'not msgpack', codec.encode(['no', 'timestamp']))
+        await sender.send(channel, {'type': 'lobby.message'})
+
+        self.assertEqual(await self.receive(receiver, channel), {'type': 'lobby.message'})
+        self.assertEqual(receiver.stats()['undeliverable'], 2)
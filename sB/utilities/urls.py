@@ -1,7 +1,8 @@
 from django.urls import path
-from .views import StatusView
+from .views import StatusView, MetricsView
 
 
 urlpatterns = [
     path('ping', StatusView.as_view(), name='ping'),
+    path('metrics', MetricsView.as_view(), name='metrics'),
 ]
\ No newline at end of file
@@ -2,6 +2,13 @@ from rest_framework.views import APIView
 from sB.permissions import ProvidesValidRootPassword
 from rest_framework.response import Response
 from rest_framework import status
+from sB.utilities import local_cache, rejected_tokens
+from sB.middleware import logger as logstash_logger
+from sB import http_client, loaders, user_events
+from sB.permissions import token_validations
+from lobbies.consumers import token_validations as async_token_validations
+from lobbies import broadcast, games
+from channels.layers import get_channel_layer
 import os
 
 
@@ -12,4 +19,28 @@ class StatusView(APIView):
         return Response(
             {'message': f"Instance of service B running on 127.0.0.1:{os.getenv('PORT')} is alive!"},
             status=status.HTTP_202_ACCEPTED
-        )
\ No newline at end of file
+        )
+
+
+class MetricsView(APIView):
+    permission_classes = [ProvidesValidRootPassword]
+
+    def get(self, request):
+        channel_layer = get_channel_layer()
+
+        return Response(
+            {
+                'local_cache': local_cache.stats(),
+                'rejected_tokens': rejected_tokens.stats(),
+                'token_validations': token_validations.stats(),
+                'async_token_validations': async_token_validations.stats(),
+                'http_client': http_client.get_stats(),
+                'loaders': loaders.get_stats(),
+                'user_events': user_events.subscriber.stats() if user_events.subscriber else None,
+                'channel_layer': channel_layer.stats() if hasattr(channel_layer, 'stats') else None,
+                'broadcast_hubs': broadcast.get_stats(),
+                'games': games.get_stats(),
+                'logstash': logstash_logger.stats(),
+            },
+            status=status.HTTP_200_OK
+        )